@@ -1 +1,16 @@
-from .operators import *
+from typing import Any, List
+from as_scraper_airflow import operators
+
+__all__ = list(operators.__all__)
+
+
+def __getattr__(name: str) -> Any:
+    if name not in __all__:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(operators, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(__all__))
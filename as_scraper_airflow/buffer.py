@@ -0,0 +1,71 @@
+import logging
+from time import monotonic
+from typing import Callable, List, Optional
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+
+class ResultBuffer:
+    '''
+    Accumulate scraper results and hand them to a storage function in chunks.
+
+    Without thresholds, every result is buffered and flushed once when the buffer is closed.
+
+    Parameters:
+    -----------
+    flush : `Callable[[pd.DataFrame], None]`
+        Function that stores a chunk of results.
+    every_rows : `Optional[int]`
+        Flush as soon as this many rows are buffered.
+    every_seconds : `Optional[float]`
+        Flush buffered rows when this many seconds passed since the last flush. It is checked
+        whenever new results are added.
+    '''
+
+    def __init__(
+        self,
+        flush: Callable[[pd.DataFrame], None],
+        every_rows: Optional[int] = None,
+        every_seconds: Optional[float] = None,
+    ):
+        self._flush = flush
+        self.every_rows = every_rows
+        self.every_seconds = every_seconds
+        self.rows_flushed = 0
+        self._chunks: List[pd.DataFrame] = []
+        self._rows = 0
+        self._last_flush = monotonic()
+
+    def add(self, df: pd.DataFrame) -> None:
+        '''
+        Buffer results, flushing them if a threshold is reached.
+        '''
+        if not len(df):
+            return
+        self._chunks.append(df)
+        self._rows += len(df)
+        if self.every_rows is not None and self._rows >= self.every_rows:
+            self.flush()
+        elif self.every_seconds is not None and monotonic() - self._last_flush >= self.every_seconds:
+            self.flush()
+
+    def flush(self) -> None:
+        '''
+        Store the buffered results, if any.
+        '''
+        self._last_flush = monotonic()
+        if not self._chunks:
+            return
+        df = pd.concat(self._chunks, ignore_index=True)
+        self._chunks = []
+        self._rows = 0
+        log.info('Flushing %d results', len(df))
+        self._flush(df)
+        self.rows_flushed += len(df)
+
+    def close(self) -> None:
+        '''
+        Store the remaining results.
+        '''
+        self.flush()
@@ -0,0 +1,121 @@
+from datetime import timedelta
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+from time import time
+from typing import Any, Dict, Optional, Type
+import pandas as pd
+from as_scraper.scraper import Scraper
+
+log = logging.getLogger(__name__)
+
+
+class ResultCache:
+    '''
+    On-disk cache of scraped results per url, shared between DAG runs.
+
+    Entries expire after `ttl` and the least recently used entries are evicted when the cache
+    grows past `max_size` bytes. Scrapers can define a `VERSION` class variable, which is part
+    of the cache key, so changing it invalidates the results cached by previous versions.
+
+    Parameters:
+    -----------
+    directory : `str`
+        Directory of the cache database. It is created if needed.
+    ttl : `Optional[timedelta]`
+        Time to live of the entries. Defaults to 1 day.
+    max_size : `Optional[int]`
+        Maximum size of the cached results in bytes. Defaults to 1GiB.
+    '''
+
+    def __init__(
+        self,
+        directory: str,
+        ttl: Optional[timedelta] = timedelta(days=1),
+        max_size: Optional[int] = 2 ** 30,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'results.sqlite')
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            self.path, timeout=30, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries '
+                '(key TEXT PRIMARY KEY, output BLOB, size INTEGER, expires REAL, accessed REAL)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self._size, = self._connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+
+    @staticmethod
+    def key(scraper_cls: Type[Scraper], url: str, extras: Dict[str, Any]) -> str:
+        '''
+        Cache key of an url scraped by a scraper class. Extra parameters are part of the key
+        because they can change the output of `scrape_handler`.
+        '''
+        scraper_name = f'{scraper_cls.__module__}.{scraper_cls.__qualname__}'
+        version = getattr(scraper_cls, 'VERSION', None)
+        content = json.dumps([scraper_name, version, url, extras],
+                             sort_keys=True, default=str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        '''
+        Get the cached results of a key, or None if they are missing or expired.
+        '''
+        now = time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                'SELECT output, expires FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None or row[1] < now:
+                self.misses += 1
+                return None
+            self._connection.execute(
+                'UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return pickle.loads(row[0])
+
+    def put(self, key: str, df: pd.DataFrame) -> None:
+        '''
+        Cache the results of a key, evicting old entries if the cache is full.
+        '''
+        output = pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+        now = time()
+        with self._lock, self._connection:
+            previous = self._connection.execute(
+                'SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+            self._connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                                     (key, output, len(output), now + self.ttl.total_seconds(), now))
+            self._size += len(output) - (previous[0] if previous else 0)
+            if self._size > self.max_size:
+                self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        self._connection.execute(
+            'DELETE FROM entries WHERE expires < ?', (now,))
+        self._size, = self._connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+        evicted = []
+        entries = self._connection.execute(
+            'SELECT key, size FROM entries ORDER BY accessed').fetchall()
+        for key, size in entries:
+            if self._size <= self.max_size:
+                break
+            evicted.append((key,))
+            self._size -= size
+        self._connection.executemany(
+            'DELETE FROM entries WHERE key = ?', evicted)
+        log.info('Evicted %d entries from the result cache', len(evicted))
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+from typing import Iterable, Iterator, List, Set, Tuple
+from urllib.parse import quote
+import pandas as pd
+from as_scraper.errors import ScraperError
+
+log = logging.getLogger(__name__)
+
+
+class CheckpointStore:
+    '''
+    SQLite store of the urls already scraped by a task run, with their results and errors.
+
+    Urls are recorded in batches: a batch is written in a single transaction once all its urls
+    went through every scraper, so a crashed task never leaves partial batches behind.
+
+    Parameters:
+    -----------
+    path : `str`
+        Path of the SQLite database file. Parent directories are created if needed.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS batches (id INTEGER PRIMARY KEY, output BLOB, errors TEXT)')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, batch_id INTEGER)')
+
+    @classmethod
+    def for_task(
+        cls,
+        directory: str,
+        dag_id: str,
+        task_id: str,
+        run_id: str,
+        map_index: int = -1,
+    ) -> 'CheckpointStore':
+        '''
+        Open the checkpoint of a task run, stored at `<directory>/<dag_id>/<task_id>/<run_id>`.
+        '''
+        name = quote(run_id, safe='')
+        if map_index >= 0:
+            name = f'{name}.{map_index}'
+        return cls(os.path.join(directory, quote(dag_id, safe=''), quote(task_id, safe=''), f'{name}.sqlite'))
+
+    def completed_urls(self) -> Set[str]:
+        '''
+        Urls already scraped.
+        '''
+        with self._lock:
+            rows = self._connection.execute('SELECT url FROM urls').fetchall()
+        return {url for url, in rows}
+
+    def completed_batches(self) -> Iterator[Tuple[pd.DataFrame, List[ScraperError]]]:
+        '''
+        Results and errors of the batches already scraped, in the order they were saved.
+        '''
+        with self._lock:
+            ids = [id for id, in self._connection.execute(
+                'SELECT id FROM batches ORDER BY id').fetchall()]
+        for id in ids:
+            with self._lock:
+                output, errors = self._connection.execute(
+                    'SELECT output, errors FROM batches WHERE id = ?', (id,)).fetchone()
+            yield pickle.loads(output), [ScraperError(*error) for error in json.loads(errors)]
+
+    def save_batch(self, urls: Iterable[str], df: pd.DataFrame, errors: List[ScraperError]) -> None:
+        '''
+        Record a batch of urls as scraped, along with its results and errors.
+        '''
+        output = pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock, self._connection:
+            cursor = self._connection.execute('INSERT INTO batches (output, errors) VALUES (?, ?)',
+                                              (output, json.dumps([list(error) for error in errors])))
+            self._connection.executemany('INSERT OR REPLACE INTO urls (url, batch_id) VALUES (?, ?)',
+                                         [(url, cursor.lastrowid) for url in urls])
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def clear(self) -> None:
+        '''
+        Close and delete the checkpoint. Used once the task results are stored.
+        '''
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,73 @@
+from hashlib import sha256
+from json import dumps
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+from airflow.providers.google.cloud.hooks.bigquery import BigQueryHook
+from airflow.providers.google.common.consts import CLIENT_INFO
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud.bigquery import Client
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 32
+
+_clients: Dict[Tuple[str, str, int], Client] = {}
+_lock = threading.Lock()
+
+
+def _credentials_key(hook: BigQueryHook) -> str:
+    # The credentials of a connection are defined by its extras: key file, key secret,
+    # impersonation chain or scopes. Editing them yields a new client.
+    return sha256(dumps(hook.extras, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def bigquery_client(conn_id: str, pool_size: Optional[int] = DEFAULT_POOL_SIZE) -> Client:
+    '''
+    BigQuery client of a connection, shared by every task running in the process.
+
+    Creating a client resolves the credentials of the connection, and its first requests pay
+    for the token exchange and the TLS handshakes. Sharing it lets mapped tasks and consecutive
+    tasks on a worker reuse a warm pool of keep-alive connections. Credentials are only
+    refreshed when a request needs a token, and again when it expires.
+
+    Parameters:
+    -----------
+    conn_id : `str`
+        The Airflow connection ID for BigQuery.
+    pool_size : `Optional[int]`
+        Maximum number of keep-alive connections kept open to the BigQuery API, which bounds
+        the concurrent requests that do not wait for a connection. Defaults to 32.
+
+    Returns:
+    --------
+    client : `Client`
+        The shared client. It can be used from several threads.
+    '''
+    hook = BigQueryHook(gcp_conn_id=conn_id, use_legacy_sql=False)
+    key = (conn_id, _credentials_key(hook), pool_size)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            log.info('Creating BigQuery client for connection %s', conn_id)
+            credentials, project_id = hook.get_credentials_and_project_id()
+            session = AuthorizedSession(credentials)
+            adapter = HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            client = Client(project=project_id, credentials=credentials,
+                            _http=session, client_info=CLIENT_INFO)
+            _clients[key] = client
+    return client
+
+
+def clear_client_cache() -> None:
+    '''
+    Close and forget the shared clients, e.g. after rotating the credentials of a connection
+    in place.
+    '''
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
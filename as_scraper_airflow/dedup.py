@@ -0,0 +1,288 @@
+from datetime import date, datetime
+from decimal import Decimal
+import logging
+import os
+from tempfile import TemporaryDirectory
+from typing import Any, Iterable, List, Optional, Sequence
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+
+# Second pandas hash key, used for the low 64 bits of 128 bit hashes. It must be 16 bytes long.
+_LOW_HASH_KEY = 'as-scraper-dedup'
+# Number of in-memory hash runs merged together when it is exceeded.
+_MAX_RUNS = 8
+
+
+def hash_dtype(hash_bits: int) -> np.dtype:
+    '''
+    Numpy dtype of row hashes of `hash_bits` bits, either 64 or 128.
+    '''
+    if hash_bits == 64:
+        return np.dtype('<u8')
+    if hash_bits == 128:
+        return np.dtype([('high', '<u8'), ('low', '<u8')])
+    raise ValueError('hash_bits must be 64 or 128')
+
+
+def _canonical_value(value: Any) -> Optional[str]:
+    '''
+    String of a value that is the same for equal values of different types, like the int 1 and
+    the float 1.0 of a column with missing values, or a float and the decimal read from a
+    NUMERIC column.
+    '''
+    if pd.api.types.is_scalar(value) and pd.isna(value):
+        return None
+    if isinstance(value, (bool, np.bool_)):
+        return str(bool(value)).lower()
+    if isinstance(value, (int, float, Decimal, np.integer, np.floating)):
+        # Floats are taken from their shortest representation, 0.1 rather than its binary value
+        if isinstance(value, (float, np.floating)):
+            number = Decimal(repr(float(value)))
+        else:
+            number = Decimal(value)
+        if number == number.to_integral_value():
+            return str(int(number))
+        return format(number.normalize(), 'f')
+    if isinstance(value, datetime):
+        value = pd.Timestamp(value)
+        if value.tzinfo is not None:
+            value = value.tz_convert('UTC')
+        return value.isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+def _canonical_column(column: pd.Series) -> pd.Series:
+    inferred = pd.api.types.infer_dtype(column, skipna=False)
+    if inferred in ('string', 'empty'):
+        return column.astype(object)
+    if pd.api.types.is_integer_dtype(column.dtype) and not pd.api.types.is_extension_array_dtype(column.dtype):
+        return column.astype(str).astype(object)
+    return column.map(_canonical_value).astype(object)
+
+
+def row_hashes(df: pd.DataFrame, columns: Sequence[str], hash_bits: int = 64) -> np.ndarray:
+    '''
+    Hash of the `columns` of every row. Values are hashed by a canonical string, so that hashes
+    don't depend on the dtypes pandas inferred for each chunk, nor on whether they were
+    scraped or read from BigQuery: equal numbers have the same hash whether they are ints,
+    floats or decimals, and datetimes are compared in UTC. Strings are not parsed, so a date
+    scraped as a string doesn't match the datetime read from a TIMESTAMP column.
+    '''
+    keys = pd.DataFrame({column: _canonical_column(df[column])
+                         for column in columns})
+    high = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+    if hash_bits == 64:
+        return high
+    hashes = np.empty(len(df), dtype=hash_dtype(hash_bits))
+    hashes['high'] = high
+    hashes['low'] = pd.util.hash_pandas_object(
+        keys, index=False, hash_key=_LOW_HASH_KEY).to_numpy()
+    return hashes
+
+
+def _contains(run: np.ndarray, values: np.ndarray) -> np.ndarray:
+    '''
+    Whether each value is in a sorted array of hashes.
+    '''
+    positions = np.searchsorted(run, values)
+    found = positions < len(run)
+    found[found] = run[positions[found]] == values[found]
+    return found
+
+
+class HashDeduplicator:
+    '''
+    Drop duplicate rows across chunks of results keeping only a fixed-width hash per row.
+
+    Hashes are kept in sorted runs. When the runs take more than `max_memory` bytes they are
+    merged and spilled to a memory-mapped file, so memory stays bounded for any number of rows.
+
+    Rows are compared by the hash of their `columns`, so two different rows are taken as
+    duplicates with a probability of about `n ** 2 / 2 ** (hash_bits + 1)` for `n` rows.
+
+    Parameters:
+    -----------
+    columns : `Sequence[str]`
+        Columns that identify a row.
+    hash_bits : `Optional[int]`
+        Either 64 or 128. Defaults to 64.
+    max_memory : `Optional[int]`
+        Bytes of hashes kept in memory before spilling them to disk. Defaults to 64MiB.
+    spill_dir : `Optional[str]`
+        Directory for the spilled hashes. Defaults to a temporary directory.
+    '''
+
+    def __init__(
+        self,
+        columns: Sequence[str],
+        hash_bits: Optional[int] = 64,
+        max_memory: Optional[int] = 64 * 2 ** 20,
+        spill_dir: Optional[str] = None,
+    ):
+        self.dtype = hash_dtype(hash_bits)
+        self.columns = list(columns)
+        self.hash_bits = hash_bits
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self.dropped = 0
+        self._runs: List[np.ndarray] = []
+        self._spilled: List[np.ndarray] = []
+        self._memory = 0
+        self._tmp_dir: Optional[TemporaryDirectory] = None
+
+    def filter(self, df: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Drop the rows of a chunk that are duplicated within it or were seen in previous chunks.
+        The first occurrence of a row is kept.
+        '''
+        if not len(df):
+            return df
+        hashes = row_hashes(df, self.columns, self.hash_bits)
+        unique, positions = np.unique(hashes, return_index=True)
+        new = np.ones(len(unique), dtype=bool)
+        for run in self._runs + self._spilled:
+            new &= ~_contains(run, unique)
+        self._add(unique[new])
+        kept = np.sort(positions[new])
+        self.dropped += len(df) - len(kept)
+        return df.iloc[kept]
+
+    def close(self) -> None:
+        '''
+        Release the hashes and delete the spilled files.
+        '''
+        self._runs = []
+        self._spilled = []
+        self._memory = 0
+        if self._tmp_dir is not None:
+            self._tmp_dir.cleanup()
+            self._tmp_dir = None
+
+    def _add(self, hashes: np.ndarray) -> None:
+        if not len(hashes):
+            return
+        self._runs.append(hashes)
+        self._memory += hashes.nbytes
+        if self._memory > self.max_memory:
+            self._spill()
+        elif len(self._runs) > _MAX_RUNS:
+            self._runs = [self._merge(self._runs)]
+
+    @staticmethod
+    def _merge(runs: List[np.ndarray]) -> np.ndarray:
+        # Runs never share hashes, so there is nothing to de-duplicate
+        merged = np.concatenate(runs)
+        merged.sort()
+        return merged
+
+    def _spill(self) -> None:
+        if self._tmp_dir is None:
+            self._tmp_dir = TemporaryDirectory(
+                prefix='dedup-', dir=self.spill_dir)
+        path = os.path.join(self._tmp_dir.name, f'{len(self._spilled)}.npy')
+        np.save(path, self._merge(self._runs))
+        self._spilled.append(np.load(path, mmap_mode='r'))
+        log.info('Spilled %d row hashes to disk', self._memory //
+                 self.dtype.itemsize)
+        self._runs = []
+        self._memory = 0
+
+
+class FingerprintIndex:
+    '''
+    Persistent index of the rows stored by previous runs, used to skip them in append-only
+    destinations.
+
+    The index is a sorted array of row hashes saved as a `.npy` file and memory-mapped for
+    lookups. New rows are only added to the file on `commit`, once they are stored, so a failed
+    run doesn't mark rows as stored.
+
+    Parameters:
+    -----------
+    path : `str`
+        Path of the index file.
+    columns : `Sequence[str]`
+        Columns that identify a row.
+    hash_bits : `Optional[int]`
+        Either 64 or 128. Defaults to 64.
+    '''
+
+    def __init__(self, path: str, columns: Sequence[str], hash_bits: Optional[int] = 64):
+        self.path = path
+        self.columns = list(columns)
+        self.hash_bits = hash_bits
+        self.dtype = hash_dtype(hash_bits)
+        self.skipped = 0
+        self._pending: List[np.ndarray] = []
+        self._index = np.empty(0, dtype=self.dtype)
+        self.exists = False
+        if os.path.exists(path):
+            index = np.load(path, mmap_mode='r')
+            if index.dtype == self.dtype:
+                self._index = index
+                self.exists = True
+            else:
+                log.warning('Ignoring fingerprint index %s with %d bit hashes',
+                            path, index.dtype.itemsize * 8)
+
+    def filter(self, df: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Drop the rows already in the index. The hashes of the kept rows are added to the index
+        on `commit`.
+        '''
+        if not len(df):
+            return df
+        hashes = row_hashes(df, self.columns, self.hash_bits)
+        new = ~_contains(self._index, hashes)
+        self._pending.append(hashes[new])
+        self.skipped += len(df) - int(new.sum())
+        return df.iloc[np.flatnonzero(new)]
+
+    def stage(self, path: str) -> None:
+        '''
+        Save the hashes of the kept rows to a `.npy` file, to `commit` them from another process,
+        like after a deferred task resumes.
+        '''
+        np.save(path, np.concatenate(
+            [np.empty(0, dtype=self.dtype)] + self._pending))
+        self._pending = []
+
+    def commit(self, staged: Optional[str] = None) -> None:
+        '''
+        Add the hashes of the kept rows to the index file, with those saved by `stage` at the
+        `staged` path, if it exists. The staged file is deleted.
+        '''
+        runs = [self._index] + self._pending
+        if staged is not None and os.path.exists(staged):
+            runs.append(np.load(staged))
+        self._write(runs)
+        self._pending = []
+        if staged is not None and os.path.exists(staged):
+            os.remove(staged)
+
+    def rebuild(self, frames: Iterable[pd.DataFrame]) -> None:
+        '''
+        Replace the index with the rows of a destination, read in chunks.
+        '''
+        self._write([row_hashes(df, self.columns, self.hash_bits)
+                     for df in frames])
+        self._pending = []
+
+    def _write(self, runs: List[np.ndarray]) -> None:
+        runs = [np.empty(0, dtype=self.dtype)] + runs
+        hashes = np.unique(np.concatenate(
+            [np.asarray(run, dtype=self.dtype) for run in runs]))
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.tmp.npy'
+        np.save(tmp_path, hashes)
+        # Release the memory map of the previous file before replacing it
+        self._index = hashes
+        os.replace(tmp_path, self.path)
+        self._index = np.load(self.path, mmap_mode='r')
+        self.exists = True
+        log.info('Fingerprint index has %d rows', len(hashes))
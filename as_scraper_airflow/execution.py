@@ -0,0 +1,609 @@
+from concurrent.futures import Executor, ThreadPoolExecutor
+import logging
+from math import ceil
+import os
+import threading
+from time import monotonic
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Type
+import pandas as pd
+import requests
+from as_scraper.errors import ScraperError
+from as_scraper.exceptions import ThresholdException
+from as_scraper.scraper import Scraper
+from as_scraper_airflow.fetch import AsyncFetcher
+from as_scraper_airflow.http_cache import HttpCache
+from as_scraper_airflow.scheduler import ERROR, OK, HostLimits, HostScheduler, RetryPolicy, request_outcome
+from as_scraper_airflow.webdriver_pool import WebDriverPool
+
+log = logging.getLogger(__name__)
+
+
+RowResult = Tuple[Optional[pd.DataFrame], Optional[ScraperError]]
+
+
+def _cgroup_cpu_quota() -> Optional[float]:
+    '''
+    Read the cpu quota of the current cgroup, in number of cpus. Returns None when there is no
+    quota or it can't be read.
+    '''
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as file:
+            quota, period = file.read().split()
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as file:
+            quota = int(file.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as file:
+            period = int(file.read())
+        if quota <= 0:
+            return None
+        return quota / period
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus() -> int:
+    '''
+    Number of cpus this task is allowed to use, considering the cpu affinity of the process and
+    the cgroup cpu quota of the container.
+    '''
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, int(quota)))
+    return cpus
+
+
+def empty_output(scraper_cls: Type[Scraper]) -> pd.DataFrame:
+    '''
+    Empty dataframe with the columns and dtypes of a scraper output.
+    '''
+    df = pd.DataFrame(columns=scraper_cls.COLUMNS)
+    if scraper_cls.DTYPES is not None:
+        df = df.astype(scraper_cls.DTYPES, errors='ignore')
+    return df
+
+
+def urls_and_extras(df: pd.DataFrame) -> List[Tuple[str, Dict[str, Any]]]:
+    '''
+    Extract urls and extra parameters from a scraper input.
+
+    Parameters:
+    -----------
+    df : `pd.DataFrame`
+        The scraper input. Columns other than `url` are passed to `scrape_handler` as
+        keyword arguments.
+
+    Returns:
+    --------
+    urls_and_extras : `List[Tuple[str, Dict[str, Any]]]`
+        A list of pairs consisting on a url and a dict with extra arguments.
+    '''
+    if 'url' not in df.columns:
+        raise AttributeError('df must have a `url` column')
+    records = df.to_dict(orient='records')
+    return [(record.pop('url'), record) for record in records]
+
+
+def scrape_url(
+    scraper: Scraper,
+    url: str,
+    extras: Dict[str, Any],
+    html: Optional[Any] = None,
+    driver: Optional[Any] = None,
+) -> RowResult:
+    '''
+    Call the scraper `scrape_handler` for an already loaded url.
+
+    Returns:
+    --------
+    df, error : `Tuple[Optional[pd.DataFrame], Optional[ScraperError]]`
+        The scraped data, or the error raised by the handler.
+    '''
+    try:
+        return scraper.scrape_handler(url, html, driver, **extras), None
+    except Exception as e:
+        log.error(str(e))
+        return None, ScraperError(url, str(e))
+
+
+def split_chunks(df: pd.DataFrame, chunk_size: int) -> List[pd.DataFrame]:
+    '''
+    Split a scraper input dataframe into consecutive chunks.
+
+    Parameters:
+    -----------
+    df : `pd.DataFrame`
+        The scraper input. It needs to have an `url` column.
+    chunk_size : `int`
+        Maximum number of rows per chunk.
+
+    Returns:
+    --------
+    chunks : `List[pd.DataFrame]`
+        The chunks, in the same order as the rows of `df`.
+    '''
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be greater than 0')
+    return [df.iloc[start:start + chunk_size].reset_index(drop=True)
+            for start in range(0, len(df), chunk_size)]
+
+
+def url_batches(urls: Iterable[str], batch_size: int) -> Iterator[pd.DataFrame]:
+    '''
+    Lazily group urls into scraper input dataframes.
+
+    Parameters:
+    -----------
+    urls : `Iterable[str]`
+        The urls to scrape. They are consumed as batches are requested, so generators are never
+        fully materialized.
+    batch_size : `int`
+        Maximum number of urls per batch.
+
+    Returns:
+    --------
+    batches : `Iterator[pd.DataFrame]`
+        Dataframes with an `url` column.
+    '''
+    if batch_size < 1:
+        raise ValueError('batch_size must be greater than 0')
+    batch = []
+    for url in urls:
+        batch.append(url)
+        if len(batch) == batch_size:
+            yield pd.DataFrame({'url': batch})
+            batch = []
+    if batch:
+        yield pd.DataFrame({'url': batch})
+
+
+def load_html_requests(scraper: Scraper, url: str, http_cache: Optional[HttpCache] = None) -> Optional[bytes]:
+    '''
+    Load the html for an url with the scraper requests session. If an `HttpCache` is given, the
+    request is conditional and the cached body is returned for `304 Not Modified` responses.
+    '''
+    if http_cache is None:
+        return scraper._load_html_requests(url)
+    ok_status_code = 200
+    not_modified_status_code = 304
+    headers = {**scraper.headers, **http_cache.conditional_headers(url)}
+    response = scraper.session.get(url, headers=headers)
+    if response.status_code == ok_status_code:
+        http_cache.store(url, response.headers, response.content)
+        return response.content
+    if response.status_code == not_modified_status_code:
+        content = http_cache.body(url)
+        if content is not None:
+            return content
+    log.error('Failed http get request for url %s', url)
+
+
+def load_and_scrape(
+    scraper: Scraper,
+    url: str,
+    extras: Dict[str, Any],
+    http_cache: Optional[HttpCache] = None,
+) -> RowResult:
+    '''
+    Load an url with the scraper own loader, requests or selenium, and scrape it. Requests that
+    time out or can't connect are reported as errors of the url.
+    '''
+    if scraper.LOAD_JAVASCRIPT:
+        scraper._load_html_selenium(url)
+        return scrape_url(scraper, url, extras, driver=scraper.driver)
+    try:
+        html = load_html_requests(scraper, url, http_cache)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        log.error('%s. Failed http get request for url %s', type(e), url)
+        return None, ScraperError(url, str(e) or type(e).__name__)
+    if html is None:
+        return None, ScraperError(url, 'Html not loaded')
+    return scrape_url(scraper, url, extras, html=html)
+
+
+class ErrorCounter:
+    '''
+    Count the urls and errors of a scraper over the inputs it is called with, so that its
+    `ERROR_THRESHOLD` applies to all the urls of a run rather than to each input.
+
+    The threshold is a fraction of the `total` number of urls of the run. If the total is
+    known, inputs fail as soon as the errors pass it. Otherwise, like for crawled urls or the
+    output of a previous scraper, errors can only be compared to the urls of the whole run, with
+    `check` once every input was added.
+
+    Parameters:
+    -----------
+    scraper_cls : `Type[Scraper]`
+        The scraper whose `ERROR_THRESHOLD` applies.
+    total : `Optional[int]`
+        Number of urls of the run, if known.
+    '''
+
+    def __init__(self, scraper_cls: Type[Scraper], total: Optional[int] = None):
+        self.threshold = scraper_cls.ERROR_THRESHOLD
+        self.total = total
+        self.urls = 0
+        self.errors = 0
+
+    def exceeded(self, errors: int) -> bool:
+        '''
+        Whether `errors` more errors, counting the inputs added before, pass the threshold of
+        the run. Always False while the total is unknown.
+        '''
+        if self.total is None:
+            return False
+        return self.errors + errors > self.total * self.threshold
+
+    def add(self, urls: int, errors: int) -> None:
+        '''
+        Count an input once it is scraped. Raises a `ThresholdException` if the errors pass the
+        threshold of the run.
+        '''
+        if self.exceeded(errors):
+            raise ThresholdException(self.threshold * 100)
+        self.urls += urls
+        self.errors += errors
+
+    def check(self) -> None:
+        '''
+        Raise a `ThresholdException` if the errors pass the threshold of the urls added so far.
+        Used once the run is done, when its total was unknown.
+        '''
+        if self.errors > self.urls * self.threshold:
+            raise ThresholdException(self.threshold * 100)
+
+
+def execute_scraper(
+    scraper: Scraper,
+    scraper_input: pd.DataFrame,
+    counter: Optional[ErrorCounter] = None,
+) -> Tuple[pd.DataFrame, List[ScraperError]]:
+    '''
+    Scrape an input with the scraper own `execute` method. The scraper instance can be called
+    with many inputs, keeping its requests session between them.
+
+    If a `counter` is given, the threshold is checked by the counter once the input is scraped,
+    instead of by the scraper against this input only.
+    '''
+    if counter is None:
+        return scraper.execute(scraper_input)
+    # Errors never pass a threshold of 100%, so the counter is the one to check it
+    scraper.ERROR_THRESHOLD = 1
+    df, errors = scraper.execute(scraper_input)
+    counter.add(len(scraper_input), len(errors))
+    return df, errors
+
+
+def merge_rows(
+    scraper_cls: Type[Scraper],
+    rows: List[RowResult],
+    counter: Optional[ErrorCounter] = None,
+) -> Tuple[pd.DataFrame, List[ScraperError]]:
+    '''
+    Merge the results of every url of a scraper input, keeping their order.
+
+    Raises a `ThresholdException` if the errors pass the scraper `ERROR_THRESHOLD`, counting
+    the inputs added before to `counter` if it is given.
+
+    Returns:
+    --------
+    df, errors : `Tuple[pd.DataFrame, List[ScraperError]]`
+        The scraper results and the errors captured in the process.
+    '''
+    outputs = [empty_output(scraper_cls)]
+    errors = []
+    for df, error in rows:
+        if error is None:
+            outputs.append(df)
+        else:
+            errors.append(error)
+    if counter is None:
+        counter = ErrorCounter(scraper_cls, len(rows))
+    counter.add(len(rows), len(errors))
+    return pd.concat(outputs, ignore_index=True), errors
+
+
+def scrape_serially(
+    scraper_cls: Type[Scraper],
+    inputs: Iterable[Tuple[str, Dict[str, Any]]],
+    http_cache: Optional[HttpCache] = None,
+    response_hook: Optional[Callable[..., Any]] = None,
+) -> Iterator[RowResult]:
+    '''
+    Scrape urls one after another with a fresh scraper instance, restarting its selenium driver
+    every `RESET_AFTER` pages. Urls are consumed lazily.
+
+    If a `response_hook` is given, it is called with every response of the requests session of
+    `LOAD_JAVASCRIPT=False` scrapers.
+    '''
+    scraper = scraper_cls()
+    if response_hook is not None and not scraper.LOAD_JAVASCRIPT:
+        scraper.session.hooks['response'].append(response_hook)
+    # Number of pages loaded by the current selenium driver
+    pages = 0
+    try:
+        for url, extras in inputs:
+            pages += 1
+            yield load_and_scrape(scraper, url, extras, http_cache)
+            if scraper.LOAD_JAVASCRIPT and scraper.RESET_AFTER is not None and pages == scraper.RESET_AFTER:
+                log.info('Reseting Selenium driver')
+                scraper.driver.quit()
+                scraper = scraper_cls()
+                pages = 0
+    finally:
+        if scraper.LOAD_JAVASCRIPT and not scraper.TEST_MODE and pages:
+            scraper.driver.quit()
+
+
+def execute_chunk(
+    scraper_cls: Type[Scraper],
+    chunk: pd.DataFrame,
+    http_cache: Optional[HttpCache] = None,
+) -> List[RowResult]:
+    '''
+    Scrape a chunk of the scraper input with a fresh scraper instance, one url after another.
+
+    A new instance is created for every chunk so that requests sessions and selenium drivers
+    are never shared between workers. This function is sent to worker processes, so it must stay
+    at module level.
+    '''
+    return list(scrape_serially(scraper_cls, urls_and_extras(chunk), http_cache))
+
+
+def execute_chunks(
+    scraper_cls: Type[Scraper],
+    scraper_input: pd.DataFrame,
+    executor: Executor,
+    max_workers: int,
+    chunk_size: Optional[int] = None,
+    http_cache: Optional[HttpCache] = None,
+) -> List[RowResult]:
+    '''
+    Scrape the input in chunks across the workers of an executor.
+
+    Parameters:
+    -----------
+    scraper_cls : `Type[Scraper]`
+        The scraper to run.
+    scraper_input : `pd.DataFrame`
+        The scraper input. It needs to have an `url` column.
+    executor : `concurrent.futures.Executor`
+        The pool that runs the chunks.
+    max_workers : `int`
+        Number of workers of the executor. Used to size chunks when `chunk_size` is not given.
+    chunk_size : `Optional[int]`
+        Number of urls per chunk. Defaults to an even split of the input between workers.
+    http_cache : `Optional[HttpCache]`
+        Cache used to make conditional requests for `LOAD_JAVASCRIPT=False` scrapers.
+
+    Returns:
+    --------
+    rows : `List[Tuple[Optional[pd.DataFrame], Optional[ScraperError]]]`
+        The result of every url, in input order regardless of the order in which the chunks
+        finished.
+    '''
+    if chunk_size is None:
+        chunk_size = max(1, ceil(len(scraper_input) / max_workers))
+    chunks = split_chunks(scraper_input, chunk_size)
+    rows = []
+    for chunk_rows in executor.map(execute_chunk, [scraper_cls] * len(chunks), chunks,
+                                   [http_cache] * len(chunks)):
+        rows.extend(chunk_rows)
+    return rows
+
+
+def execute_async(
+    scraper_cls: Type[Scraper],
+    scraper_input: pd.DataFrame,
+    fetcher: AsyncFetcher,
+    counter: Optional[ErrorCounter] = None,
+) -> List[RowResult]:
+    '''
+    Scrape a `LOAD_JAVASCRIPT=False` scraper fetching its urls with an `AsyncFetcher`.
+
+    Pages are handed to `scrape_handler` as they arrive, while the next ones are still being
+    fetched. Fetching stops early if the errors pass the scraper `ERROR_THRESHOLD`, counting
+    the inputs added before to `counter` if it is given.
+
+    Returns:
+    --------
+    rows : `List[Tuple[Optional[pd.DataFrame], Optional[ScraperError]]]`
+        The result of every url, in input order.
+    '''
+    scraper = scraper_cls()
+    inputs = urls_and_extras(scraper_input)
+    if counter is None:
+        counter = ErrorCounter(scraper_cls, len(inputs))
+    rows = {}
+    errors = 0
+    results = fetcher.fetch([url for url, _ in inputs],
+                            headers=scraper.headers)
+    for result in results:
+        url, extras = inputs[result.position]
+        if result.content is None:
+            rows[result.position] = None, ScraperError(url, 'Html not loaded')
+        else:
+            rows[result.position] = scrape_url(
+                scraper, url, extras, html=result.content)
+        if rows[result.position][1] is not None:
+            errors += 1
+        if counter.exceeded(errors):
+            results.close()
+            raise ThresholdException(scraper.ERROR_THRESHOLD * 100)
+    return [rows[position] for position in range(len(inputs))]
+
+
+def execute_scheduled(
+    scraper_cls: Type[Scraper],
+    scraper_input: pd.DataFrame,
+    limits: HostLimits,
+    max_workers: int,
+    http_cache: Optional[HttpCache] = None,
+    pool: Optional[WebDriverPool] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+    counter: Optional[ErrorCounter] = None,
+) -> List[RowResult]:
+    '''
+    Scrape the input with worker threads that take urls from a `HostScheduler`, so that hosts
+    are interleaved and requested within their limits.
+
+    Every worker scrapes with its own scraper instance, or leases browsers from `pool` if it is
+    given. The latency and outcome of every url are reported to the limits, so that an adaptive
+    controller can set the concurrency of the hosts. Requests that fail with a transient status
+    are retried according to `retry_policy`, while the worker goes on with other urls. Pending
+    urls are dropped if the errors pass the scraper `ERROR_THRESHOLD`, counting the inputs added
+    before to `counter` if it is given.
+
+    Parameters:
+    -----------
+    scraper_cls : `Type[Scraper]`
+        The scraper to run.
+    scraper_input : `pd.DataFrame`
+        The scraper input. It needs to have an `url` column.
+    limits : `HostLimits`
+        Per-host rate and concurrency limits.
+    max_workers : `int`
+        Number of worker threads.
+    http_cache : `Optional[HttpCache]`
+        Cache used to make conditional requests for `LOAD_JAVASCRIPT=False` scrapers.
+    pool : `Optional[WebDriverPool]`
+        Browsers used by `LOAD_JAVASCRIPT=True` scrapers.
+    retry_policy : `Optional[RetryPolicy]`
+        Policy to retry the urls of `LOAD_JAVASCRIPT=False` scrapers.
+    counter : `Optional[ErrorCounter]`
+        Count of the urls and errors of the previous inputs of the scraper.
+
+    Returns:
+    --------
+    rows : `List[Tuple[Optional[pd.DataFrame], Optional[ScraperError]]]`
+        The result of every url, in input order.
+    '''
+    inputs = urls_and_extras(scraper_input)
+    if counter is None:
+        counter = ErrorCounter(scraper_cls, len(inputs))
+    scheduler = HostScheduler(
+        [url for url, _ in inputs], limits, retry_policy)
+    rows: Dict[int, RowResult] = {}
+    lock = threading.Lock()
+    errors = 0
+
+    def work() -> None:
+        nonlocal errors
+        taken = []
+        responses = []
+
+        def scheduled_inputs() -> Iterator[Tuple[str, Dict[str, Any]]]:
+            while True:
+                item = scheduler.take()
+                if item is None:
+                    return
+                taken.append((item, monotonic()))
+                yield inputs[item[0]]
+
+        if pool is None:
+            scraped_rows = scrape_serially(scraper_cls, scheduled_inputs(), http_cache,
+                                           lambda response, *args, **kwargs: responses.append(response))
+        else:
+            scraped_rows = (_scrape_with_pool(pool, url, extras)
+                            for url, extras in scheduled_inputs())
+        try:
+            for row in scraped_rows:
+                # The url stays taken until its slot is released
+                item, started = taken[-1]
+                error = row[1] is not None
+                # Requests tell the status and latency, or have no response if they couldn't connect.
+                # Browsers only tell the scrape result.
+                if pool is None and not scraper_cls.LOAD_JAVASCRIPT:
+                    status, latency = None, monotonic() - started
+                    if responses:
+                        response = responses[-1]
+                        status, latency = response.status_code, response.elapsed.total_seconds()
+                        responses.clear()
+                    retryable = retry_policy is not None and retry_policy.is_retryable(
+                        status, error)
+                    retried = scheduler.release(
+                        item, latency, request_outcome(status, error), retryable)
+                else:
+                    scheduler.release(item, monotonic() - started,
+                                      ERROR if error else OK)
+                    retried = False
+                taken.pop()
+                if retried:
+                    continue
+                with lock:
+                    rows[item[0]] = row
+                    if row[1] is not None:
+                        errors += 1
+                        if counter.exceeded(errors):
+                            scheduler.cancel()
+        except BaseException:
+            # Free the slots of the urls being scraped and stop the other workers, which would
+            # otherwise wait for these slots in `take` forever
+            for item, _ in taken:
+                scheduler.release(item)
+            scheduler.cancel()
+            raise
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(work) for _ in range(max_workers)]:
+            future.result()
+    if len(rows) < len(inputs):
+        raise ThresholdException(scraper_cls.ERROR_THRESHOLD * 100)
+    return [rows[position] for position in range(len(inputs))]
+
+
+def _scrape_with_pool(pool: WebDriverPool, url: str, extras: Dict[str, Any]) -> RowResult:
+    with pool.lease() as scraper:
+        driver = scraper.driver
+        try:
+            driver.get(url)
+        except Exception as e:
+            log.error(
+                '%s. handing loaded content to scrape handler. Url: %s', type(e), url)
+        return scrape_url(scraper, url, extras, driver=driver)
+
+
+def execute_pool(
+    scraper_cls: Type[Scraper],
+    scraper_input: pd.DataFrame,
+    pool: WebDriverPool,
+    counter: Optional[ErrorCounter] = None,
+) -> List[RowResult]:
+    '''
+    Scrape a `LOAD_JAVASCRIPT=True` scraper leasing browsers from a `WebDriverPool`.
+
+    Urls are scraped by one thread per browser of the pool. Pending urls are cancelled if the
+    errors pass the scraper `ERROR_THRESHOLD`, counting the inputs added before to `counter` if
+    it is given.
+
+    Returns:
+    --------
+    rows : `List[Tuple[Optional[pd.DataFrame], Optional[ScraperError]]]`
+        The result of every url, in input order.
+    '''
+    inputs = urls_and_extras(scraper_input)
+    if counter is None:
+        counter = ErrorCounter(scraper_cls, len(inputs))
+    rows = []
+    errors = 0
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        futures = [executor.submit(_scrape_with_pool, pool, url, extras)
+                   for url, extras in inputs]
+        for future in futures:
+            rows.append(future.result())
+            if rows[-1][1] is None:
+                continue
+            errors += 1
+            if counter.exceeded(errors):
+                for pending in futures:
+                    pending.cancel()
+                raise ThresholdException(scraper_cls.ERROR_THRESHOLD * 100)
+    return rows
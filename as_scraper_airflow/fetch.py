@@ -0,0 +1,191 @@
+import asyncio
+from collections import namedtuple
+from concurrent.futures import Future
+import logging
+import threading
+from time import monotonic
+from typing import Any, Dict, Iterable, Iterator, Optional
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+from as_scraper_airflow.http_cache import HttpCache
+from as_scraper_airflow.scheduler import HostLimits, HostScheduler, RetryPolicy, request_outcome
+
+log = logging.getLogger(__name__)
+
+
+FetchResult = namedtuple('FetchResult', 'position url status content error')
+
+_DONE = object()
+
+
+class AsyncFetcher:
+    '''
+    Fetch urls concurrently with asyncio over pooled keep-alive connections.
+
+    Urls are handed to the requests by a `HostScheduler`, which interleaves hosts and keeps
+    every host within its rate and concurrency limits while the requests to other hosts go on.
+
+    The event loop runs in a background thread, so fetched pages can be consumed from a regular
+    iterator while the next requests are still in flight.
+
+    Parameters:
+    -----------
+    max_connections : `Optional[int]`
+        Maximum number of requests in flight. Defaults to 100.
+    max_connections_per_host : `Optional[int]`
+        Maximum number of requests in flight against the same host. Defaults to 10.
+    timeout : `Optional[float]`
+        Total timeout of a request, in seconds. Defaults to 60.
+    http_cache : `Optional[HttpCache]`
+        If given, requests are conditional on the validators stored from previous responses, and
+        the stored body is returned when the server answers `304 Not Modified`.
+    limits : `Optional[HostLimits]`
+        Per-host limits, which can be shared with other fetchers. Defaults to limits of
+        `max_connections_per_host` requests in flight per host, without a rate limit.
+    retry_policy : `Optional[RetryPolicy]`
+        If given, requests that time out or fail with a transient status are retried after a
+        backoff, and only their last attempt is returned.
+    '''
+
+    def __init__(
+        self,
+        max_connections: Optional[int] = 100,
+        max_connections_per_host: Optional[int] = 10,
+        timeout: Optional[float] = 60,
+        http_cache: Optional[HttpCache] = None,
+        limits: Optional[HostLimits] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+    ):
+        if aiohttp is None:
+            raise ImportError(
+                'aiohttp is required for async fetching. Install as-scraper-airflow[async]')
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self.http_cache = http_cache
+        if limits is None:
+            limits = HostLimits(max_per_host=max_connections_per_host)
+        self.limits = limits
+        self.retry_policy = retry_policy
+
+    def fetch(
+        self,
+        urls: Iterable[str],
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Iterator[FetchResult]:
+        '''
+        Fetch urls and yield the results as they complete.
+
+        Parameters:
+        -----------
+        urls : `Iterable[str]`
+            Urls to fetch.
+        headers : `Optional[Dict[str, str]]`
+            Headers sent with every request.
+
+        Returns:
+        --------
+        results : `Iterator[FetchResult]`
+            One result per url, in completion order. `position` is the index of the url in
+            `urls`, and `content` is only set for successful responses.
+        '''
+        started = Future()
+        thread = threading.Thread(target=asyncio.run, args=(
+            self._run(urls, headers, started),), daemon=True)
+        thread.start()
+        loop, results, task = started.result()
+        try:
+            while True:
+                item = asyncio.run_coroutine_threadsafe(
+                    self._next(results), loop).result()
+                if item is _DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            try:
+                loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:
+                # The loop already finished
+                pass
+            thread.join()
+
+    async def _run(self, urls: Iterable[str], headers: Optional[Dict[str, str]], started: Future):
+        results = asyncio.Queue(maxsize=self.max_connections)
+        started.set_result(
+            (asyncio.get_event_loop(), results, asyncio.current_task()))
+        try:
+            await self._fetch_all(urls, headers, results)
+        except asyncio.CancelledError:
+            # The consumer stopped iterating the results
+            return
+        except Exception as e:
+            await results.put(e)
+        await results.put(_DONE)
+        # Keep the loop running until the consumer got every result
+        await results.join()
+
+    @staticmethod
+    async def _next(results: asyncio.Queue) -> Any:
+        item = await results.get()
+        results.task_done()
+        return item
+
+    async def _fetch_all(self, urls: Iterable[str], headers: Optional[Dict[str, str]], results: asyncio.Queue):
+        connector = aiohttp.TCPConnector(
+            limit=self.max_connections, limit_per_host=self.max_connections_per_host)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as session:
+            scheduler = HostScheduler(
+                list(urls), self.limits, self.retry_policy)
+            workers = [asyncio.ensure_future(self._worker(session, scheduler, results))
+                       for _ in range(self.max_connections)]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for worker in workers:
+                    worker.cancel()
+
+    async def _worker(self, session: Any, scheduler: HostScheduler, results: asyncio.Queue):
+        while True:
+            item = await scheduler.take_async()
+            if item is None:
+                return
+            started = monotonic()
+            try:
+                result = await self._fetch_one(session, *item)
+            except BaseException:
+                scheduler.release(item)
+                raise
+            error = result.error is not None
+            retryable = self.retry_policy is not None and self.retry_policy.is_retryable(
+                result.status, error)
+            if scheduler.release(item, monotonic() - started, request_outcome(result.status, error), retryable):
+                continue
+            await results.put(result)
+
+    async def _fetch_one(self, session: Any, position: int, url: str) -> FetchResult:
+        ok_status_code = 200
+        not_modified_status_code = 304
+        headers = None
+        if self.http_cache is not None:
+            headers = self.http_cache.conditional_headers(url)
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status == ok_status_code:
+                    content = await response.read()
+                    if self.http_cache is not None:
+                        self.http_cache.store(url, response.headers, content)
+                    return FetchResult(position, url, response.status, content, None)
+                if response.status == not_modified_status_code and self.http_cache is not None:
+                    content = self.http_cache.body(url)
+                    if content is not None:
+                        return FetchResult(position, url, response.status, content, None)
+                log.error('Failed http get request for url %s', url)
+                return FetchResult(position, url, response.status, None, f'HTTP {response.status}')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.error('%s. Failed http get request for url %s', type(e), url)
+            return FetchResult(position, url, None, None, str(e) or type(e).__name__)
@@ -0,0 +1,98 @@
+import logging
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Mapping, Optional
+
+log = logging.getLogger(__name__)
+
+
+class HttpCache:
+    '''
+    On-disk store of http validators and bodies, used to make conditional requests.
+
+    Responses with an `ETag` or `Last-Modified` header are stored, and the next request to the
+    same url sends `If-None-Match` and `If-Modified-Since`. When the server answers
+    `304 Not Modified`, the stored body is used instead.
+
+    The cache can be pickled to be sent to worker processes. Each process opens its own
+    connection to the database, and `not_modified` only counts the responses of the current
+    process.
+
+    Parameters:
+    -----------
+    directory : `str`
+        Directory of the cache database. It is created if needed.
+    '''
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, 'http.sqlite')
+        self.not_modified = 0
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {'directory': self.directory, 'path': self.path, 'not_modified': 0}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._connection = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False)
+            with self._connection:
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS responses '
+                    '(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, body BLOB)')
+        return self._connection
+
+    def conditional_headers(self, url: str) -> Dict[str, str]:
+        '''
+        Validator headers to send when requesting an url. Empty if the url is not cached.
+        '''
+        with self._lock:
+            row = self.connection.execute(
+                'SELECT etag, last_modified FROM responses WHERE url = ?', (url,)).fetchone()
+        headers = {}
+        if row is not None:
+            etag, last_modified = row
+            if etag is not None:
+                headers['If-None-Match'] = etag
+            if last_modified is not None:
+                headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def body(self, url: str) -> Optional[bytes]:
+        '''
+        Stored body of an url, used when the server answers `304 Not Modified`.
+        '''
+        with self._lock:
+            row = self.connection.execute(
+                'SELECT body FROM responses WHERE url = ?', (url,)).fetchone()
+            if row is not None:
+                self.not_modified += 1
+        return row[0] if row is not None else None
+
+    def store(self, url: str, headers: Mapping[str, str], body: bytes) -> None:
+        '''
+        Store a successful response if it has validators.
+        '''
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            return
+        with self._lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                                    (url, etag, last_modified, body))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -1,3 +1,24 @@
-from .scraper import ScraperOperator
-from .scraper_to_bq import ScraperToBigqueryOperator
-from .scraper_to_logs import ScraperToLogsOperator
+from importlib import import_module
+from typing import Any, List
+
+# Operators are imported on first access, so that importing one of them does not load the
+# dependencies of the others
+_operators = {
+    'ScraperOperator': 'scraper',
+    'ScraperToBigqueryOperator': 'scraper_to_bq',
+    'ScraperToLogsOperator': 'scraper_to_logs',
+}
+
+__all__ = list(_operators)
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _operators:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(import_module(f'{__name__}.{_operators[name]}'), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(__all__))
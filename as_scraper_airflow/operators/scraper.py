@@ -1,11 +1,28 @@
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, closing, contextmanager
+from datetime import timedelta
+from itertools import chain
 import logging
-from typing import Any, List, Optional, Type, Union
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator, List, Optional, Tuple, Type, Union
+from urllib.parse import quote
 from airflow.models.baseoperator import BaseOperator
 from airflow.exceptions import AirflowException
-import pandas as pd
-from as_scraper.crawlers.crawler import Crawler
-from as_scraper.errors import ScraperError
-from as_scraper.scraper import Scraper
+from as_scraper_airflow.http_cache import HttpCache
+from as_scraper_airflow.scheduler import AdaptiveConcurrency, HostLimits, RetryPolicy
+from as_scraper_airflow.urls import UrlNormalizer
+if TYPE_CHECKING:
+    # pandas, as_scraper and the execution modules are imported when the operator runs, so
+    # that parsing a DAG file only pays for the operator classes
+    import pandas as pd
+    from as_scraper.crawlers.crawler import Crawler
+    from as_scraper.errors import ScraperError
+    from as_scraper.scraper import Scraper
+    from as_scraper_airflow.cache import ResultCache
+    from as_scraper_airflow.checkpoint import CheckpointStore
+    from as_scraper_airflow.dedup import FingerprintIndex
+    from as_scraper_airflow.execution import ErrorCounter, RowResult
+    from as_scraper_airflow.pipeline import Stage
 
 log = logging.getLogger(__name__)
 
@@ -22,20 +39,136 @@ class ScraperOperator(BaseOperator):
         List of urls to scrap.
     crawler_cls : `Optional[Type[Crawler]]`
         The crawler to run. It is an alternative to the `urls` parameter. A crawler generates
-        the urls that will be scraped in the execution.
+        the urls that will be scraped in the execution. The crawl is consumed lazily in batches
+        of `pipeline_batch_size` urls, so crawlers that yield their urls get them scraped while
+        they are still crawling. Since the number of urls is unknown until the crawl is done,
+        the scrapers `ERROR_THRESHOLD` is checked at the end of the run.
     save_errors : `Optional[bool]`
         Wether to store scraping errors or not. Defaults to `False`
     drop_duplicates : `Optional[List[str]]`
         A list of columns of the resulting pandas dataframe of the scraping. If given, results
-        will drop duplicate values based on the columns specified in this parameter.
+        will drop duplicate values based on the columns specified in this parameter. Rows are
+        compared by a hash of these columns, so that memory stays bounded on large outputs.
     local_tz : `Optional[Any]`
         Pendulum timezone object. Used to assign timezone to output datetime.
     fail_if_empty_results : `Optional[bool]`
         If true, throw an error if the execution returns no results. Defaults to True.
+    max_workers : `Optional[int]`
+        Number of workers used to scrape urls concurrently. The input is split in chunks that
+        are scraped by independent scraper instances. If not given, urls are scraped serially
+        with `thread` workers, and the task cpu quota is used with `process` workers. When urls
+        are scheduled by host, like with `requests_per_host`, it defaults to `max_connections`
+        workers for scrapers with `LOAD_JAVASCRIPT=False`, and to one for the others, which
+        start a browser per worker.
+    chunk_size : `Optional[int]`
+        Number of urls per chunk when running with workers. Defaults to an even split of the
+        input between workers.
+    worker_executor : `Optional[str]`
+        Either `thread` or `process`. Use `process` for scrapers whose `scrape_handler` is cpu
+        bound. Scraper classes must be importable from the worker processes. Defaults to `thread`.
+        It is not named `executor`, which selects the Airflow executor of the task.
+    async_fetch : `Optional[bool]`
+        If true, scrapers with `LOAD_JAVASCRIPT=False` fetch their urls with asyncio, keeping
+        up to `max_connections` requests in flight. Requires the `async` extra. Defaults to False.
+    max_connections : `Optional[int]`
+        Maximum number of requests in flight when `async_fetch` is true, and default number of
+        workers when urls are scheduled by host. Defaults to 100.
+    max_connections_per_host : `Optional[int]`
+        Maximum number of requests in flight against a single host when `async_fetch` is true
+        or `requests_per_host` is given. Defaults to 10.
+    requests_per_host : `Optional[float]`
+        If given, urls are handed to the workers interleaving their hosts, and every host gets
+        at most this many requests per second and `max_connections_per_host` requests in flight,
+        while the workers go on with the urls of other hosts. The limits are shared by all the
+        scrapers of the task. Not available with `process` workers.
+    host_burst : `Optional[int]`
+        Number of requests that can be made at once against a host that was idle, when
+        `requests_per_host` is given. Defaults to 1.
+    concurrency_controller : `Optional[AdaptiveConcurrency]`
+        If given, the number of requests in flight against every host is adapted to its latency
+        and errors instead of being fixed to `max_connections_per_host`, within the global
+        `max_connections` or `max_workers`. Urls are scheduled like with `requests_per_host`,
+        and every concurrency change is logged.
+    retry_policy : `Optional[RetryPolicy]`
+        If given, urls of `LOAD_JAVASCRIPT=False` scrapers that time out, can't connect or get a
+        transient http status are retried after an exponential backoff with jitter, while the
+        other urls go on. Only urls that run out of attempts are reported as errors. Urls are
+        scheduled like with `requests_per_host`. Not available with `process` workers.
+    webdriver_pool_size : `Optional[int]`
+        If given, scrapers with `LOAD_JAVASCRIPT=True` reuse a pool of this many long-lived
+        browsers, which are reset between urls instead of being started per chunk. If not
+        given, scrapers whose input comes in batches, like with `pipeline_batch_size`,
+        `crawler_cls` or `checkpoint_dir`, reuse a pool of `max_workers` browsers, or of one
+        browser, across the batches of the run with `thread` workers.
+    webdriver_max_pages : `Optional[int]`
+        Number of pages after which a pooled browser is restarted. Defaults to the scraper
+        `RESET_AFTER` variable.
+    pipeline_batch_size : `Optional[int]`
+        If given, chained scrapers run concurrently: the output of a scraper is handed to the
+        next one in batches of this many rows while the former is still running. If not given,
+        each scraper waits for the previous one to finish, unless there is a `crawler_cls` or
+        results are flushed, in which case batches of `default_batch_size` rows, or of
+        `flush_every_rows` if fewer, are used.
+    pipeline_queue_size : `Optional[int]`
+        Number of batches that can wait between two pipelined scrapers before the upstream
+        scraper is paused. Defaults to 4.
+    flush_every_rows : `Optional[int]`
+        If given, results are stored in chunks as soon as this many rows are ready, instead of
+        all at once at the end of the run. Urls are then scraped in batches like with
+        `pipeline_batch_size`, so that results are ready before the run ends. Chunks can't be
+        smaller than the output of a batch.
+    flush_every_seconds : `Optional[float]`
+        If given, ready results are stored when this many seconds passed since the last chunk
+        was stored. Urls are then scraped in batches like with `flush_every_rows`.
+    checkpoint_dir : `Optional[str]`
+        If given, scraped urls are recorded with their results in a SQLite checkpoint under this
+        directory, keyed by dag id, task id and run id. A retry of the task replays the recorded
+        results and only scrapes the remaining urls. Input urls are processed in batches, of
+        `pipeline_batch_size` urls if given, each one going through every scraper before it is
+        recorded. The directory must be reachable from the worker running the retry. Chunks of
+        results flushed before the failure are stored again by the retry, so destinations that
+        results are appended to must only make them visible once the run succeeds.
+    cache_dir : `Optional[str]`
+        If given, results are cached per scraper class and url in this directory and shared
+        between DAG runs. Cached urls are neither fetched nor scraped. Scrapers can define a
+        `VERSION` class variable to invalidate the results cached by previous versions.
+    cache_ttl : `Optional[timedelta]`
+        Time to live of the cached results. Defaults to 1 day.
+    cache_max_size : `Optional[int]`
+        Maximum size of the cache in bytes. Least recently used results are evicted past it.
+        Defaults to 1GiB.
+    http_cache_dir : `Optional[str]`
+        If given, scrapers with `LOAD_JAVASCRIPT=False` store the `ETag` and `Last-Modified`
+        validators and bodies of their responses in this directory, and make conditional
+        requests on the next runs. Cached bodies are scraped again when the server answers
+        `304 Not Modified`.
+    url_normalizer : `Optional[UrlNormalizer]`
+        If given, input urls are canonicalized with it and duplicates are skipped before the
+        first scraper runs.
+    dedup_hash_bits : `Optional[int]`
+        Width of the row hashes used by `drop_duplicates`, either 64 or 128. Use 128 bits to
+        make hash collisions negligible on outputs of billions of rows. Defaults to 64.
+    dedup_max_memory : `Optional[int]`
+        Bytes of row hashes kept in memory by `drop_duplicates` before spilling them to disk.
+        Defaults to 64MiB.
+    dedup_spill_dir : `Optional[str]`
+        Directory for the row hashes spilled by `drop_duplicates`. Defaults to a temporary
+        directory.
+    fingerprint_index : `Optional[str]`
+        Path of a file indexing the rows stored by previous runs, by the hash of their
+        `drop_duplicates` columns. Rows already in the index are skipped, which is meant for
+        destinations that results are appended to. The stored rows are added to the index once
+        the run succeeds. If the file is missing it is rebuilt from `read_destination`.
+        Operators that replace the destination on every run reject it.
+    rebuild_fingerprint_index : `Optional[bool]`
+        Rebuild the `fingerprint_index` from `read_destination` before the run, like after the
+        destination was edited by other means. Defaults to False.
     '''
 
     ui_color: str = '#eb9319'
     ui_fgcolor: str = '#5c4b1f'
+    executors = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}
+    default_batch_size: int = 100
 
     def __init__(
         self,
@@ -46,6 +179,33 @@ class ScraperOperator(BaseOperator):
         drop_duplicates: Optional[List[str]] = None,
         local_tz: Optional[Any] = None,
         fail_if_empty_results: Optional[bool] = True,
+        max_workers: Optional[int] = None,
+        chunk_size: Optional[int] = None,
+        worker_executor: Optional[str] = 'thread',
+        async_fetch: Optional[bool] = False,
+        max_connections: Optional[int] = 100,
+        max_connections_per_host: Optional[int] = 10,
+        requests_per_host: Optional[float] = None,
+        host_burst: Optional[int] = 1,
+        concurrency_controller: Optional[AdaptiveConcurrency] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        webdriver_pool_size: Optional[int] = None,
+        webdriver_max_pages: Optional[int] = None,
+        pipeline_batch_size: Optional[int] = None,
+        pipeline_queue_size: Optional[int] = 4,
+        flush_every_rows: Optional[int] = None,
+        flush_every_seconds: Optional[float] = None,
+        checkpoint_dir: Optional[str] = None,
+        cache_dir: Optional[str] = None,
+        cache_ttl: Optional[timedelta] = timedelta(days=1),
+        cache_max_size: Optional[int] = 2 ** 30,
+        http_cache_dir: Optional[str] = None,
+        url_normalizer: Optional[UrlNormalizer] = None,
+        dedup_hash_bits: Optional[int] = 64,
+        dedup_max_memory: Optional[int] = 64 * 2 ** 20,
+        dedup_spill_dir: Optional[str] = None,
+        fingerprint_index: Optional[str] = None,
+        rebuild_fingerprint_index: Optional[bool] = False,
         *args,
         **kwargs,
     ):
@@ -57,52 +217,523 @@ class ScraperOperator(BaseOperator):
         self.drop_duplicates = drop_duplicates
         self.local_tz = local_tz
         self.fail_if_empty_results = fail_if_empty_results
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        if worker_executor not in self.executors:
+            raise AirflowException(
+                f'worker_executor must be one of {list(self.executors)}, got {worker_executor}')
+        self.worker_executor = worker_executor
+        self.async_fetch = async_fetch
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.requests_per_host = requests_per_host
+        self.host_burst = host_burst
+        self.concurrency_controller = concurrency_controller
+        self.retry_policy = retry_policy
+        self.webdriver_pool_size = webdriver_pool_size
+        self.webdriver_max_pages = webdriver_max_pages
+        self.pipeline_batch_size = pipeline_batch_size
+        self.pipeline_queue_size = pipeline_queue_size
+        self.flush_every_rows = flush_every_rows
+        self.flush_every_seconds = flush_every_seconds
+        self.checkpoint_dir = checkpoint_dir
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self.cache_max_size = cache_max_size
+        self.http_cache_dir = http_cache_dir
+        self.url_normalizer = url_normalizer
+        self.dedup_hash_bits = dedup_hash_bits
+        self.dedup_max_memory = dedup_max_memory
+        self.dedup_spill_dir = dedup_spill_dir
+        if fingerprint_index is not None and drop_duplicates is None:
+            raise AirflowException(
+                'fingerprint_index requires drop_duplicates columns')
+        self.fingerprint_index = fingerprint_index
+        self.rebuild_fingerprint_index = rebuild_fingerprint_index
+        self._index: Optional[FingerprintIndex] = None
+        self._checkpoint: Optional[CheckpointStore] = None
 
     def execute(self, context: Any):
+        import pandas as pd
+        from as_scraper_airflow.buffer import ResultBuffer
+        from as_scraper_airflow.dedup import HashDeduplicator
         self.test_storage_connection()
-        scraper_input = pd.DataFrame(columns=['url'])
-        if self.crawler_cls is not None:
-            crawler = self.crawler_cls()
-            crawled_urls = [{'url': url} for url in crawler.crawl()]
-            scraper_input = pd.concat(
-                scraper_input, pd.DataFrame(crawled_urls))
-        if self.urls is not None:
-            input_urls = [{'url': url} for url in self.urls]
-            inputs = scraper_input, pd.DataFrame(input_urls)
-            scraper_input = pd.concat(inputs, ignore_index=True)
         if not isinstance(self.scraper_cls, list):
             self.scraper_cls = [self.scraper_cls]
-        # Algorithm to run multiple scraper classes one after each other.
-        # The last scraper will have the target data for this operator.
+        scraped_date = self.scraped_date(context)
+        self.flushed_chunks = 0
+        self.host_limits = HostLimits(self.requests_per_host, self.host_burst,
+                                      self.max_connections_per_host, self.concurrency_controller)
+        results = ResultBuffer(self.flush_results,
+                               self.flush_every_rows, self.flush_every_seconds)
         errors = []
-        scraper_output = None
-        for scraper_cls in self.scraper_cls:
-            scraper = scraper_cls()
-            scraper_output, _errors = scraper.execute(scraper_input)
-            errors.extend(_errors)
-            scraper_input = scraper_output
+        self._checkpoint = None
+        if self.checkpoint_dir is not None:
+            self._checkpoint = self.open_checkpoint(context)
+            outputs = self.run_checkpointed(
+                self.input_urls(), errors, self._checkpoint)
+        elif (self.pipeline_batch_size is not None or self.crawler_cls is not None
+              or self.flush_every_rows is not None or self.flush_every_seconds is not None):
+            outputs = self.run_pipeline(self.input_urls(), errors)
+        else:
+            scraper_input = pd.DataFrame({'url': list(self.input_urls())})
+            outputs = self.run_sequential(scraper_input, errors)
+        deduplicator = None
         if self.drop_duplicates is not None:
-            filtered_scraper_output = scraper_output.drop_duplicates(
-                subset=self.drop_duplicates)
-            dropped = len(scraper_output) - len(filtered_scraper_output)
-            log.warning('Dropped %d rows due to duplicate detection', dropped)
-            scraper_output = filtered_scraper_output
-        start_date = context['dag_run'].start_date
-        if self.local_tz:
-            start_date = start_date.astimezone(tz=self.local_tz)
-        start_date = start_date.isoformat()
-        execution_df = scraper_output.assign(scraped_date=start_date)
+            deduplicator = HashDeduplicator(self.drop_duplicates, self.dedup_hash_bits,
+                                            self.dedup_max_memory, self.dedup_spill_dir)
+        index = self._index = None
+        if self.fingerprint_index is not None:
+            index = self._index = self.open_fingerprint_index()
+        # Closing the outputs early, like when storing results fails, stops the scrapers and
+        # releases their workers and browsers
+        with closing(outputs):
+            for scraper_output in outputs:
+                if deduplicator is not None:
+                    scraper_output = deduplicator.filter(scraper_output)
+                if index is not None:
+                    scraper_output = index.filter(scraper_output)
+                results.add(scraper_output.assign(scraped_date=scraped_date))
+        if deduplicator is not None:
+            log.warning('Dropped %d rows due to duplicate detection',
+                        deduplicator.dropped)
+            deduplicator.close()
         if self.save_errors and len(errors):
             self.store_errors(errors, context)
-        if len(execution_df):
-            self.store_results(execution_df)
-        elif self.fail_if_empty_results:
+        results.close()
+        self.commit_results()
+        if index is not None:
+            log.info('Skipped %d rows stored by previous runs', index.skipped)
+        if not self.defers_commit():
+            self.complete_run(context)
+        else:
+            # The run is completed by the method the task resumes with, maybe in another process
+            if index is not None:
+                index.stage(self.staged_fingerprints_path(context))
+            if self._checkpoint is not None:
+                self._checkpoint.close()
+        if not results.rows_flushed and self.fail_if_empty_results:
             raise AirflowException('No results from scraper run')
 
+    def flush_results(self, df: pd.DataFrame) -> None:
+        '''
+        Store a chunk of results and count it in `flushed_chunks`.
+        '''
+        self.store_results(df)
+        self.flushed_chunks += 1
+
+    def scraped_date(self, context: Any) -> str:
+        '''
+        Value of the `scraped_date` column of the results: the start date of the run in ISO
+        format, in `local_tz` if given.
+        '''
+        start_date = context['dag_run'].start_date
+        if self.local_tz:
+            start_date = start_date.astimezone(tz=self.local_tz)
+        return start_date.isoformat()
+
+    def open_checkpoint(self, context: Any) -> CheckpointStore:
+        '''
+        Open the checkpoint of the task run in `checkpoint_dir`.
+        '''
+        from as_scraper_airflow.checkpoint import CheckpointStore
+        ti = context['ti']
+        return CheckpointStore.for_task(self.checkpoint_dir, ti.dag_id, ti.task_id,
+                                        ti.run_id, getattr(ti, 'map_index', -1))
+
+    def open_fingerprint_index(self) -> FingerprintIndex:
+        '''
+        Open the `fingerprint_index`, rebuilding it from the destination if it is missing or a
+        rebuild was requested.
+        '''
+        from as_scraper_airflow.dedup import FingerprintIndex
+        index = FingerprintIndex(self.fingerprint_index,
+                                 self.drop_duplicates, self.dedup_hash_bits)
+        if index.exists and not self.rebuild_fingerprint_index:
+            return index
+        log.info('Rebuilding fingerprint index %s from the destination',
+                 self.fingerprint_index)
+        try:
+            index.rebuild(self.read_destination(self.drop_duplicates))
+        except NotImplementedError:
+            log.warning('%s can not read its destination, starting an empty index',
+                        type(self).__name__)
+        return index
+
+    def input_urls(self) -> Iterator[str]:
+        '''
+        Urls to scrape: the crawled urls, consumed lazily, followed by the `urls` parameter.
+        They are normalized and de-duplicated if there is an `url_normalizer`.
+        '''
+        crawled_urls = []
+        if self.crawler_cls is not None:
+            crawler = self.crawler_cls()
+            crawled_urls = crawler.crawl()
+        urls = chain(crawled_urls, self.urls or [])
+        if self.url_normalizer is not None:
+            return self.url_normalizer.unique(urls)
+        return urls
+
+    def run_sequential(self, scraper_input: pd.DataFrame, errors: List[ScraperError]) -> Iterator[pd.DataFrame]:
+        '''
+        Run the scraper classes one after each other. The last scraper will have the target data
+        for this operator.
+
+        Parameters:
+        -----------
+        scraper_input : `pd.DataFrame`
+            Input of the first scraper, having an `url` column.
+        errors : `List[ScraperError]`
+            List extended with the errors of every scraper.
+
+        Returns:
+        --------
+        outputs : `Iterator[pd.DataFrame]`
+            The results of the last scraper.
+        '''
+        scraper_output = None
+        for scraper_cls in self.scraper_cls:
+            with self.scraper_runner(scraper_cls) as run:
+                scraper_output, _errors = run(scraper_input)
+            errors.extend(_errors)
+            scraper_input = scraper_output
+        yield scraper_output
+
+    def run_pipeline(self, urls: Iterable[str], errors: List[ScraperError]) -> Iterator[pd.DataFrame]:
+        '''
+        Run the scraper classes concurrently, streaming batches of `batch_size` rows
+        from each scraper to the next one. Urls are consumed lazily, while the first batches are
+        already being scraped.
+
+        Parameters:
+        -----------
+        urls : `Iterable[str]`
+            Urls for the first scraper.
+        errors : `List[ScraperError]`
+            List extended with the errors of every scraper once the pipeline is done.
+
+        Returns:
+        --------
+        outputs : `Iterator[pd.DataFrame]`
+            Batches of results of the last scraper, as they are produced.
+        '''
+        from as_scraper_airflow.execution import url_batches
+        from as_scraper_airflow.pipeline import ScraperPipeline
+        batch_size = self.batch_size()
+        if self.crawler_cls is None:
+            urls = list(urls)
+        counters = self.error_counters(urls)
+        with ExitStack() as stack:
+            stages = [stack.enter_context(self.scraper_runner(scraper_cls, counter))
+                      for scraper_cls, counter in zip(self.scraper_cls, counters)]
+            pipeline = ScraperPipeline(
+                stages, batch_size, self.pipeline_queue_size)
+            yield from pipeline.run(url_batches(urls, batch_size))
+        errors.extend(pipeline.errors)
+
+    def run_checkpointed(
+        self,
+        urls: Iterable[str],
+        errors: List[ScraperError],
+        checkpoint: CheckpointStore,
+    ) -> Iterator[pd.DataFrame]:
+        '''
+        Replay the results recorded in the checkpoint, then scrape the urls that are not in it.
+        Every batch of urls goes through all the scraper classes and is recorded before its
+        results are returned.
+
+        Parameters:
+        -----------
+        urls : `Iterable[str]`
+            Urls for the first scraper.
+        errors : `List[ScraperError]`
+            List extended with the recorded errors and the errors of every scraper.
+        checkpoint : `CheckpointStore`
+            The checkpoint of the task run.
+
+        Returns:
+        --------
+        outputs : `Iterator[pd.DataFrame]`
+            Batches of results of the last scraper.
+        '''
+        from as_scraper_airflow.execution import url_batches
+        from as_scraper_airflow.pipeline import ScraperPipeline
+        completed_urls = checkpoint.completed_urls()
+        if completed_urls:
+            log.info('Resuming from checkpoint, skipping %d scraped urls',
+                     len(completed_urls))
+        for scraper_output, _errors in checkpoint.completed_batches():
+            errors.extend(_errors)
+            yield scraper_output
+        pending_urls = (url for url in urls if url not in completed_urls)
+        if self.crawler_cls is None:
+            pending_urls = list(pending_urls)
+        counters = self.error_counters(pending_urls)
+        batch_size = self.batch_size()
+        with ExitStack() as stack:
+            runs = [stack.enter_context(self.scraper_runner(scraper_cls, counter))
+                    for scraper_cls, counter in zip(self.scraper_cls, counters)]
+
+            def run_batch(scraper_input: pd.DataFrame) -> Tuple[pd.DataFrame, List[ScraperError]]:
+                batch_urls = list(scraper_input.url)
+                batch_errors = []
+                for run in runs:
+                    scraper_input, _errors = run(scraper_input)
+                    batch_errors.extend(_errors)
+                checkpoint.save_batch(batch_urls, scraper_input, batch_errors)
+                return scraper_input, batch_errors
+
+            pipeline = ScraperPipeline(
+                [run_batch], batch_size, self.pipeline_queue_size)
+            yield from pipeline.run(url_batches(pending_urls, batch_size))
+        errors.extend(pipeline.errors)
+
+    def batch_size(self) -> int:
+        '''
+        Number of urls per batch when they are scraped in batches: `pipeline_batch_size`, or
+        `default_batch_size` capped to `flush_every_rows`, so that flushes are not delayed to
+        the end of bigger batches.
+        '''
+        if self.pipeline_batch_size is not None:
+            return self.pipeline_batch_size
+        if self.flush_every_rows is not None:
+            return max(1, min(self.default_batch_size, self.flush_every_rows))
+        return self.default_batch_size
+
+    def error_counters(self, urls: Iterable[str]) -> List[ErrorCounter]:
+        '''
+        Counters applying the `ERROR_THRESHOLD` of every scraper to all the batches of a run.
+        The number of urls is only known for the first scraper, and only if `urls` is a list
+        rather than a crawl.
+        '''
+        from as_scraper_airflow.execution import ErrorCounter
+        total = len(urls) if isinstance(urls, list) else None
+        return [ErrorCounter(scraper_cls, total if position == 0 else None)
+                for position, scraper_cls in enumerate(self.scraper_cls)]
+
+    @contextmanager
+    def scraper_runner(self, scraper_cls: Type[Scraper], counter: Optional[ErrorCounter] = None) -> Iterator[Stage]:
+        '''
+        Prepare the resources to run a scraper, like worker pools or browsers, and release them
+        when the scraper is done. Scrapers that don't need any feature handled url by url run
+        with their own `execute` method.
+
+        Parameters:
+        -----------
+        scraper_cls : `Type[Scraper]`
+            The scraper to run.
+        counter : `Optional[ErrorCounter]`
+            Given when the input comes in batches, so that the scraper `ERROR_THRESHOLD`
+            applies to the urls and errors of all the batches. It is checked once more when the
+            scraper is done, in case the number of urls was unknown. Otherwise the threshold
+            applies to every input.
+
+        Returns:
+        --------
+        run : `Callable[[pd.DataFrame], Tuple[pd.DataFrame, List[ScraperError]]]`
+            A function that scrapes an input dataframe, having an `url` column, and returns the
+            scraper results and the errors captured in the process. It can be called many times.
+        '''
+        with self.scraper_stage(scraper_cls, counter) as run:
+            yield run
+        if counter is not None:
+            counter.check()
+
+    @contextmanager
+    def scraper_stage(self, scraper_cls: Type[Scraper], counter: Optional[ErrorCounter] = None) -> Iterator[Stage]:
+        '''
+        Choose how a scraper runs, with its own `execute` method or url by url. See
+        `scraper_runner`.
+        '''
+        from as_scraper_airflow.cache import ResultCache
+        from as_scraper_airflow.execution import execute_scraper, merge_rows
+        if not self.scrapes_by_url(scraper_cls, counter is not None):
+            scraper = scraper_cls()
+            yield lambda df: execute_scraper(scraper, df, counter)
+            return
+        with self.rows_runner(scraper_cls, counter) as run_rows:
+            if self.cache_dir is None:
+                yield lambda df: merge_rows(scraper_cls, run_rows(df), counter)
+                return
+            cache = ResultCache(self.cache_dir, self.cache_ttl,
+                                self.cache_max_size)
+            try:
+                yield lambda df: merge_rows(scraper_cls, self.run_cached(scraper_cls, df, run_rows, cache),
+                                            counter)
+            finally:
+                log.info('Result cache for %s: %d hits, %d misses',
+                         scraper_cls.__name__, cache.hits, cache.misses)
+                cache.close()
+
+    def scrapes_by_url(self, scraper_cls: Type[Scraper], batched: Optional[bool] = False) -> bool:
+        '''
+        Whether a scraper runs with the execution strategies of this package, which handle every
+        url apart, to cache its results, share limits and browsers, or spread urls across
+        workers. Otherwise the scraper runs with its own `execute` method.
+        '''
+        if self.cache_dir is not None:
+            return True
+        if self.browsers(scraper_cls, batched) is not None:
+            return True
+        if not scraper_cls.LOAD_JAVASCRIPT and (self.async_fetch or self.http_cache_dir is not None):
+            return True
+        if (self.requests_per_host is not None or self.concurrency_controller is not None
+                or self.retry_policy is not None):
+            return True
+        if self.worker_executor == 'process':
+            return True
+        return self.max_workers is not None and self.max_workers > 1
+
+    def browsers(self, scraper_cls: Type[Scraper], batched: Optional[bool] = False) -> Optional[int]:
+        '''
+        Size of the `WebDriverPool` of a scraper, or None if it doesn't use one. Scrapers with
+        `LOAD_JAVASCRIPT=True` use one with `webdriver_pool_size`, and when their input comes in
+        batches, so that the batches share their browsers instead of starting new ones.
+        '''
+        if not scraper_cls.LOAD_JAVASCRIPT:
+            return None
+        if self.webdriver_pool_size is not None:
+            return self.webdriver_pool_size
+        if batched and self.worker_executor == 'thread':
+            return self.max_workers or 1
+        return None
+
+    def run_cached(
+        self,
+        scraper_cls: Type[Scraper],
+        scraper_input: pd.DataFrame,
+        run_rows: Callable[[pd.DataFrame], List[RowResult]],
+        cache: ResultCache,
+    ) -> List[RowResult]:
+        '''
+        Scrape only the urls whose results are not cached, and cache their results.
+        '''
+        from as_scraper_airflow.execution import urls_and_extras
+        inputs = urls_and_extras(scraper_input)
+        keys = [cache.key(scraper_cls, url, extras) for url, extras in inputs]
+        rows = [(cache.get(key), None) for key in keys]
+        missing = [position for position, (df, _) in enumerate(rows)
+                   if df is None]
+        if not missing:
+            return rows
+        missing_rows = run_rows(
+            scraper_input.iloc[missing].reset_index(drop=True))
+        for position, row in zip(missing, missing_rows):
+            rows[position] = row
+            df, error = row
+            if error is None:
+                cache.put(keys[position], df)
+        return rows
+
+    @contextmanager
+    def rows_runner(
+        self,
+        scraper_cls: Type[Scraper],
+        counter: Optional[ErrorCounter] = None,
+    ) -> Iterator[Callable[[pd.DataFrame], List[RowResult]]]:
+        '''
+        Prepare the resources to run a scraper, like worker pools or browsers, and release them
+        when the scraper is done.
+
+        Parameters:
+        -----------
+        scraper_cls : `Type[Scraper]`
+            The scraper to run.
+        counter : `Optional[ErrorCounter]`
+            Count of the urls and errors of the previous inputs, used by the strategies that stop
+            scraping an input once the errors pass the scraper `ERROR_THRESHOLD`.
+
+        Returns:
+        --------
+        run_rows : `Callable[[pd.DataFrame], List[Tuple[Optional[pd.DataFrame], Optional[ScraperError]]]]`
+            A function that scrapes an input dataframe, having an `url` column, and returns the
+            result of every url in input order. It can be called many times.
+        '''
+        http_cache = None
+        if self.http_cache_dir is not None and not scraper_cls.LOAD_JAVASCRIPT:
+            http_cache = HttpCache(self.http_cache_dir)
+        try:
+            with self.scrape_rows_runner(scraper_cls, http_cache, counter) as run_rows:
+                yield run_rows
+        finally:
+            if http_cache is not None:
+                log.info('%d urls of %s were not modified',
+                         http_cache.not_modified, scraper_cls.__name__)
+                http_cache.close()
+
+    @contextmanager
+    def scrape_rows_runner(
+        self,
+        scraper_cls: Type[Scraper],
+        http_cache: Optional[HttpCache] = None,
+        counter: Optional[ErrorCounter] = None,
+    ) -> Iterator[Callable[[pd.DataFrame], List[RowResult]]]:
+        '''
+        Choose the execution strategy of a scraper. See `rows_runner`.
+        '''
+        from as_scraper_airflow.execution import (available_cpus, execute_async, execute_chunk,
+                                                  execute_chunks, execute_pool, execute_scheduled)
+        from as_scraper_airflow.fetch import AsyncFetcher
+        from as_scraper_airflow.webdriver_pool import WebDriverPool
+        if self.async_fetch:
+            if not scraper_cls.LOAD_JAVASCRIPT:
+                log.info('Fetching urls for %s with up to %d connections',
+                         scraper_cls.__name__, self.max_connections)
+                fetcher = AsyncFetcher(self.max_connections, self.max_connections_per_host,
+                                       http_cache=http_cache, limits=self.host_limits,
+                                       retry_policy=self.retry_policy)
+                yield lambda df: execute_async(scraper_cls, df, fetcher, counter)
+                return
+            log.warning('%s loads javascript, async fetch is not available',
+                        scraper_cls.__name__)
+        scheduled = (self.requests_per_host is not None or self.concurrency_controller is not None
+                     or self.retry_policy is not None)
+        # The counter is given when the input comes in batches
+        pool_size = self.browsers(scraper_cls, counter is not None)
+        if pool_size is not None:
+            log.info('Scraping %s with a pool of %d browsers',
+                     scraper_cls.__name__, pool_size)
+            with WebDriverPool(scraper_cls, pool_size, self.webdriver_max_pages) as pool:
+                if scheduled:
+                    yield lambda df: execute_scheduled(scraper_cls, df, self.host_limits, pool.size,
+                                                       pool=pool, counter=counter)
+                else:
+                    yield lambda df: execute_pool(scraper_cls, df, pool, counter)
+            return
+        if scheduled:
+            if self.worker_executor == 'thread':
+                max_workers = self.max_workers
+                if max_workers is None:
+                    # Workers wait for the limits of their hosts, so it takes many of them to
+                    # keep several hosts busy
+                    max_workers = 1 if scraper_cls.LOAD_JAVASCRIPT else self.max_connections
+                log.info('Scraping %s with %d scheduled workers',
+                         scraper_cls.__name__, max_workers)
+                yield lambda df: execute_scheduled(scraper_cls, df, self.host_limits, max_workers,
+                                                   http_cache, retry_policy=self.retry_policy,
+                                                   counter=counter)
+                return
+            log.warning('Per-host limits and retries are not available with '
+                        'process workers')
+        max_workers = self.max_workers
+        if max_workers is None and self.worker_executor == 'process':
+            max_workers = available_cpus()
+        if max_workers is None or (max_workers <= 1 and self.worker_executor == 'thread'):
+            yield lambda df: execute_chunk(scraper_cls, df, http_cache)
+            return
+        log.info('Scraping %s with %d %s workers',
+                 scraper_cls.__name__, max_workers, self.worker_executor)
+        with self.executors[self.worker_executor](max_workers=max_workers) as executor:
+            yield lambda df: execute_chunks(scraper_cls, df, executor, max_workers,
+                                            self.chunk_size, http_cache)
+
     def store_results(self, df: pd.DataFrame) -> None:
         '''
         Store results for the scraper run.
 
+        When results are flushed incrementally this method is called once per chunk, and
+        `self.flushed_chunks` holds the number of chunks already stored in this run.
+
         Parameters:
         -----------
         df : `pd.DataFrame`
@@ -110,6 +741,65 @@ class ScraperOperator(BaseOperator):
         '''
         raise NotImplementedError('Implement store_results')
 
+    def commit_results(self) -> None:
+        '''
+        Make the results of the run visible once all of them are stored, for destinations that
+        stage the chunks given to `store_results`. Does nothing by default.
+        '''
+
+    def defers_commit(self) -> bool:
+        '''
+        Whether the results are only committed after the task is deferred, in which case the
+        method it resumes with must call `complete_run`. False by default.
+        '''
+        return False
+
+    def complete_run(self, context: Any) -> None:
+        '''
+        Add the stored rows to the `fingerprint_index` and clear the checkpoint, once the results
+        of the run are committed.
+        '''
+        from as_scraper_airflow.dedup import FingerprintIndex
+        if self.fingerprint_index is not None:
+            index = self._index
+            if index is None:
+                index = FingerprintIndex(self.fingerprint_index,
+                                         self.drop_duplicates, self.dedup_hash_bits)
+            index.commit(self.staged_fingerprints_path(context))
+        if self.checkpoint_dir is not None:
+            checkpoint = self._checkpoint
+            if checkpoint is None:
+                checkpoint = self.open_checkpoint(context)
+            checkpoint.clear()
+
+    def staged_fingerprints_path(self, context: Any) -> str:
+        '''
+        File holding the row hashes of a deferred run until they are added to the
+        `fingerprint_index`.
+        '''
+        ti = context['ti']
+        name = quote(ti.run_id, safe='')
+        map_index = getattr(ti, 'map_index', -1)
+        if map_index >= 0:
+            name = f'{name}.{map_index}'
+        return f'{self.fingerprint_index}.{name}.npy'
+
+    def read_destination(self, columns: List[str]) -> Iterator[pd.DataFrame]:
+        '''
+        Read the results already stored, used to rebuild the `fingerprint_index`.
+
+        Parameters:
+        -----------
+        columns : `List[str]`
+            Columns to read.
+
+        Returns:
+        --------
+        chunks : `Iterator[pd.DataFrame]`
+            The stored results, in chunks. Nothing if the destination doesn't exist yet.
+        '''
+        raise NotImplementedError('Implement read_destination')
+
     def store_errors(self, errors: List[ScraperError], context: Any) -> None:
         '''
         Store errors from scraper run.
@@ -1,13 +1,22 @@
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from json import loads
 import logging
 from math import ceil
-from typing import Any, List, Optional
-import pandas as pd
-from airflow.providers.google.cloud.hooks.bigquery import BigQueryHook
-from google.cloud.bigquery import Client, LoadJobConfig
-from as_scraper.errors import ScraperError
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional
+from uuid import uuid4
+from airflow.exceptions import AirflowException
 from as_scraper_airflow.errors import TaskError
-from as_scraper_airflow.operators import ScraperOperator
+from as_scraper_airflow.operators.scraper import ScraperOperator
+if TYPE_CHECKING:
+    # The BigQuery clients are imported when the operator runs, so that parsing a DAG file
+    # does not load them
+    import pandas as pd
+    from google.cloud.bigquery import Client, LoadJob, Table
+    from google.cloud.bigquery_storage_v1 import BigQueryWriteClient
+    from as_scraper.errors import ScraperError
+    from as_scraper_airflow.storage_write import StorageWriteSink
 
 log = logging.getLogger(__name__)
 
@@ -16,6 +25,28 @@ class ScraperToBigqueryOperator(ScraperOperator):
     '''
     Execute scraper and store results and errors in bigquery.
 
+    The first chunk of results of a run is loaded with `write_disposition`, which truncates the
+    destination table by default. When results are flushed incrementally, the following chunks
+    are appended to it. With `load_chunk_bytes`, every chunk is loaded into a staging table
+    instead, and the destination table only changes once all the results are stored.
+
+    With `checkpoint_dir` and `WRITE_APPEND`, flushed chunks are also loaded into a staging
+    table, since a retry stores the results replayed from the checkpoint again.
+
+    With `upsert`, results are always staged and then merged into the destination table on
+    `merge_keys`: rows with new keys are inserted and the other rows are updated in place, so
+    the cost of a run follows the number of changed rows instead of the size of the table.
+
+    With `partitioned`, the destination table is partitioned by day of `scraped_date`, and each
+    run is written to the partition of its start date with the `table$YYYYMMDD` decorator.
+    `WRITE_TRUNCATE` then only replaces that partition, so reruns and backfills leave the other
+    days untouched.
+
+    With `storage_write`, results are streamed over the BigQuery Storage Write API as they are
+    flushed, instead of being loaded by load jobs. Rows go to a pending stream that is committed
+    at once when the run ends, directly into the destination table with `WRITE_APPEND`, or into
+    a staging table published as above otherwise.
+
     Parameters:
     -----------
     destination_table : `str`
@@ -30,6 +61,47 @@ class ScraperToBigqueryOperator(ScraperOperator):
         <dataset_name>.<table_name>. Required if `store_errors` is True.
     error_schema : `Optional[str]`
         The BigQuery Schema for scraper errors. Required if `store_errors` is True.
+    write_disposition : `Optional[str]`
+        Either `WRITE_TRUNCATE` or `WRITE_APPEND`. A `fingerprint_index` requires `WRITE_APPEND`
+        without `upsert`, to only add the rows that previous runs didn't store. Defaults to
+        `WRITE_TRUNCATE`.
+    deferrable : `Optional[bool]`
+        Wait for the load jobs from the triggerer instead of a worker. Defaults to False.
+    poll_interval : `Optional[float]`
+        Seconds between two polls of the load jobs in deferrable mode. Defaults to 10.
+    source_format : `Optional[str]`
+        Either `NEWLINE_DELIMITED_JSON` or `PARQUET`. With `PARQUET`, results are serialized
+        column-wise with the types of `schema` into a compressed Parquet file, which is faster
+        and uses less memory than building one JSON object per row. Values that don't match
+        their field type are set to null, up to 5% of the rows like JSON loads allow. Requires
+        the `parquet` extra. Defaults to `NEWLINE_DELIMITED_JSON`.
+    load_chunk_bytes : `Optional[int]`
+        If given, results are split in chunks of about this many bytes of in-memory data, which
+        are loaded concurrently into a staging table. Once all the results are stored, the
+        staging table is copied into the destination table with `write_disposition` in a single
+        job, so the results of the run become visible at once.
+    max_parallel_loads : `Optional[int]`
+        Maximum number of chunks uploaded at the same time with `load_chunk_bytes`. Defaults
+        to 4.
+    upsert : `Optional[bool]`
+        Merge the results into the destination table instead of loading them with
+        `write_disposition`. Defaults to False.
+    merge_keys : `Optional[List[str]]`
+        Columns identifying a row of the destination table in `upsert` mode. Defaults to the
+        `drop_duplicates` columns.
+    skip_unchanged : `Optional[bool]`
+        In `upsert` mode, only update the rows whose values changed, by comparing a hash of
+        their columns other than the keys and `scraped_date`. Defaults to False.
+    partitioned : `Optional[bool]`
+        Create the destination table partitioned by day of `scraped_date`, and write each run
+        to the partition of its start date. `schema` needs a `scraped_date` field of type
+        `TIMESTAMP`, `DATETIME` or `DATE`. `DATETIME` and `DATE` fields get the wall time or
+        the date of the start of the run in `local_tz`. Defaults to False.
+    clustering_fields : `Optional[List[str]]`
+        Columns the destination table is clustered on, when the operator creates it.
+    storage_write : `Optional[bool]`
+        Stream the results over the Storage Write API. Requires the `storage-write` extra.
+        Defaults to False.
     '''
 
     def __init__(
@@ -39,6 +111,18 @@ class ScraperToBigqueryOperator(ScraperOperator):
         schema: str,
         error_table: Optional[str] = None,
         error_schema: Optional[str] = None,
+        write_disposition: Optional[str] = 'WRITE_TRUNCATE',
+        deferrable: Optional[bool] = False,
+        poll_interval: Optional[float] = 10,
+        source_format: Optional[str] = 'NEWLINE_DELIMITED_JSON',
+        load_chunk_bytes: Optional[int] = None,
+        max_parallel_loads: Optional[int] = 4,
+        upsert: Optional[bool] = False,
+        merge_keys: Optional[List[str]] = None,
+        skip_unchanged: Optional[bool] = False,
+        partitioned: Optional[bool] = False,
+        clustering_fields: Optional[List[str]] = None,
+        storage_write: Optional[bool] = False,
         *args,
         **kwargs,
     ) -> None:
@@ -48,32 +132,387 @@ class ScraperToBigqueryOperator(ScraperOperator):
         self.schema = schema
         self.error_table = error_table
         self.error_schema = error_schema
+        if write_disposition not in ('WRITE_TRUNCATE', 'WRITE_APPEND'):
+            raise AirflowException(
+                f'write_disposition must be WRITE_TRUNCATE or WRITE_APPEND, got {write_disposition}')
+        self.write_disposition = write_disposition
+        self.deferrable = deferrable
+        self.poll_interval = poll_interval
+        if source_format not in ('NEWLINE_DELIMITED_JSON', 'PARQUET'):
+            raise AirflowException(
+                f'source_format must be NEWLINE_DELIMITED_JSON or PARQUET, got {source_format}')
+        self.source_format = source_format
+        self.load_chunk_bytes = load_chunk_bytes
+        self.max_parallel_loads = max_parallel_loads
+        self.upsert = upsert
+        if merge_keys is None:
+            merge_keys = self.drop_duplicates
+        if upsert and not merge_keys:
+            raise AirflowException(
+                'upsert requires merge_keys or drop_duplicates columns')
+        self.merge_keys = merge_keys
+        if self.fingerprint_index is not None and (upsert or write_disposition != 'WRITE_APPEND'):
+            # Rows in the index are skipped, so truncating would drop the rows of previous runs,
+            # and rows whose keys were stored before would never be updated by the merge
+            raise AirflowException(
+                'fingerprint_index requires write_disposition WRITE_APPEND without upsert')
+        self.skip_unchanged = skip_unchanged
+        self.partitioned = partitioned
+        if partitioned and 'scraped_date' not in [field['name'] for field in loads(schema)]:
+            raise AirflowException(
+                'partitioned requires a scraped_date field in schema')
+        self.clustering_fields = clustering_fields
+        self.storage_write = storage_write
         self._bq_client = None
+        self._pending_jobs: List[LoadJob] = []
+        self._truncate_job: Optional[LoadJob] = None
+        self._staging_table: Optional[str] = None
+        self._destination: str = destination_table
+        self._write_sink: Optional[StorageWriteSink] = None
+
+    def write_client(self) -> BigQueryWriteClient:
+        '''
+        Storage Write API client, with the credentials of the BigQuery connection.
+        '''
+        from airflow.providers.google.cloud.hooks.bigquery import BigQueryHook
+        from as_scraper_airflow.storage_write import BigQueryWriteClient
+        bq_hook = BigQueryHook(
+            gcp_conn_id=self.bigquery_conn_id, use_legacy_sql=False)
+        return BigQueryWriteClient(credentials=bq_hook.get_credentials())
 
     @property
     def bq_client(self) -> Client:
         if self._bq_client is None:
-            bq_hook = BigQueryHook(
-                bigquery_conn_id=self.bigquery_conn_id, use_legacy_sql=False)
-            self._bq_client = bq_hook.get_client()
+            from as_scraper_airflow.clients import bigquery_client
+            self._bq_client = bigquery_client(self.bigquery_conn_id)
         return self._bq_client
 
-    def store_results(self, df: pd.DataFrame) -> None:
-        log.info('Uploading %d results to BigQuery', len(df))
-        job_config = LoadJobConfig(schema=loads(self.schema), write_disposition='WRITE_TRUNCATE',
-                                   create_disposition='CREATE_IF_NEEDED', max_bad_records=ceil(len(df) * 0.05),)
-        load_job = self.bq_client.load_table_from_json(df.to_dict(
-            orient='records'), self.destination_table, job_config=job_config,)
+    def execute(self, context: Any):
+        from as_scraper_airflow.triggers import BigQueryLoadJobsTrigger
+        self._pending_jobs = []
+        self._truncate_job = None
+        self._staging_table = None
+        self._write_sink = None
+        self._destination = self.destination_partition(context)
+        if self.partitioned or self.clustering_fields or self.storage_write:
+            self.bq_client.create_table(
+                self.destination_table_definition(), exists_ok=True)
+        try:
+            super().execute(context)
+        finally:
+            if self._write_sink is not None:
+                self._write_sink.close()
+        if self.defers_commit():
+            log.info('Deferring until %d load jobs are done',
+                     len(self._pending_jobs))
+            jobs = [(job.job_id, job.project, job.location)
+                    for job in self._pending_jobs]
+            self.defer(trigger=BigQueryLoadJobsTrigger(jobs, self.bigquery_conn_id, self.poll_interval),
+                       method_name='execute_complete', kwargs={'staging_table': self._staging_table})
+
+    def execute_complete(self, context: Any, event: Dict[str, Any], staging_table: Optional[str] = None) -> None:
+        '''
+        Resume after the load jobs are done, log their outcome, publish the staging table if
+        results were staged, and complete the run. The task fails without publishing or
+        completing the run if any load job failed, like `LoadJob.result` does when not deferred.
+        '''
+        if event['status'] != 'success':
+            raise AirflowException(
+                f'Failed waiting for load jobs: {event["message"]}')
+        failed_jobs = []
+        for job_id, outcome in event['jobs'].items():
+            log.info('Load job %s ended at %s', job_id, outcome['ended'])
+            if outcome['error_result'] is not None:
+                log.error(outcome['error_result'])
+                log.error(outcome['errors'])
+                failed_jobs.append(job_id)
+        if failed_jobs:
+            raise AirflowException(
+                f'Load jobs failed: {", ".join(failed_jobs)}')
+        if staging_table is not None:
+            self._destination = self.destination_partition(context)
+            self.publish_staging_table(staging_table)
+        self.complete_run(context)
+
+    def destination_partition(self, context: Any) -> str:
+        '''
+        The table the results of the run are written to: the partition of the start date of the
+        run with `partitioned`, or else the destination table.
+        '''
+        if not self.partitioned:
+            return self.destination_table
+        start_date = context['dag_run'].start_date
+        if self.scraped_date_type() == 'TIMESTAMP':
+            # BigQuery partitions timestamps by their UTC date
+            start_date = start_date.astimezone(timezone.utc)
+        elif self.local_tz:
+            start_date = start_date.astimezone(tz=self.local_tz)
+        return f'{self.destination_table}${start_date:%Y%m%d}'
+
+    def scraped_date_type(self) -> Optional[str]:
+        '''
+        The type of the `scraped_date` field of `schema`, if it has one.
+        '''
+        for field in loads(self.schema):
+            if field['name'] == 'scraped_date':
+                return field['type'].upper()
+        return None
+
+    def scraped_date(self, context: Any) -> str:
+        '''
+        The start date of the run in the format of the `scraped_date` field: the date or the
+        wall time in `local_tz` for `DATE` and `DATETIME` fields, which have no timezone, so
+        that they fall in the partition of the run.
+        '''
+        field_type = self.scraped_date_type()
+        if field_type not in ('DATE', 'DATETIME'):
+            return super().scraped_date(context)
+        start_date = context['dag_run'].start_date
+        if self.local_tz:
+            start_date = start_date.astimezone(tz=self.local_tz)
+        if field_type == 'DATE':
+            return start_date.date().isoformat()
+        return start_date.replace(tzinfo=None).isoformat()
+
+    def wait_for_job(self, load_job: LoadJob) -> None:
+        '''
+        Wait for a load job and log its outcome, or leave it to the trigger in deferrable mode.
+        '''
+        if self.deferrable:
+            self._pending_jobs.append(load_job)
+            return
         load_job.result()
         log.info('Load job ended at %s', load_job.ended)
         if load_job.error_result is not None:
             log.error(load_job.error_result)
             log.error(load_job.errors)
 
+    def store_results(self, df: pd.DataFrame) -> None:
+        log.info('Uploading %d results to BigQuery', len(df))
+        if self.storage_write:
+            self.stream_results(df)
+            return
+        if self.stages_results():
+            self.store_staged(df)
+            return
+        # Only the first chunk of the run can replace the table content
+        write_disposition = self.write_disposition if self.flushed_chunks == 0 else 'WRITE_APPEND'
+        if self._truncate_job is not None:
+            # Appends could run before the truncate otherwise
+            self._truncate_job.result()
+            self._truncate_job = None
+        load_job = self.load_dataframe(
+            df, self._destination, write_disposition)
+        if self.deferrable and write_disposition == 'WRITE_TRUNCATE':
+            self._truncate_job = load_job
+        self.wait_for_job(load_job)
+
+    def stages_results(self) -> bool:
+        '''
+        Whether the chunks of results are loaded into a staging table, with `load_chunk_bytes`
+        or `upsert`, or when a checkpointed run flushes them to a table they are appended to.
+        A retry of the latter replays the chunks stored before the failure, which would be
+        appended twice.
+        '''
+        if self.load_chunk_bytes is not None or self.upsert:
+            return True
+        flushed = self.flush_every_rows is not None or self.flush_every_seconds is not None
+        return self.checkpoint_dir is not None and flushed and self.write_disposition == 'WRITE_APPEND'
+
+    def load_dataframe(self, df: pd.DataFrame, table: str, write_disposition: str) -> LoadJob:
+        '''
+        Submit a load job of a dataframe into a table, in the `source_format` of the operator.
+        '''
+        from google.cloud.bigquery import LoadJobConfig, ParquetOptions
+        from as_scraper_airflow.parquet import to_parquet
+        schema = loads(self.schema)
+        max_bad_records = ceil(len(df) * 0.05)
+        if self.source_format == 'PARQUET':
+            # BigQuery ignores max_bad_records for Parquet files, so values that don't match
+            # their field type are set to null when they are serialized, within the same limit
+            parquet_options = ParquetOptions()
+            parquet_options.enable_list_inference = True
+            job_config = LoadJobConfig(schema=schema, write_disposition=write_disposition,
+                                       create_disposition='CREATE_IF_NEEDED', source_format='PARQUET',
+                                       parquet_options=parquet_options,)
+            return self.bq_client.load_table_from_file(to_parquet(
+                df, schema, max_bad_records=max_bad_records), table, job_config=job_config,)
+        job_config = LoadJobConfig(schema=schema, write_disposition=write_disposition,
+                                   create_disposition='CREATE_IF_NEEDED', max_bad_records=max_bad_records,)
+        return self.bq_client.load_table_from_json(df.to_dict(
+            orient='records'), table, job_config=job_config,)
+
+    def stream_results(self, df: pd.DataFrame) -> None:
+        '''
+        Send results to the write stream of the run. The stream writes into the destination table
+        with `WRITE_APPEND` and without `upsert`, and into a staging table otherwise.
+        '''
+        from google.cloud.bigquery import TableReference
+        from as_scraper_airflow.storage_write import StorageWriteSink
+        if self._write_sink is None:
+            if self.write_disposition == 'WRITE_APPEND' and not self.upsert:
+                table = self.destination_table
+            else:
+                table = self._staging_table = self.create_staging_table()
+            table_ref = TableReference.from_string(
+                table, default_project=self.bq_client.project)
+            table_path = f'projects/{table_ref.project}/datasets/{table_ref.dataset_id}/tables/{table_ref.table_id}'
+            self._write_sink = StorageWriteSink(
+                self.write_client(), table_path, loads(self.schema))
+        self._write_sink.append(df)
+
+    def store_staged(self, df: pd.DataFrame) -> None:
+        '''
+        Load a chunk of results into the staging table of the run, split in chunks of about
+        `load_chunk_bytes` bytes that are uploaded concurrently.
+        '''
+        from as_scraper_airflow.execution import split_chunks
+        if self._staging_table is None:
+            self._staging_table = self.create_staging_table()
+        chunks = [df]
+        if self.load_chunk_bytes is not None:
+            df_bytes = df.memory_usage(index=False, deep=True).sum()
+            row_bytes = max(1, df_bytes / max(1, len(df)))
+            chunk_rows = max(1, int(self.load_chunk_bytes // row_bytes))
+            chunks = split_chunks(df, chunk_rows)
+        log.info('Loading %d chunks into %s', len(chunks), self._staging_table)
+        with ThreadPoolExecutor(max_workers=self.max_parallel_loads) as executor:
+            load_jobs = list(executor.map(
+                lambda chunk: self.load_dataframe(chunk, self._staging_table, 'WRITE_APPEND'), chunks))
+        for load_job in load_jobs:
+            self.wait_for_job(load_job)
+
+    def create_staging_table(self) -> str:
+        '''
+        Create an empty staging table next to the destination table. It expires after a day, so
+        the tables of failed runs are cleaned up by BigQuery.
+        '''
+        staging_table = f'{self.destination_table}_staging_{uuid4().hex}'
+        table = self.schema_table(staging_table)
+        table.expires = datetime.now(timezone.utc) + timedelta(days=1)
+        self.bq_client.create_table(table)
+        return staging_table
+
+    def schema_table(self, table_id: str) -> Table:
+        '''
+        Table definition with the schema of the operator.
+        '''
+        from google.cloud.bigquery import SchemaField, Table, TableReference
+        table_ref = TableReference.from_string(
+            table_id, default_project=self.bq_client.project)
+        return Table(table_ref, schema=[SchemaField.from_api_repr(field)
+                                        for field in loads(self.schema)])
+
+    def destination_table_definition(self) -> Table:
+        '''
+        Definition of the destination table, with its partitioning and clustering.
+        '''
+        from google.cloud.bigquery import TimePartitioning, TimePartitioningType
+        table = self.schema_table(self.destination_table)
+        if self.partitioned:
+            table.time_partitioning = TimePartitioning(
+                type_=TimePartitioningType.DAY, field='scraped_date')
+        if self.clustering_fields:
+            table.clustering_fields = self.clustering_fields
+        return table
+
+    def commit_results(self) -> None:
+        if self._write_sink is not None:
+            self._write_sink.commit()
+        if self._staging_table is None or self.defers_commit():
+            # In deferrable mode the staging table is published once the loads are done
+            return
+        self.publish_staging_table(self._staging_table)
+
+    def defers_commit(self) -> bool:
+        return self.deferrable and bool(self._pending_jobs)
+
+    def publish_staging_table(self, staging_table: str) -> None:
+        '''
+        Apply the staging table to the destination table in a single job, so the results of the
+        run become visible at once, and drop the staging table.
+        '''
+        if self.upsert:
+            self.merge_staging_table(staging_table)
+        else:
+            self.copy_staging_table(staging_table)
+        self.bq_client.delete_table(staging_table, not_found_ok=True)
+
+    def copy_staging_table(self, staging_table: str) -> None:
+        '''
+        Copy the staging table into the destination table with `write_disposition`.
+        '''
+        from google.cloud.bigquery import CopyJobConfig
+        log.info('Copying %s into %s', staging_table, self._destination)
+        job_config = CopyJobConfig(write_disposition=self.write_disposition,
+                                   create_disposition='CREATE_IF_NEEDED')
+        copy_job = self.bq_client.copy_table(
+            staging_table, self._destination, job_config=job_config)
+        copy_job.result()
+
+    def merge_staging_table(self, staging_table: str) -> None:
+        '''
+        Merge the staging table into the destination table on `merge_keys`.
+        '''
+        log.info('Merging %s into %s on %s', staging_table,
+                 self.destination_table, ', '.join(self.merge_keys))
+        self.bq_client.create_table(
+            self.destination_table_definition(), exists_ok=True)
+        query_job = self.bq_client.query(self.merge_query(staging_table))
+        query_job.result()
+        log.info('Merge changed %s rows', query_job.num_dml_affected_rows)
+
+    def merge_query(self, staging_table: str) -> str:
+        '''
+        MERGE statement of the staging table into the destination table. Rows staged more than
+        once with the same keys are merged once, since a MERGE fails when a destination row
+        matches several source rows.
+        '''
+        columns = [field['name'] for field in loads(self.schema)]
+        keys = ', '.join(f'`{key}`' for key in self.merge_keys)
+        # Null keys match each other, so that rerunning a merge doesn't insert their rows again
+        on = ' AND '.join(
+            f'T.`{key}` IS NOT DISTINCT FROM S.`{key}`' for key in self.merge_keys)
+        updated = [
+            column for column in columns if column not in self.merge_keys]
+        matched = 'WHEN MATCHED'
+        compared = [column for column in updated if column != 'scraped_date']
+        if self.skip_unchanged and compared:
+            def row_hash(alias):
+                struct = ', '.join(f'{alias}.`{column}`'
+                                   for column in compared)
+                return f'FARM_FINGERPRINT(TO_JSON_STRING(STRUCT({struct})))'
+            matched += f' AND {row_hash("T")} != {row_hash("S")}'
+        query = [
+            f'MERGE `{self.destination_table}` T',
+            f'USING (SELECT * FROM `{staging_table}` WHERE TRUE',
+            f'       QUALIFY ROW_NUMBER() OVER (PARTITION BY {keys}) = 1) S',
+            f'ON {on}',
+        ]
+        if updated:
+            query.append(f'{matched} THEN UPDATE SET ' +
+                         ', '.join(f'`{column}` = S.`{column}`' for column in updated))
+        query.append('WHEN NOT MATCHED THEN INSERT (' + ', '.join(f'`{column}`' for column in columns) +
+                     ') VALUES (' + ', '.join(f'S.`{column}`' for column in columns) + ')')
+        return '\n'.join(query)
+
+    def read_destination(self, columns: List[str]) -> Iterator[pd.DataFrame]:
+        import pandas as pd
+        from google.api_core.exceptions import NotFound
+        try:
+            table = self.bq_client.get_table(self.destination_table)
+        except NotFound:
+            return
+        fields = [field for field in table.schema if field.name in columns]
+        rows = self.bq_client.list_rows(table, selected_fields=fields)
+        for page in rows.pages:
+            yield pd.DataFrame([dict(row.items()) for row in page], columns=columns)
+
     def test_storage_connection(self) -> Any:
-        return self.bq_client()
+        return self.bq_client
 
     def store_errors(self, errors: List[ScraperError], context: Any) -> None:
+        from google.cloud.bigquery import LoadJobConfig
         log.info('Uploading %d errors to BigQuery', len(errors))
         start_date = context['dag_run'].start_date
         if self.local_tz:
@@ -85,4 +524,4 @@ class ScraperToBigqueryOperator(ScraperOperator):
             self.error_schema), write_disposition='WRITE_APPEND', create_disposition='CREATE_IF_NEEDED',)
         load_job = self.bq_client.load_table_from_json(
             errors, destination=self.error_table, job_config=job_config)
-        load_job.result()
+        self.wait_for_job(load_job)
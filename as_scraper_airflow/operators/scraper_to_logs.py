@@ -1,8 +1,10 @@
+from __future__ import annotations
 import logging
-from typing import Any, List
-import pandas as pd
-from as_scraper.errors import ScraperError
+from typing import TYPE_CHECKING, Any, List
 from as_scraper_airflow.operators.scraper import ScraperOperator
+if TYPE_CHECKING:
+    import pandas as pd
+    from as_scraper.errors import ScraperError
 
 log = logging.getLogger(__name__)
 
@@ -0,0 +1,272 @@
+from decimal import ROUND_HALF_UP, Context, Decimal
+import io
+from json import dumps
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+log = logging.getLogger(__name__)
+
+
+def _arrow_type(field: Dict[str, Any]) -> 'pa.DataType':
+    field_type = field['type'].upper()
+    if field_type in ('RECORD', 'STRUCT'):
+        return pa.struct([arrow_field(subfield) for subfield in field['fields']])
+    types = {
+        'STRING': pa.string(),
+        'BYTES': pa.binary(),
+        'INTEGER': pa.int64(),
+        'INT64': pa.int64(),
+        'FLOAT': pa.float64(),
+        'FLOAT64': pa.float64(),
+        'NUMERIC': pa.decimal128(38, 9),
+        'BIGNUMERIC': pa.decimal256(76, 38),
+        'BOOLEAN': pa.bool_(),
+        'BOOL': pa.bool_(),
+        'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+        'DATETIME': pa.timestamp('us'),
+        'DATE': pa.date32(),
+        'TIME': pa.time64('us'),
+        'JSON': pa.string(),
+    }
+    if field_type not in types:
+        raise ValueError(
+            f'Unsupported BigQuery type {field_type} of field {field["name"]}')
+    return types[field_type]
+
+
+def arrow_field(field: Dict[str, Any]) -> 'pa.Field':
+    '''
+    Arrow field of a BigQuery schema field, in the JSON format of BigQuery schemas.
+    '''
+    arrow_type = _arrow_type(field)
+    mode = field.get('mode', 'NULLABLE').upper()
+    if mode == 'REPEATED':
+        return pa.field(field['name'], pa.list_(arrow_type))
+    return pa.field(field['name'], arrow_type, nullable=mode != 'REQUIRED')
+
+
+# Digits after the decimal point of the BigQuery decimal types
+_DECIMAL_SCALES = {'NUMERIC': 9, 'BIGNUMERIC': 38}
+# Enough precision for the digits of BIGNUMERIC values
+_DECIMAL_CONTEXT = Context(prec=77, rounding=ROUND_HALF_UP)
+
+_BOOLEANS = {'true': True, 'false': False, '1': True, '0': False}
+
+# Errors of values that can't be converted to the type of their field
+_CONVERSION_ERRORS = (ValueError, TypeError, KeyError, ArithmeticError)
+
+
+def _is_missing(value: Any) -> bool:
+    return pd.api.types.is_scalar(value) and pd.isna(value)
+
+
+def _to_integer(value: Any) -> Any:
+    if isinstance(value, str):
+        return int(value)
+    if isinstance(value, float):
+        # Integers are floats in columns that have missing values
+        if not value.is_integer():
+            raise ValueError(f'{value} is not an integer')
+        return int(value)
+    return value
+
+
+def _to_decimal(value: Any, scale: int) -> Decimal:
+    # Floats are converted from their shortest representation, 0.1 rather than its binary value
+    return Decimal(str(value)).quantize(Decimal(1).scaleb(-scale), context=_DECIMAL_CONTEXT)
+
+
+def _to_boolean(value: Any) -> Any:
+    if isinstance(value, str):
+        return _BOOLEANS[value.strip().lower()]
+    return value
+
+
+def _to_string(value: Any) -> str:
+    return value if isinstance(value, str) else str(value)
+
+
+def _to_json(value: Any) -> str:
+    return value if isinstance(value, str) else dumps(value, default=str)
+
+
+def _to_timestamp(value: Any) -> pd.Timestamp:
+    value = pd.Timestamp(value)
+    if value.tzinfo is None:
+        return value.tz_localize('UTC')
+    return value.tz_convert('UTC')
+
+
+def _to_datetime(value: Any) -> pd.Timestamp:
+    # Datetimes have no timezone in BigQuery, keep the wall time of the values
+    return pd.Timestamp(value).tz_localize(None)
+
+
+def _to_date(value: Any) -> Any:
+    return pd.Timestamp(value).date()
+
+
+def _coerce(column: pd.Series, convert: Callable[[Any], Any]) -> Tuple[pd.Series, pd.Series]:
+    '''
+    Convert every value of a column. Values that can't be converted are set to null.
+
+    Returns:
+    --------
+    column, invalid : `Tuple[pd.Series, pd.Series]`
+        The converted values, and a mask of the values that couldn't be converted.
+    '''
+    values = []
+    invalid = []
+    for value in column:
+        if _is_missing(value):
+            values.append(None)
+            invalid.append(False)
+            continue
+        try:
+            values.append(convert(value))
+            invalid.append(False)
+        except _CONVERSION_ERRORS:
+            values.append(None)
+            invalid.append(True)
+    return (pd.Series(values, index=column.index, dtype=object),
+            pd.Series(invalid, index=column.index, dtype=bool))
+
+
+def _coerce_datetimes(column: pd.Series, field_type: str) -> Tuple[pd.Series, pd.Series]:
+    invalid = pd.Series(False, index=column.index)
+    try:
+        # Parse the whole column at once, unless some values can't be parsed, or have
+        # different formats
+        if field_type == 'TIMESTAMP':
+            return pd.to_datetime(column, utc=True), invalid
+        if field_type == 'DATE':
+            return pd.to_datetime(column).dt.date, invalid
+        converted = pd.to_datetime(column)
+        if converted.dt.tz is not None:
+            converted = converted.dt.tz_localize(None)
+        return converted, invalid
+    except _CONVERSION_ERRORS:
+        pass
+    convert = {'TIMESTAMP': _to_timestamp,
+               'DATETIME': _to_datetime, 'DATE': _to_date}[field_type]
+    converted, invalid = _coerce(column, convert)
+    if field_type == 'TIMESTAMP':
+        return pd.to_datetime(converted, utc=True), invalid
+    if field_type == 'DATETIME':
+        return pd.to_datetime(converted), invalid
+    return converted, invalid
+
+
+def _convert_column(column: pd.Series, field: Dict[str, Any]) -> Tuple[pd.Series, pd.Series]:
+    # Scraped values are usually strings, or have the types pandas inferred from the scraped
+    # rows, like floats for integers with missing values. They are coerced to the field type,
+    # like BigQuery does with JSON values.
+    invalid = pd.Series(False, index=column.index)
+    if field.get('mode', 'NULLABLE').upper() == 'REPEATED':
+        return column, invalid
+    field_type = field['type'].upper()
+    inferred = pd.api.types.infer_dtype(column, skipna=True)
+    if field_type in ('TIMESTAMP', 'DATETIME', 'DATE'):
+        return _coerce_datetimes(column, field_type)
+    if field_type in ('STRING', 'JSON') and inferred not in ('string', 'empty'):
+        return _coerce(column, _to_string if field_type == 'STRING' else _to_json)
+    if field_type in ('INTEGER', 'INT64') and inferred not in ('integer', 'empty'):
+        return _coerce(column, _to_integer)
+    if field_type in ('FLOAT', 'FLOAT64') and inferred not in ('floating', 'integer', 'empty'):
+        converted = pd.to_numeric(column, errors='coerce')
+        return converted, converted.isna() & column.notna()
+    if field_type in _DECIMAL_SCALES:
+        scale = _DECIMAL_SCALES[field_type]
+        return _coerce(column, lambda value: _to_decimal(value, scale))
+    if field_type in ('BOOLEAN', 'BOOL') and inferred not in ('boolean', 'empty'):
+        return _coerce(column, _to_boolean)
+    return column, invalid
+
+
+def to_arrow(
+    df: pd.DataFrame,
+    schema: List[Dict[str, Any]],
+    max_bad_records: Optional[int] = 0,
+) -> 'pa.Table':
+    '''
+    Convert a dataframe into an Arrow table with the types of a BigQuery schema. Values are
+    coerced to the type of their field, like numbers to strings or floats to decimals. Values
+    that can't be coerced, like `N/A` in an INTEGER field, are set to null and logged.
+
+    Parameters:
+    -----------
+    df : `pd.DataFrame`
+        The data. It must have every column of the schema.
+    schema : `List[Dict[str, Any]]`
+        The BigQuery schema, in the JSON format of BigQuery schemas.
+    max_bad_records : `Optional[int]`
+        Maximum number of rows with values that can't be coerced. A `ValueError` is raised
+        past it. Defaults to 0.
+
+    Returns:
+    --------
+    table : `pa.Table`
+        The data, with the columns of the schema in its order.
+    '''
+    if pa is None:
+        raise ImportError(
+            'pyarrow is required for Arrow conversions. Install as-scraper-airflow[parquet]')
+    arrow_schema = pa.schema([arrow_field(field) for field in schema])
+    columns = {}
+    bad_records = pd.Series(False, index=df.index)
+    for field in schema:
+        column, invalid = _convert_column(df[field['name']], field)
+        if invalid.any():
+            log.warning('Setting %d values of %s to null, they are not %s. First one: %r',
+                        invalid.sum(), field['name'], field['type'].upper(),
+                        df[field['name']][invalid].iloc[0])
+        columns[field['name']] = column
+        bad_records |= invalid
+    if bad_records.sum() > max_bad_records:
+        raise ValueError(f'{bad_records.sum()} rows have values that do not match their field '
+                         f'type, more than the {max_bad_records} allowed')
+    return pa.Table.from_pandas(df.assign(**columns), schema=arrow_schema, preserve_index=False)
+
+
+def to_parquet(
+    df: pd.DataFrame,
+    schema: List[Dict[str, Any]],
+    compression: Optional[str] = 'snappy',
+    max_bad_records: Optional[int] = 0,
+) -> io.BytesIO:
+    '''
+    Serialize a dataframe column-wise into an in-memory Parquet file, with the types of a
+    BigQuery schema.
+
+    Parameters:
+    -----------
+    df : `pd.DataFrame`
+        The data. It must have every column of the schema.
+    schema : `List[Dict[str, Any]]`
+        The BigQuery schema, in the JSON format of BigQuery schemas.
+    compression : `Optional[str]`
+        Parquet compression codec. Defaults to snappy.
+    max_bad_records : `Optional[int]`
+        Maximum number of rows with values that can't be coerced to their field type, which
+        are set to null. See `to_arrow`. Defaults to 0.
+
+    Returns:
+    --------
+    file : `io.BytesIO`
+        The Parquet file, positioned at its start.
+    '''
+    if pa is None:
+        raise ImportError(
+            'pyarrow is required for Parquet loads. Install as-scraper-airflow[parquet]')
+    file = io.BytesIO()
+    table = to_arrow(df, schema, max_bad_records)
+    pq.write_table(table, file, compression=compression)
+    file.seek(0)
+    return file
@@ -0,0 +1,138 @@
+import logging
+from queue import Empty, Full, Queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+import pandas as pd
+from as_scraper.errors import ScraperError
+from as_scraper_airflow.execution import split_chunks
+
+log = logging.getLogger(__name__)
+
+
+Stage = Callable[[pd.DataFrame], Tuple[pd.DataFrame, List[ScraperError]]]
+
+_END = object()
+
+
+class ScraperPipeline:
+    '''
+    Run chained scraper stages concurrently, streaming micro-batches between them.
+
+    Every stage runs in its own thread and processes its batches in order, so outputs keep the
+    input order. The output of a stage is split into batches of `batch_size` rows and put into a
+    bounded queue, which blocks a stage that gets too far ahead of the next one.
+
+    Parameters:
+    -----------
+    stages : `List[Callable[[pd.DataFrame], Tuple[pd.DataFrame, List[ScraperError]]]]`
+        The stages to run. Each one scrapes an input dataframe and returns its results and errors.
+    batch_size : `int`
+        Number of rows handed at once from a stage to the next one.
+    queue_size : `Optional[int]`
+        Number of batches that can wait between two stages. Defaults to 4.
+    '''
+
+    def __init__(self, stages: List[Stage], batch_size: int, queue_size: Optional[int] = 4):
+        self.stages = stages
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self._errors: List[List[ScraperError]] = [[] for _ in stages]
+        self._failure: Optional[BaseException] = None
+        self._stopped = threading.Event()
+
+    @property
+    def errors(self) -> List[ScraperError]:
+        '''
+        Errors captured by every stage, in stage order.
+        '''
+        return [error for errors in self._errors for error in errors]
+
+    def run(self, batches: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        '''
+        Feed input batches through the stages.
+
+        Parameters:
+        -----------
+        batches : `Iterable[pd.DataFrame]`
+            Input batches for the first stage. They are consumed in a background thread.
+
+        Returns:
+        --------
+        outputs : `Iterator[pd.DataFrame]`
+            The batches produced by the last stage, in input order.
+        '''
+        queues = [Queue(maxsize=self.queue_size)
+                  for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(
+            target=self._feed, args=(batches, queues[0]), daemon=True)]
+        for position in range(len(self.stages)):
+            threads.append(threading.Thread(target=self._run_stage, args=(
+                position, queues[position], queues[position + 1]), daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                batch = self._get(queues[-1])
+                if batch is _END:
+                    break
+                yield batch
+            if self._failure is not None:
+                raise self._failure
+        finally:
+            self._stopped.set()
+            for thread in threads:
+                thread.join()
+
+    def _feed(self, batches: Iterable[pd.DataFrame], output: Queue) -> None:
+        try:
+            for batch in batches:
+                if not self._put(output, batch):
+                    break
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._put(output, _END)
+
+    def _run_stage(self, position: int, input: Queue, output: Queue) -> None:
+        try:
+            while True:
+                batch = self._get(input)
+                if batch is _END:
+                    break
+                df, errors = self.stages[position](batch)
+                self._errors[position].extend(errors)
+                for chunk in split_chunks(df, self.batch_size):
+                    if not self._put(output, chunk):
+                        return
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._put(output, _END)
+
+    def _fail(self, e: BaseException) -> None:
+        if self._failure is None:
+            self._failure = e
+        self._stopped.set()
+
+    def _put(self, queue: Queue, item: Any) -> bool:
+        '''
+        Put an item in a queue unless the pipeline is stopped. Returns False if it was stopped.
+        '''
+        while not self._stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _get(self, queue: Queue) -> Any:
+        '''
+        Get an item from a queue, or the end marker if the pipeline is stopped.
+        '''
+        while True:
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                if self._stopped.is_set():
+                    return _END
@@ -0,0 +1,462 @@
+import asyncio
+from collections import Counter, deque, namedtuple
+import heapq
+import logging
+from math import ceil, inf
+import random
+import threading
+from time import monotonic
+from typing import Collection, Deque, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+log = logging.getLogger(__name__)
+
+# Seconds between checks for a free slot when waiting from an event loop, which can't be
+# notified by the threads releasing slots.
+_ASYNC_POLL_INTERVAL = 0.05
+
+ScheduledUrl = Tuple[int, str]
+
+# Outcomes of the requests, reported to `HostLimits.release`
+OK = 'ok'
+ERROR = 'error'
+OVERLOADED = 'overloaded'
+
+# Request timeout, too early, too many requests, and transient server errors
+DEFAULT_RETRY_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+
+ConcurrencyChange = namedtuple(
+    'ConcurrencyChange', 'time host limit p95_latency error_rate reason')
+
+
+def request_outcome(status: Optional[int], error: bool) -> str:
+    '''
+    Classify a request by its http status. Throttled and server error responses, as well as
+    timeouts and connection errors, which have no status, mean the host is overloaded.
+    '''
+    too_many_requests_status_code = 429
+    server_error_status_code = 500
+    if status is None and error:
+        return OVERLOADED
+    if status is not None and (status == too_many_requests_status_code or status >= server_error_status_code):
+        return OVERLOADED
+    return ERROR if error else OK
+
+
+def url_host(url: str) -> str:
+    '''
+    Host an url is requested from, used to apply per-host limits.
+    '''
+    return urlsplit(url).hostname or ''
+
+
+class TokenBucket:
+    '''
+    Token bucket refilled at `rate` tokens per second, holding up to `burst` tokens. It starts
+    full.
+    '''
+
+    def __init__(self, rate: float, burst: int, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        '''
+        Seconds until a token is available.
+        '''
+        self.tokens = min(self.burst, self.tokens +
+                          (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class _HostWindow:
+    '''
+    Latencies and errors of the last requests of a host.
+    '''
+
+    def __init__(self, limit: int, in_flight_at_cut: int = 0):
+        self.limit = limit
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.cut = False
+        # Requests that were in flight when the concurrency was last cut and didn't finish yet
+        self.in_flight_at_cut = in_flight_at_cut
+
+
+class AdaptiveConcurrency:
+    '''
+    Additive increase, multiplicative decrease controller of the concurrency of every host.
+
+    The requests of a host are evaluated in windows of `window` requests. The concurrency of the
+    host grows by one when the p95 latency of the window and its error rate are within their
+    targets, and is multiplied by `decrease` otherwise. It is also cut as soon as the host
+    throttles requests, answers with server errors or times out, ignoring the failures of the
+    requests that were already in flight. Changes are logged and kept in `trace`.
+
+    Parameters:
+    -----------
+    initial : `Optional[int]`
+        Concurrency of a host that wasn't requested yet. Defaults to 2.
+    minimum : `Optional[int]`
+        Minimum concurrency of a host. Defaults to 1.
+    maximum : `Optional[int]`
+        Maximum concurrency of a host. Defaults to 32.
+    target_latency : `Optional[float]`
+        Target p95 latency of the requests, in seconds. Latency is not considered if not given.
+    target_error_rate : `Optional[float]`
+        Target fraction of failed requests. Defaults to 0.1.
+    decrease : `Optional[float]`
+        Factor applied to the concurrency when it is cut. Defaults to 0.5.
+    window : `Optional[int]`
+        Number of requests evaluated before growing the concurrency. Defaults to 10.
+    '''
+
+    def __init__(
+        self,
+        initial: Optional[int] = 2,
+        minimum: Optional[int] = 1,
+        maximum: Optional[int] = 32,
+        target_latency: Optional[float] = None,
+        target_error_rate: Optional[float] = 0.1,
+        decrease: Optional[float] = 0.5,
+        window: Optional[int] = 10,
+    ):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.target_error_rate = target_error_rate
+        self.decrease = decrease
+        self.window = window
+        self.trace: List[ConcurrencyChange] = []
+        self._hosts: Dict[str, _HostWindow] = {}
+
+    def limit(self, host: str) -> int:
+        '''
+        Current concurrency of a host.
+        '''
+        window = self._hosts.get(host)
+        return window.limit if window is not None else self.initial
+
+    def record(self, host: str, latency: float, outcome: str) -> None:
+        '''
+        Record a finished request of a host, and adapt its concurrency.
+        '''
+        window = self._hosts.get(host)
+        if window is None:
+            window = self._hosts[host] = _HostWindow(self.initial)
+        window.latencies.append(latency)
+        window.in_flight_at_cut -= 1
+        if outcome != OK:
+            window.errors += 1
+        # The requests that were in flight when the concurrency was cut are likely to fail too,
+        # so they don't cut it again
+        if outcome == OVERLOADED and window.in_flight_at_cut <= 0:
+            window.cut = True
+            window.in_flight_at_cut = window.limit
+            self._change(host, window, self._decreased(window.limit), outcome)
+        if len(window.latencies) < self.window:
+            return
+        if not window.cut:
+            p95_latency, error_rate = self._stats(window)
+            decreased = self._decreased(window.limit)
+            if error_rate > self.target_error_rate:
+                self._change(host, window, decreased, 'errors')
+            elif self.target_latency is not None and p95_latency > self.target_latency:
+                self._change(host, window, decreased, 'latency')
+            else:
+                increased = min(self.maximum, window.limit + 1)
+                self._change(host, window, increased, 'healthy')
+        self._hosts[host] = _HostWindow(
+            window.limit, window.in_flight_at_cut)
+
+    def _decreased(self, limit: int) -> int:
+        return max(self.minimum, int(limit * self.decrease))
+
+    @staticmethod
+    def _stats(window: _HostWindow) -> Tuple[float, float]:
+        latencies = sorted(window.latencies)
+        p95_latency = latencies[ceil(len(latencies) * 0.95) - 1]
+        return p95_latency, window.errors / len(latencies)
+
+    def _change(self, host: str, window: _HostWindow, limit: int, reason: str) -> None:
+        if limit == window.limit:
+            return
+        p95_latency, error_rate = self._stats(window)
+        self.trace.append(ConcurrencyChange(
+            monotonic(), host, limit, p95_latency, error_rate, reason))
+        log.info('Concurrency of %s: %d -> %d (%s, p95 latency %.2fs, error rate %.0f%%)',
+                 host, window.limit, limit, reason, p95_latency, error_rate * 100)
+        window.limit = limit
+
+
+class HostLimits:
+    '''
+    Per-host request rate and concurrency limits, shared by every scraper of a task run.
+
+    Parameters:
+    -----------
+    requests_per_host : `Optional[float]`
+        Maximum number of requests per second against a single host. Unlimited if not given.
+    burst : `Optional[int]`
+        Number of requests that can be made at once against a host that was idle. Defaults to 1.
+    max_per_host : `Optional[int]`
+        Maximum number of requests in flight against a single host. Defaults to 10.
+    controller : `Optional[AdaptiveConcurrency]`
+        If given, it sets the number of requests in flight against every host instead of
+        `max_per_host`, from the outcomes of their requests.
+    '''
+
+    def __init__(
+        self,
+        requests_per_host: Optional[float] = None,
+        burst: Optional[int] = 1,
+        max_per_host: Optional[int] = 10,
+        controller: Optional[AdaptiveConcurrency] = None,
+    ):
+        self.requests_per_host = requests_per_host
+        self.burst = burst
+        self.max_per_host = max_per_host
+        self.controller = controller
+        # Guards the state of the limits and of every scheduler using them
+        self.condition = threading.Condition()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._in_flight: Counter = Counter()
+
+    def acquire(self, host: str, now: float) -> float:
+        '''
+        Take a slot and a token of a host. Must be called holding `condition`.
+
+        Returns:
+        --------
+        delay : `float`
+            0 if they were taken. Otherwise the seconds until a token is available, or `inf` if
+            every slot of the host is busy.
+        '''
+        max_per_host = self.max_per_host
+        if self.controller is not None:
+            max_per_host = self.controller.limit(host)
+        if self._in_flight[host] >= max_per_host:
+            return inf
+        if self.requests_per_host is not None:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = TokenBucket(
+                    self.requests_per_host, self.burst, now)
+            delay = bucket.delay(now)
+            if delay > 0:
+                return delay
+            bucket.take()
+        self._in_flight[host] += 1
+        return 0.0
+
+    def release(self, host: str, latency: Optional[float] = None, outcome: Optional[str] = None) -> None:
+        '''
+        Release a slot of a host, reporting the latency and outcome of its request if they are
+        known. Must be called holding `condition`.
+        '''
+        if self.controller is not None and outcome is not None:
+            self.controller.record(host, latency, outcome)
+        self._in_flight[host] -= 1
+        if not self._in_flight[host]:
+            del self._in_flight[host]
+
+
+class RetryPolicy:
+    '''
+    When and how soon to retry the urls that failed with a transient error.
+
+    Urls are retried after an exponential backoff with full jitter: the n-th retry waits a random
+    time between 0 and `backoff * 2 ** (n - 1)` seconds, capped to `max_backoff`.
+
+    Parameters:
+    -----------
+    attempts : `Optional[int]`
+        Maximum number of attempts per url, including the first one. Defaults to 3.
+    backoff : `Optional[float]`
+        Base backoff in seconds. Defaults to 1.
+    max_backoff : `Optional[float]`
+        Maximum backoff in seconds. Defaults to 60.
+    retry_statuses : `Optional[Collection[int]]`
+        Http statuses that are retried. Timeouts and connection errors are always retried.
+        Defaults to `DEFAULT_RETRY_STATUSES`.
+    '''
+
+    def __init__(
+        self,
+        attempts: Optional[int] = 3,
+        backoff: Optional[float] = 1,
+        max_backoff: Optional[float] = 60,
+        retry_statuses: Optional[Collection[int]] = DEFAULT_RETRY_STATUSES,
+    ):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = retry_statuses
+
+    def is_retryable(self, status: Optional[int], error: bool) -> bool:
+        '''
+        Whether a failed request is worth retrying. Requests without a status timed out or
+        couldn't connect.
+        '''
+        return error and (status is None or status in self.retry_statuses)
+
+    def delay(self, retry: int) -> float:
+        '''
+        Seconds to wait before the n-th retry of an url.
+        '''
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (retry - 1)))
+
+
+class HostScheduler:
+    '''
+    Hand out the urls of a scraper input to concurrent workers, interleaving hosts.
+
+    Hosts take turns, so that a worker is given the url of another host while a host is at its
+    rate or concurrency limit, instead of waiting for it. Urls that failed with a transient error
+    are scheduled again after a backoff, while the workers go on with other urls.
+
+    Parameters:
+    -----------
+    urls : `Sequence[str]`
+        The urls to schedule. Workers get them as `(position, url)` pairs.
+    limits : `HostLimits`
+        The limits of the hosts, which can be shared with other schedulers.
+    retry_policy : `Optional[RetryPolicy]`
+        If given, urls released with a retryable error are scheduled again.
+    '''
+
+    def __init__(self, urls: Sequence[str], limits: HostLimits, retry_policy: Optional[RetryPolicy] = None):
+        self.limits = limits
+        self.retry_policy = retry_policy
+        self.retries = 0
+        self._pending: Dict[str, Deque[ScheduledUrl]] = {}
+        for position, url in enumerate(urls):
+            self._pending.setdefault(
+                url_host(url), deque()).append((position, url))
+        self._hosts = deque(self._pending)
+        # Urls waiting for their backoff, as a heap of (ready time, url)
+        self._backoff: List[Tuple[float, ScheduledUrl]] = []
+        self._attempts: Counter = Counter()
+        self._in_flight = 0
+        self._cancelled = False
+
+    @property
+    def finished(self) -> bool:
+        '''
+        Whether no url is left to hand out, now or after the urls in flight are done. Must be
+        called holding `limits.condition`.
+        '''
+        return self._cancelled or not (self._hosts or self._backoff or self._in_flight)
+
+    def poll(self) -> Tuple[Optional[ScheduledUrl], float]:
+        '''
+        Hand out the next url whose host is within its limits, without waiting. Must be called
+        holding `limits.condition`.
+
+        Returns:
+        --------
+        item, delay : `Tuple[Optional[Tuple[int, str]], float]`
+            The url and its position, or None with the seconds to wait before polling again. The
+            delay is `inf` if the workers must wait for a slot to be released.
+        '''
+        now = monotonic()
+        while self._backoff and self._backoff[0][0] <= now:
+            _, item = heapq.heappop(self._backoff)
+            host = url_host(item[1])
+            if host not in self._pending:
+                self._pending[host] = deque()
+                self._hosts.append(host)
+            # Retried urls go first, so that their results aren't held back
+            self._pending[host].appendleft(item)
+        delay = self._backoff[0][0] - now if self._backoff else inf
+        for _ in range(len(self._hosts)):
+            host = self._hosts[0]
+            self._hosts.rotate(-1)
+            host_delay = self.limits.acquire(host, now)
+            if host_delay:
+                delay = min(delay, host_delay)
+                continue
+            pending = self._pending[host]
+            item = pending.popleft()
+            if not pending:
+                del self._pending[host]
+                self._hosts.remove(host)
+            self._in_flight += 1
+            return item, 0.0
+        return None, delay
+
+    def take(self) -> Optional[ScheduledUrl]:
+        '''
+        Wait for the next url whose host is within its limits. Returns None once every url was
+        done, or the scheduler was cancelled.
+        '''
+        with self.limits.condition:
+            while True:
+                item, delay = self.poll()
+                if item is not None or self.finished:
+                    return item
+                self.limits.condition.wait(None if delay == inf else delay)
+
+    async def take_async(self) -> Optional[ScheduledUrl]:
+        '''
+        Like `take`, waiting from an event loop.
+        '''
+        while True:
+            with self.limits.condition:
+                item, delay = self.poll()
+                if item is not None or self.finished:
+                    return item
+            await asyncio.sleep(min(delay, _ASYNC_POLL_INTERVAL))
+
+    def release(
+        self,
+        item: ScheduledUrl,
+        latency: Optional[float] = None,
+        outcome: Optional[str] = None,
+        retryable: Optional[bool] = False,
+    ) -> bool:
+        '''
+        Release the slot of an url once it was loaded. See `HostLimits.release`.
+
+        If the url failed with a `retryable` error and has attempts left, it is scheduled again
+        after a backoff.
+
+        Returns:
+        --------
+        retried : `bool`
+            Whether the url was scheduled again, in which case its result must be discarded.
+        '''
+        position, url = item
+        with self.limits.condition:
+            self.limits.release(url_host(url), latency, outcome)
+            self._in_flight -= 1
+            self.limits.condition.notify_all()
+            if not retryable or self.retry_policy is None or self._cancelled:
+                return False
+            self._attempts[position] += 1
+            if self._attempts[position] >= self.retry_policy.attempts:
+                return False
+            delay = self.retry_policy.delay(self._attempts[position])
+            log.warning('Retrying %s in %.1fs, attempt %d failed',
+                        url, delay, self._attempts[position])
+            heapq.heappush(self._backoff, (monotonic() + delay, item))
+            self.retries += 1
+        return True
+
+    def cancel(self) -> None:
+        '''
+        Drop the urls not handed out yet.
+        '''
+        with self.limits.condition:
+            self._pending.clear()
+            self._hosts.clear()
+            self._backoff.clear()
+            self._cancelled = True
+            self.limits.condition.notify_all()
@@ -0,0 +1,127 @@
+from collections import deque
+import logging
+from typing import Any, Dict, List, Optional
+import pandas as pd
+try:
+    from google.cloud.bigquery_storage_v1 import BigQueryWriteClient, types, writer
+    from google.cloud.bigquery_storage_v1.exceptions import StreamClosedError
+except ImportError:
+    BigQueryWriteClient = None
+from as_scraper_airflow.parquet import to_arrow
+
+log = logging.getLogger(__name__)
+
+
+class StorageWriteSink:
+    '''
+    Stream rows into a BigQuery table over the Storage Write API, in a pending stream committed
+    at once at the end.
+
+    Rows are sent as serialized Arrow record batches as soon as they are appended, so they do
+    not wait in memory or in a load job queue. They only become visible in the table once the
+    stream is committed, and a stream that is never committed is discarded by BigQuery.
+
+    Parameters:
+    -----------
+    client : `BigQueryWriteClient`
+        The Storage Write API client.
+    table_path : `str`
+        The table, in the format projects/<project>/datasets/<dataset>/tables/<table>.
+    schema : `List[Dict[str, Any]]`
+        The BigQuery schema of the rows, in the JSON format of BigQuery schemas.
+    max_request_bytes : `Optional[int]`
+        Maximum size of the record batches of a request. The API rejects requests over 10 MB.
+        Defaults to 8 MB.
+    max_in_flight : `Optional[int]`
+        Maximum number of requests waiting for their response. Defaults to 8.
+    '''
+
+    def __init__(
+        self,
+        client: 'BigQueryWriteClient',
+        table_path: str,
+        schema: List[Dict[str, Any]],
+        max_request_bytes: Optional[int] = 8 * 2 ** 20,
+        max_in_flight: Optional[int] = 8,
+    ):
+        if BigQueryWriteClient is None:
+            raise ImportError(
+                'google-cloud-bigquery-storage is required for the Storage Write API. '
+                'Install as-scraper-airflow[storage-write]')
+        self.client = client
+        self.table_path = table_path
+        self.schema = schema
+        self.max_request_bytes = max_request_bytes
+        self.max_in_flight = max_in_flight
+        self.rows = 0
+        self._stream_name: Optional[str] = None
+        self._append_rows: Optional['writer.AppendRowsStream'] = None
+        self._in_flight = deque()
+
+    def _open(self, arrow_schema: Any) -> None:
+        write_stream = types.WriteStream(type_=types.WriteStream.Type.PENDING)
+        self._stream_name = self.client.create_write_stream(
+            parent=self.table_path, write_stream=write_stream).name
+        log.info('Opened write stream %s', self._stream_name)
+        template = types.AppendRowsRequest(
+            write_stream=self._stream_name,
+            arrow_rows=types.AppendRowsRequest.ArrowData(writer_schema=types.ArrowSchema(
+                serialized_schema=arrow_schema.serialize().to_pybytes())),
+        )
+        self._append_rows = writer.AppendRowsStream(self.client, template)
+
+    def append(self, df: pd.DataFrame) -> None:
+        '''
+        Send rows to the stream. They are not visible until `commit` is called.
+        '''
+        if not len(df):
+            return
+        table = to_arrow(df, self.schema)
+        if self._append_rows is None:
+            self._open(table.schema)
+        row_bytes = table.nbytes / table.num_rows
+        batch_rows = max(1, int(self.max_request_bytes // max(1, row_bytes)))
+        for batch in table.to_batches(max_chunksize=batch_rows):
+            request = types.AppendRowsRequest(
+                offset=self.rows,
+                arrow_rows=types.AppendRowsRequest.ArrowData(rows=types.ArrowRecordBatch(
+                    serialized_record_batch=batch.serialize().to_pybytes())),
+            )
+            self._in_flight.append(self._append_rows.send(request))
+            self.rows += batch.num_rows
+            while len(self._in_flight) > self.max_in_flight:
+                self._in_flight.popleft().result()
+
+    def commit(self) -> None:
+        '''
+        Wait for the pending requests, then finalize and commit the stream, which makes all
+        its rows visible at once.
+        '''
+        if self._stream_name is None:
+            return
+        while self._in_flight:
+            self._in_flight.popleft().result()
+        self.close()
+        self.client.finalize_write_stream(name=self._stream_name)
+        response = self.client.batch_commit_write_streams(types.BatchCommitWriteStreamsRequest(
+            parent=self.table_path, write_streams=[self._stream_name]))
+        if response.stream_errors:
+            raise RuntimeError(
+                f'Failed committing write stream {self._stream_name}: {response.stream_errors}')
+        log.info('Committed %d rows into %s at %s', self.rows,
+                 self.table_path, response.commit_time)
+        self._stream_name = None
+
+    def close(self) -> None:
+        '''
+        Close the connection to the stream. Rows of a stream that was not committed are
+        discarded.
+        '''
+        if self._append_rows is None:
+            return
+        try:
+            self._append_rows.close()
+        except StreamClosedError:
+            # The connection closed itself after an error
+            pass
+        self._append_rows = None
@@ -0,0 +1,20 @@
+from importlib import import_module
+from typing import Any, List
+
+_triggers = {
+    'BigQueryLoadJobsTrigger': 'bigquery',
+}
+
+__all__ = list(_triggers)
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _triggers:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(import_module(f'{__name__}.{_triggers[name]}'), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,79 @@
+import asyncio
+from functools import partial
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from airflow.triggers.base import BaseTrigger, TriggerEvent
+from google.cloud.bigquery import Client
+from as_scraper_airflow.clients import bigquery_client
+
+log = logging.getLogger(__name__)
+
+
+class BigQueryLoadJobsTrigger(BaseTrigger):
+    '''
+    Wait for BigQuery jobs to finish without holding a worker slot.
+
+    The jobs are polled from the triggerer, and a single event is fired once all of them are
+    done, with the outcome of every job.
+
+    Parameters:
+    -----------
+    jobs : `List[Tuple[str, str, str]]`
+        The `(job_id, project, location)` of every job to wait for.
+    bigquery_conn_id : `str`
+        The Airflow connection ID for BigQuery.
+    poll_interval : `Optional[float]`
+        Seconds between two polls of the pending jobs. Defaults to 10.
+    '''
+
+    def __init__(
+        self,
+        jobs: List[Tuple[str, str, str]],
+        bigquery_conn_id: str,
+        poll_interval: Optional[float] = 10,
+    ):
+        super().__init__()
+        self.jobs = [tuple(job) for job in jobs]
+        self.bigquery_conn_id = bigquery_conn_id
+        self.poll_interval = poll_interval
+
+    def serialize(self) -> Tuple[str, Dict[str, Any]]:
+        return (f'{type(self).__module__}.{type(self).__qualname__}', {
+            'jobs': [list(job) for job in self.jobs],
+            'bigquery_conn_id': self.bigquery_conn_id,
+            'poll_interval': self.poll_interval,
+        })
+
+    def get_client(self) -> Client:
+        '''
+        BigQuery client used to poll the jobs. It is called once per run of the trigger, from a
+        thread, since creating it can block. The triggers of a connection share its client.
+        '''
+        return bigquery_client(self.bigquery_conn_id)
+
+    async def run(self) -> AsyncIterator[TriggerEvent]:
+        loop = asyncio.get_event_loop()
+        try:
+            client = await loop.run_in_executor(None, self.get_client)
+            pending = list(self.jobs)
+            outcomes = {}
+            while True:
+                for job_id, project, location in list(pending):
+                    job = await loop.run_in_executor(None, partial(
+                        client.get_job, job_id, project=project, location=location))
+                    if job.state != 'DONE':
+                        continue
+                    pending.remove((job_id, project, location))
+                    outcomes[job_id] = {
+                        'ended': job.ended.isoformat() if job.ended is not None else None,
+                        'error_result': job.error_result,
+                        'errors': job.errors,
+                    }
+                if not pending:
+                    break
+                log.info('Waiting for %d BigQuery jobs', len(pending))
+                await asyncio.sleep(self.poll_interval)
+        except Exception as e:
+            yield TriggerEvent({'status': 'error', 'message': str(e)})
+            return
+        yield TriggerEvent({'status': 'success', 'jobs': outcomes})
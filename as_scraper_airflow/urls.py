@@ -0,0 +1,104 @@
+from fnmatch import fnmatchcase
+import logging
+from typing import Iterable, Iterator, Optional, Sequence
+from urllib.parse import unquote_plus, urlsplit, urlunsplit
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_IGNORED_PARAMS = (
+    'utm_*',
+    'gclid',
+    'dclid',
+    'fbclid',
+    'msclkid',
+    'mc_cid',
+    'mc_eid',
+    '_ga',
+    '_gl',
+)
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+
+
+class UrlNormalizer:
+    '''
+    Canonicalize urls so that different spellings of the same page are scraped only once.
+
+    Parameters:
+    -----------
+    lowercase_host : `Optional[bool]`
+        Lowercase the scheme and host. Defaults to True.
+    remove_default_port : `Optional[bool]`
+        Remove the port when it is the default one of the scheme. Defaults to True.
+    remove_fragment : `Optional[bool]`
+        Remove the `#fragment`. Defaults to True.
+    remove_trailing_slash : `Optional[bool]`
+        Remove the trailing slash of paths other than the root. Defaults to True.
+    sort_query : `Optional[bool]`
+        Sort query parameters by name. Defaults to True.
+    ignored_params : `Optional[Sequence[str]]`
+        Shell-style patterns of query parameter names to remove, like tracking parameters.
+        Defaults to `DEFAULT_IGNORED_PARAMS`.
+    '''
+
+    def __init__(
+        self,
+        lowercase_host: Optional[bool] = True,
+        remove_default_port: Optional[bool] = True,
+        remove_fragment: Optional[bool] = True,
+        remove_trailing_slash: Optional[bool] = True,
+        sort_query: Optional[bool] = True,
+        ignored_params: Optional[Sequence[str]] = DEFAULT_IGNORED_PARAMS,
+    ):
+        self.lowercase_host = lowercase_host
+        self.remove_default_port = remove_default_port
+        self.remove_fragment = remove_fragment
+        self.remove_trailing_slash = remove_trailing_slash
+        self.sort_query = sort_query
+        self.ignored_params = ignored_params or ()
+        self.duplicates = 0
+
+    def normalize(self, url: str) -> str:
+        '''
+        Canonical form of an url. Query parameters keep their original encoding.
+        '''
+        scheme, netloc, path, query, fragment = urlsplit(url.strip())
+        if self.lowercase_host:
+            scheme = scheme.lower()
+            userinfo, at, hostport = netloc.rpartition('@')
+            netloc = f'{userinfo}{at}{hostport.lower()}'
+        if self.remove_default_port and scheme in DEFAULT_PORTS:
+            default_port = f':{DEFAULT_PORTS[scheme]}'
+            if netloc.endswith(default_port):
+                netloc = netloc[:-len(default_port)]
+        if not path and netloc:
+            path = '/'
+        if self.remove_trailing_slash and len(path) > 1:
+            path = path.rstrip('/') or '/'
+        params = [param for param in query.split('&') if param]
+        if self.ignored_params:
+            params = [param for param in params if not self._is_ignored(param)]
+        if self.sort_query:
+            params.sort()
+        if self.remove_fragment:
+            fragment = ''
+        return urlunsplit((scheme, netloc, path, '&'.join(params), fragment))
+
+    def unique(self, urls: Iterable[str]) -> Iterator[str]:
+        '''
+        Lazily normalize urls and drop the ones already seen. Dropped urls are counted in
+        `duplicates`.
+        '''
+        seen = set()
+        for url in urls:
+            url = self.normalize(url)
+            if url in seen:
+                self.duplicates += 1
+                continue
+            seen.add(url)
+            yield url
+        log.info('Skipped %d duplicate urls after normalization', self.duplicates)
+
+    def _is_ignored(self, param: str) -> bool:
+        name = unquote_plus(param.partition('=')[0])
+        return any(fnmatchcase(name, pattern) for pattern in self.ignored_params)
@@ -0,0 +1,144 @@
+from contextlib import contextmanager
+import logging
+from queue import Queue
+import threading
+from typing import Any, Iterator, List, Optional, Type
+from as_scraper.scraper import Scraper
+
+log = logging.getLogger(__name__)
+
+
+class _PooledDriver:
+    '''
+    A pool slot. The scraper instance owns the Firefox driver, so the driver is configured with
+    the options of the scraper class.
+    '''
+
+    def __init__(self, scraper: Scraper):
+        self.scraper = scraper
+        self.pages = 0
+
+
+class WebDriverPool:
+    '''
+    Pool of long-lived selenium drivers for `LOAD_JAVASCRIPT=True` scrapers.
+
+    Browsers are started lazily, leased to one url at a time and reset between uses. A browser
+    is recycled after `max_pages` pages to bound the memory leaked by long browser sessions.
+
+    Parameters:
+    -----------
+    scraper_cls : `Type[Scraper]`
+        The scraper whose driver configuration is used for the browsers.
+    size : `int`
+        Maximum number of browsers alive at the same time.
+    max_pages : `Optional[int]`
+        Number of pages after which a browser is restarted. Defaults to the scraper
+        `RESET_AFTER` variable. If both are None, browsers are never recycled.
+    '''
+
+    def __init__(self, scraper_cls: Type[Scraper], size: int, max_pages: Optional[int] = None):
+        if size < 1:
+            raise ValueError('size must be greater than 0')
+        self.scraper_cls = scraper_cls
+        self.size = size
+        self.max_pages = max_pages if max_pages is not None else scraper_cls.RESET_AFTER
+        self._idle = Queue()
+        for _ in range(size):
+            self._idle.put(None)
+        self._started: List[_PooledDriver] = []
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> 'WebDriverPool':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @contextmanager
+    def lease(self) -> Iterator[Scraper]:
+        '''
+        Lease a browser for a single url. Blocks until a browser is available.
+
+        Returns:
+        --------
+        scraper : `Scraper`
+            A scraper instance whose `driver` is a clean, already started browser.
+        '''
+        slot = self._idle.get()
+        try:
+            if slot is None:
+                slot = self._start()
+            yield slot.scraper
+            slot.pages += 1
+            if self.max_pages is not None and slot.pages >= self.max_pages:
+                log.info('Recycling selenium driver after %d pages', slot.pages)
+                self._stop(slot)
+                slot = None
+            elif not self._reset(slot):
+                self._stop(slot)
+                slot = None
+        except Exception:
+            if slot is not None:
+                self._stop(slot)
+                slot = None
+            raise
+        finally:
+            self._idle.put(slot)
+
+    def close(self) -> None:
+        '''
+        Quit every browser of the pool.
+        '''
+        with self._lock:
+            started, self._started = self._started, []
+        for slot in started:
+            self._quit(slot)
+
+    def _start(self) -> _PooledDriver:
+        slot = _PooledDriver(self.scraper_cls())
+        # Access the driver to start the browser. It is only tracked once it is running, so a
+        # browser that failed to start is never quit, which would start a new one.
+        slot.scraper.driver
+        with self._lock:
+            self._started.append(slot)
+        return slot
+
+    def _stop(self, slot: _PooledDriver) -> None:
+        with self._lock:
+            if slot in self._started:
+                self._started.remove(slot)
+        self._quit(slot)
+
+    def _quit(self, slot: _PooledDriver) -> None:
+        try:
+            slot.scraper.driver.quit()
+        except Exception as e:
+            log.warning('%s. Failed to quit selenium driver', type(e))
+
+    def _reset(self, slot: _PooledDriver) -> bool:
+        '''
+        Clear cookies, storage, extra windows and the current page of a browser. Returns False
+        if the browser could not be reset, like after it crashed.
+        '''
+        try:
+            self._clear(slot.scraper.driver)
+        except Exception as e:
+            log.warning('%s. Failed to reset selenium driver, recycling it',
+                        type(e))
+            return False
+        return True
+
+    def _clear(self, driver: Any) -> None:
+        while len(driver.window_handles) > 1:
+            driver.switch_to.window(driver.window_handles[-1])
+            driver.close()
+        driver.switch_to.window(driver.window_handles[0])
+        try:
+            driver.execute_script(
+                'window.localStorage.clear(); window.sessionStorage.clear();')
+        except Exception:
+            # Storage is not accessible from some pages, like about:blank
+            pass
+        driver.delete_all_cookies()
+        driver.get('about:blank')
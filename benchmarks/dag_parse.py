@@ -0,0 +1,265 @@
+'''
+Benchmark how long the Airflow scheduler takes to parse scraper DAG files, and how much memory
+they use, by loading generated DAG files through Airflow's `DagBag`.
+
+The DAG files are modeled on the example DAG in tests/example-as-scraper-airflow/dags, with one
+scraper task per file. Every measure runs in a fresh interpreter, like a DAG file processor:
+
+- import: time to import the operators, paid by the first DAG file parsed by a process, on
+  top of Airflow's `BaseOperator` only. The scraper module is imported after them, apart.
+- parse: time `DagBag` spends on each DAG file, as reported in its stats.
+- memory: memory still allocated per DAG file once the `DagBag` is filled.
+
+Results can be recorded in a JSON lines history, one entry per version of the package, and
+compared with the previous entry to catch regressions in the cost of constructing operators:
+
+    python benchmarks/dag_parse.py --dags 100 --record benchmarks/results/dag_parse.jsonl
+    python benchmarks/dag_parse.py --dags 100 --compare benchmarks/results/dag_parse.jsonl
+'''
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRAPER_MODULE = '''from typing import Optional
+from selenium.webdriver import Firefox
+from selenium.webdriver.common.by import By
+import pandas as pd
+from as_scraper.scraper import Scraper
+
+
+class SyntheticScraper(Scraper):
+    COLUMNS = ['name', 'url']
+    LOAD_JAVASCRIPT = True
+
+    def scrape_handler(self, url: str, html: Optional[str] = None, driver: Optional[Firefox] = None, **kwargs) -> pd.DataFrame:
+        rows = []
+        for a_tag in driver.find_elements(By.TAG_NAME, "a"):
+            rows.append({"name": a_tag.text, "url": a_tag.get_attribute("href")})
+        return pd.DataFrame(rows, columns=self.COLUMNS)
+'''
+
+DAG_TEMPLATE = '''from datetime import datetime, timedelta
+from airflow.models import DAG
+from scrapers.synthetic import SyntheticScraper
+from as_scraper_airflow.operators import {operator}
+
+
+with DAG(
+    dag_id="scraper_{index}",
+    default_args={{
+        'depends_on_past': False,
+        'email': ['airflow@example.com'],
+        'email_on_failure': False,
+        'email_on_retry': False,
+        'retries': 1,
+        'retry_delay': timedelta(minutes=5),
+    }},
+    description="A synthetic Scraper DAG",
+    schedule_interval=timedelta(days=1),
+    start_date=datetime(2022, 8, 4),
+    catchup=False,
+) as dag:
+    t1 = {operator}(
+        scraper_cls=SyntheticScraper,
+        urls=['https://www.example.com/sitemap/{index}'],
+        task_id='scrape',
+        save_errors=True,{arguments}
+    )
+'''
+
+OPERATOR_ARGUMENTS = {
+    'ScraperToLogsOperator': '',
+    'ScraperToBigqueryOperator': '''
+        destination_table='scrapers.synthetic_{index}',
+        bigquery_conn_id='bigquery',
+        schema='[{{"name": "name", "type": "STRING"}}, {{"name": "url", "type": "STRING"}}]',
+        error_table='scrapers.errors',
+        error_schema='[{{"name": "message", "type": "STRING"}}]','''
+}
+
+OPERATORS = {
+    'logs': ['ScraperToLogsOperator'],
+    'bigquery': ['ScraperToBigqueryOperator'],
+    'mixed': ['ScraperToLogsOperator', 'ScraperToBigqueryOperator'],
+}
+
+
+def generate_dags(folder: str, count: int, operators: List[str]) -> None:
+    '''
+    Write `count` DAG files in a folder, using the operators in turn, with the scraper module
+    they import.
+    '''
+    os.makedirs(os.path.join(folder, 'scrapers'), exist_ok=True)
+    with open(os.path.join(folder, 'scrapers', '__init__.py'), 'w'):
+        pass
+    with open(os.path.join(folder, 'scrapers', 'synthetic.py'), 'w') as file:
+        file.write(SCRAPER_MODULE)
+    for index in range(count):
+        operator = operators[index % len(operators)]
+        arguments = OPERATOR_ARGUMENTS[operator].format(index=index)
+        with open(os.path.join(folder, f'scraper_{index}.py'), 'w') as file:
+            file.write(DAG_TEMPLATE.format(
+                operator=operator, index=index, arguments=arguments))
+
+
+def measure_folder(folder: str, memory: bool) -> Dict[str, Any]:
+    '''
+    Fill a `DagBag` from the folder, in the current interpreter.
+    '''
+    from time import perf_counter
+    import tracemalloc
+    import airflow.models.baseoperator  # noqa: F401
+    from airflow.models.dagbag import DagBag
+    # The operators are imported first, so that the dependencies of the scraper module, like
+    # pandas, are not loaded yet and count against the operators if they import them
+    start = perf_counter()
+    from as_scraper_airflow.operators import ScraperToBigqueryOperator, ScraperToLogsOperator  # noqa: F401
+    import_seconds = perf_counter() - start
+    # The scraper is user code shared by the DAG files, measured apart from the operators
+    start = perf_counter()
+    import scrapers.synthetic  # noqa: F401
+    scraper_import_seconds = perf_counter() - start
+    if memory:
+        tracemalloc.start()
+    dagbag = DagBag(folder, include_examples=False,
+                    read_dags_from_db=False, safe_mode=False)
+    result = {
+        'scraper_import_seconds': scraper_import_seconds,
+        'import_seconds': import_seconds,
+        'parse_seconds': [stat.duration.total_seconds() for stat in dagbag.dagbag_stats
+                          if stat.file.endswith('.py') and 'scraper_' in stat.file],
+        'dags': len(dagbag.dags),
+        'import_errors': dagbag.import_errors,
+    }
+    if memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result.update(memory_bytes=current, peak_memory_bytes=peak)
+    return result
+
+
+def run_child(folder: str, memory: bool) -> Dict[str, Any]:
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, [folder, ROOT, os.environ.get('PYTHONPATH')])))
+    command = [sys.executable, os.path.abspath(__file__), '--child', folder]
+    if memory:
+        command.append('--memory')
+    output = subprocess.run(command, env=env, check=True,
+                            capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    if result['import_errors']:
+        file, error = next(iter(result['import_errors'].items()))
+        raise RuntimeError(
+            f'{len(result["import_errors"])} DAG files failed to import, like {file}: {error}')
+    return result
+
+
+def benchmark(count: int, operator: str, repeat: int) -> Dict[str, Any]:
+    '''
+    Median metrics of `repeat` parses of `count` generated DAG files.
+    '''
+    with tempfile.TemporaryDirectory() as folder:
+        generate_dags(folder, count, OPERATORS[operator])
+        runs = [run_child(folder, memory=False) for _ in range(repeat)]
+        # Tracing allocations slows parsing down, so memory is measured in a separate run
+        memory = run_child(folder, memory=True)
+    parse_seconds = [statistics.median(seconds) for seconds in zip(
+        *[sorted(run['parse_seconds']) for run in runs])]
+    return {
+        'dags': count,
+        'operator': operator,
+        'scraper_import_ms': statistics.median(run['scraper_import_seconds'] for run in runs) * 1000,
+        'import_ms': statistics.median(run['import_seconds'] for run in runs) * 1000,
+        'parse_total_ms': sum(parse_seconds) * 1000,
+        'parse_ms_per_dag': statistics.median(parse_seconds) * 1000,
+        'parse_p95_ms': parse_seconds[int(0.95 * (len(parse_seconds) - 1))] * 1000,
+        'memory_kib_per_dag': memory['memory_bytes'] / count / 1024,
+        'peak_memory_mib': memory['peak_memory_bytes'] / 2 ** 20,
+    }
+
+
+def environment() -> Dict[str, str]:
+    '''
+    Version of the package and of what it runs on, recorded with the results.
+    '''
+    import airflow
+    with open(os.path.join(ROOT, 'setup.py')) as file:
+        version = re.search(r"version='([^']+)'", file.read()).group(1)
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                                capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'version': version, 'commit': commit, 'python': platform.python_version(),
+            'airflow': airflow.__version__}
+
+
+COMPARED_METRICS = ['import_ms', 'parse_ms_per_dag', 'memory_kib_per_dag']
+
+
+def compare(result: Dict[str, Any], history: str, max_regression: float) -> bool:
+    '''
+    Print the change of every metric since the last recorded entry with the same DAG count and
+    operator. Returns False if a metric regressed by more than `max_regression`.
+    '''
+    with open(history) as file:
+        entries = [json.loads(line) for line in file if line.strip()]
+    entries = [entry for entry in entries
+               if (entry['dags'], entry['operator']) == (result['dags'], result['operator'])]
+    if not entries:
+        print(f'No entry for {result["dags"]} {result["operator"]} DAGs in {history}')
+        return True
+    previous = entries[-1]
+    print(f'Compared with {previous["version"]} ({previous["commit"]}):')
+    ok = True
+    for metric in COMPARED_METRICS:
+        change = result[metric] / previous[metric] - 1
+        regression = change > max_regression
+        ok = ok and not regression
+        print(f'  {metric:<20}{previous[metric]:>10.1f} -> {result[metric]:>10.1f}  {change:+7.1%}'
+              f'{"  REGRESSION" if regression else ""}')
+    return ok
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--dags', type=int, default=50)
+    parser.add_argument('--operator', choices=list(OPERATORS), default='mixed')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--record', metavar='HISTORY',
+                        help='Append the results to a JSON lines history.')
+    parser.add_argument('--compare', metavar='HISTORY',
+                        help='Compare the results with the last entry of a history.')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='Relative increase of a metric that fails --compare. Defaults to 0.2.')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--memory', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        print(json.dumps(measure_folder(args.child, args.memory)))
+        return
+    result = benchmark(args.dags, args.operator, args.repeat)
+    for metric, value in result.items():
+        print(f'{metric:<20}{value:>10.1f}' if isinstance(value, float) else f'{metric:<20}{value:>10}')
+    ok = True
+    if args.compare:
+        ok = compare(result, args.compare, args.max_regression)
+    if args.record:
+        os.makedirs(os.path.dirname(os.path.abspath(args.record)), exist_ok=True)
+        with open(args.record, 'a') as file:
+            file.write(json.dumps({**environment(), **result}) + '\n')
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
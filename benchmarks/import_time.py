@@ -0,0 +1,79 @@
+'''
+Benchmark the cost of importing the operators from a DAG file, which the Airflow scheduler pays
+every time it parses the file.
+
+Every import runs in a fresh interpreter, after Airflow's `BaseOperator`, which any DAG file
+imports anyway, so only the cost added by this package is measured. The `execute` rows import
+the dependencies that the operators load when they run, which is what parsing cost before the
+imports were deferred.
+
+To compare with another version of the package, check it out and pass its directory:
+
+    git worktree add /tmp/as-scraper-airflow-old <ref>
+    python benchmarks/import_time.py --path . --path /tmp/as-scraper-airflow-old
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Any, Dict, List, Optional
+
+HEAVY_MODULES = ['pandas', 'numpy', 'pyarrow', 'as_scraper', 'selenium', 'aiohttp',
+                 'google.cloud.bigquery', 'airflow.providers.google.cloud.hooks.bigquery']
+
+IMPORTS = {
+    'ScraperToLogsOperator': 'from as_scraper_airflow import ScraperToLogsOperator',
+    'ScraperToBigqueryOperator': 'from as_scraper_airflow import ScraperToBigqueryOperator',
+    'ScraperToLogsOperator + execute': '\n'.join([
+        'from as_scraper_airflow import ScraperToLogsOperator',
+        'import pandas, as_scraper.scraper, as_scraper.crawlers.crawler',
+        'import as_scraper_airflow.execution, as_scraper_airflow.fetch, as_scraper_airflow.pipeline',
+        'import as_scraper_airflow.checkpoint, as_scraper_airflow.dedup, as_scraper_airflow.cache',
+        'import as_scraper_airflow.webdriver_pool',
+    ]),
+}
+
+_PROBE = '''
+import json, sys
+from time import perf_counter
+import airflow.models.baseoperator
+start = perf_counter()
+exec(compile(sys.argv[1], "<import>", "exec"))
+seconds = perf_counter() - start
+print(json.dumps({"seconds": seconds, "modules": [m for m in json.loads(sys.argv[2]) if m in sys.modules]}))
+'''
+
+
+def measure(statement: str, path: str, repeat: int) -> Dict[str, Any]:
+    '''
+    Median time of an import statement in fresh interpreters, and the heavy modules it loads.
+    '''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, [path, os.environ.get('PYTHONPATH')])))
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', _PROBE, statement, json.dumps(HEAVY_MODULES)],
+                                env=env, check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {'ms': statistics.median(run['seconds'] for run in runs) * 1000, 'modules': runs[-1]['modules']}
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--path', action='append',
+                        help='Directory containing the as_scraper_airflow package to measure. '
+                             'Can be repeated. Defaults to this checkout.')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+    paths = args.path or [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+    print(f'{"path":<32}{"import":<34}{"ms":>8}  heavy modules')
+    for path in paths:
+        for name, statement in IMPORTS.items():
+            result = measure(statement, path, args.repeat)
+            print(f'{path[-31:]:<32}{name:<34}{result["ms"]:>8.1f}  {", ".join(result["modules"]) or "-"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+'''
+Benchmark the serialization of scraper results for BigQuery load jobs, comparing the JSON path
+of `ScraperToBigqueryOperator` with the Parquet path selected by `source_format='PARQUET'`.
+
+Only the client side of the load is measured: the time, peak memory and payload size of turning
+a dataframe into the file sent to BigQuery. The JSON path is measured the way
+`Client.load_table_from_json` serializes rows.
+
+Usage:
+
+    python benchmarks/load_formats.py --rows 100000 --repeat 3
+'''
+import argparse
+import json
+import random
+import string
+import tracemalloc
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional
+import pandas as pd
+from as_scraper_airflow.parquet import to_parquet
+
+SCHEMA = [
+    {'name': 'url', 'type': 'STRING', 'mode': 'REQUIRED'},
+    {'name': 'title', 'type': 'STRING'},
+    {'name': 'description', 'type': 'STRING'},
+    {'name': 'price', 'type': 'FLOAT'},
+    {'name': 'reviews', 'type': 'INTEGER'},
+    {'name': 'in_stock', 'type': 'BOOLEAN'},
+    {'name': 'scraped_date', 'type': 'TIMESTAMP'},
+]
+
+
+def synthetic_results(rows: int, seed: int = 0) -> pd.DataFrame:
+    '''
+    Scraper results shaped like the ones of the example DAG.
+    '''
+    rng = random.Random(seed)
+
+    def text(length: int) -> str:
+        return ''.join(rng.choices(string.ascii_letters + ' ', k=length))
+
+    return pd.DataFrame({
+        'url': [f'https://www.example.com/listing/{i}' for i in range(rows)],
+        'title': [text(30) for _ in range(rows)],
+        'description': [text(200) for _ in range(rows)],
+        'price': [rng.uniform(1, 1000) for _ in range(rows)],
+        'reviews': [rng.randint(0, 5000) for _ in range(rows)],
+        'in_stock': [rng.random() < 0.8 for _ in range(rows)],
+        'scraped_date': '2022-01-01T00:00:00-04:00',
+    })
+
+
+def json_payload(df: pd.DataFrame) -> bytes:
+    rows = df.to_dict(orient='records')
+    return '\n'.join(json.dumps(row, ensure_ascii=False) for row in rows).encode()
+
+
+def parquet_payload(df: pd.DataFrame) -> bytes:
+    return to_parquet(df, SCHEMA).getvalue()
+
+
+def measure(serialize: Callable[[pd.DataFrame], bytes], df: pd.DataFrame, repeat: int) -> Dict[str, Any]:
+    '''
+    Best time, peak memory and payload size of a serialization.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        payload = serialize(df)
+        times.append(perf_counter() - start)
+    tracemalloc.start()
+    serialize(df)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': min(times), 'peak_mib': peak / 2 ** 20, 'payload_mib': len(payload) / 2 ** 20}
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+    df = synthetic_results(args.rows)
+    results = {
+        'NEWLINE_DELIMITED_JSON': measure(json_payload, df, args.repeat),
+        'PARQUET': measure(parquet_payload, df, args.repeat),
+    }
+    print(f'{args.rows} rows')
+    print(f'{"format":<24}{"seconds":>10}{"peak MiB":>10}{"payload MiB":>13}')
+    for source_format, result in results.items():
+        print(f'{source_format:<24}{result["seconds"]:>10.3f}{result["peak_mib"]:>10.1f}'
+              f'{result["payload_mib"]:>13.1f}')
+    speedup = results['NEWLINE_DELIMITED_JSON']['seconds'] / \
+        results['PARQUET']['seconds']
+    print(f'PARQUET is {speedup:.1f}x faster')
+
+
+if __name__ == '__main__':
+    main()
@@ -27,11 +27,20 @@ setup(
         'apache-airflow-providers-google',
         'as-scraper',
     ],
-    python_requires=">=3.6",
+    extras_require={
+        'async': ['aiohttp>=3.7'],
+        'parquet': ['pyarrow>=3.0'],
+        'storage-write': ['google-cloud-bigquery-storage>=2.27', 'pyarrow>=3.0'],
+    },
+    python_requires=">=3.7",
     classifiers=[
         'Intended Audience :: Developers',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
         'Operating System :: POSIX',
         'License :: OSI Approved :: MIT License',
         'Topic :: Software Development :: Libraries'
@@ -0,0 +1,72 @@
+from decimal import Decimal
+import pandas as pd
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+from as_scraper_airflow.parquet import to_arrow, to_parquet  # noqa: E402
+
+SCHEMA = [
+    {'name': 'position', 'type': 'INTEGER'},
+    {'name': 'price', 'type': 'NUMERIC'},
+    {'name': 'rating', 'type': 'FLOAT'},
+    {'name': 'available', 'type': 'BOOLEAN'},
+    {'name': 'published', 'type': 'TIMESTAMP'},
+    {'name': 'title', 'type': 'STRING'},
+]
+
+
+def rows(count):
+    return pd.DataFrame({
+        'position': [str(i) for i in range(count)],
+        'price': [f'{i}.5' for i in range(count)],
+        'rating': [str(i / 10) for i in range(count)],
+        'available': ['true' if i % 2 else 'false' for i in range(count)],
+        'published': ['2022-01-01T10:00:00+01:00'] * count,
+        'title': list(range(count)),
+    })
+
+
+def test_coerces_values_to_their_field_type():
+    table = to_arrow(rows(3), SCHEMA)
+    assert table.column('position').to_pylist() == [0, 1, 2]
+    assert table.column('price').to_pylist() == [Decimal('0.5'), Decimal('1.5'), Decimal('2.5')]
+    assert table.column('rating').to_pylist() == [0.0, 0.1, 0.2]
+    assert table.column('available').to_pylist() == [False, True, False]
+    assert {value.isoformat() for value in table.column('published').to_pylist()} == {
+        '2022-01-01T09:00:00+00:00'}
+    assert table.column('title').to_pylist() == ['0', '1', '2']
+
+
+def test_bad_values_are_set_to_null():
+    df = rows(100)
+    df.loc[3, 'position'] = 'N/A'
+    df.loc[4, 'position'] = '2.5'
+    df.loc[5, 'available'] = 'yes'
+    df.loc[5, 'price'] = 'free'
+    df.loc[6, 'rating'] = 'unrated'
+    df.loc[7, 'published'] = 'yesterday'
+    table = pq.read_table(to_parquet(df, SCHEMA, max_bad_records=5))
+    assert table.num_rows == 100
+    assert table.column('position').to_pylist()[2:6] == [2, None, None, 5]
+    assert table.column('available').to_pylist()[5] is None
+    assert table.column('price').to_pylist()[5] is None
+    assert table.column('rating').to_pylist()[6] is None
+    assert table.column('published').to_pylist()[7] is None
+    assert table.column('published').null_count == 1
+
+
+def test_bad_values_fail_past_max_bad_records():
+    df = rows(100)
+    df.loc[:5, 'position'] = 'N/A'
+    with pytest.raises(ValueError, match='6 rows have values that do not match'):
+        to_arrow(df, SCHEMA, max_bad_records=5)
+    with pytest.raises(ValueError, match='1 rows'):
+        to_arrow(rows(3).assign(available=['yes', 'true', 'false']), SCHEMA)
+
+
+def test_mixed_timestamp_formats():
+    df = rows(3).assign(published=['2022-01-01', '2022-01-01T10:00:00Z', '2022-01-01 12:30'])
+    table = to_arrow(df, SCHEMA)
+    assert [value.isoformat() for value in table.column('published').to_pylist()] == [
+        '2022-01-01T00:00:00+00:00', '2022-01-01T10:00:00+00:00', '2022-01-01T12:30:00+00:00']
@@ -0,0 +1,319 @@
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+import os
+import threading
+from time import monotonic, sleep
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+import pandas as pd
+import pytest
+import requests
+from as_scraper.exceptions import ThresholdException
+from as_scraper.scraper import Scraper
+from as_scraper_airflow.operators import ScraperOperator
+from as_scraper_airflow.scheduler import RetryPolicy
+
+URLS = [f'https://example.com/{i}' for i in range(1000)]
+
+
+class ExampleScraper(Scraper):
+    COLUMNS = ['url', 'title']
+    # Urls whose position is lower than this fail
+    failing = 0
+
+    def _load_html_requests(self, url):
+        return b'<html></html>'
+
+    def scrape_handler(self, url, html=None, driver=None, **kwargs):
+        position = int(url.rsplit('/', 1)[-1])
+        if position < self.failing:
+            raise ValueError(f'Failed to scrape {url}')
+        return pd.DataFrame([{'url': url, 'title': str(position)}])
+
+
+class ExampleCrawler:
+    def crawl(self):
+        yield from URLS
+
+
+class MemoryOperator(ScraperOperator):
+    '''
+    Operator keeping the chunks of results it stores.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chunks = []
+
+    def test_storage_connection(self):
+        pass
+
+    def store_results(self, df):
+        self.chunks.append(df)
+
+
+@pytest.fixture
+def context():
+    ti = SimpleNamespace(dag_id='dag', task_id='scrape',
+                         run_id='scheduled__2022-01-01T00:00:00+00:00', map_index=-1)
+    return {'ti': ti, 'dag_run': SimpleNamespace(start_date=datetime(2022, 1, 1, tzinfo=timezone.utc))}
+
+
+def failing_scraper(failing):
+    return type('FailingScraper', (ExampleScraper,), {'failing': failing})
+
+
+def stored_rows(operator):
+    return sum(len(chunk) for chunk in operator.chunks)
+
+
+BATCHED_RUNS = {
+    'sequential': {'urls': URLS},
+    'workers': {'urls': URLS, 'max_workers': 4},
+    'batches': {'urls': URLS, 'pipeline_batch_size': 100},
+    'crawler': {'crawler_cls': ExampleCrawler},
+    'crawler_workers': {'crawler_cls': ExampleCrawler, 'max_workers': 4},
+}
+
+
+@pytest.mark.parametrize('run', BATCHED_RUNS)
+def test_error_threshold_applies_to_the_whole_run(context, run):
+    # The errors of the first batch pass 5% of the batch, but not 5% of the run
+    operator = MemoryOperator(task_id='scrape', scraper_cls=failing_scraper(6), **BATCHED_RUNS[run])
+    operator.execute(context)
+    assert stored_rows(operator) == 994
+
+
+@pytest.mark.parametrize('run', BATCHED_RUNS)
+def test_error_threshold_fails_the_run(context, run):
+    operator = MemoryOperator(task_id='scrape', scraper_cls=failing_scraper(60), **BATCHED_RUNS[run])
+    with pytest.raises(ThresholdException):
+        operator.execute(context)
+
+
+class FakeDriver:
+    started = []
+
+    def __init__(self):
+        FakeDriver.started.append(self)
+        self.window_handles = ['main']
+        self.switch_to = SimpleNamespace(window=lambda handle: None)
+        self.url = None
+        self.quit_count = 0
+
+    def execute_script(self, script):
+        pass
+
+    def delete_all_cookies(self):
+        pass
+
+    def get(self, url):
+        self.url = url
+
+    def quit(self):
+        self.quit_count += 1
+
+
+class JavascriptScraper(ExampleScraper):
+    LOAD_JAVASCRIPT = True
+
+    @property
+    def driver(self):
+        if self._driver is None:
+            self._driver = FakeDriver()
+        return self._driver
+
+    def scrape_handler(self, url, html=None, driver=None, **kwargs):
+        assert driver.url == url
+        return super().scrape_handler(url, html, driver, **kwargs)
+
+
+def test_batches_share_browsers(context):
+    FakeDriver.started = []
+    operator = MemoryOperator(task_id='scrape', scraper_cls=JavascriptScraper,
+                              crawler_cls=ExampleCrawler, pipeline_batch_size=100)
+    operator.execute(context)
+    assert stored_rows(operator) == 1000
+    browser, = FakeDriver.started
+    assert browser.quit_count == 1
+
+
+@pytest.mark.parametrize('flush', [{'flush_every_rows': 7}, {'flush_every_rows': 7, 'flush_every_seconds': 60}])
+def test_flushes_results_while_scraping(context, flush):
+    operator = MemoryOperator(task_id='scrape', scraper_cls=ExampleScraper, urls=URLS[:20], **flush)
+    operator.execute(context)
+    assert [len(chunk) for chunk in operator.chunks] == [7, 7, 6]
+    assert list(pd.concat(operator.chunks).url) == URLS[:20]
+
+
+def test_flushes_results_every_seconds(context):
+    operator = MemoryOperator(task_id='scrape', scraper_cls=ExampleScraper, urls=URLS[:250],
+                              flush_every_seconds=0)
+    operator.execute(context)
+    assert [len(chunk) for chunk in operator.chunks] == [100, 100, 50]
+
+
+class CountingScraper(ExampleScraper):
+    scraped = []
+
+    def scrape_handler(self, url, html=None, driver=None, **kwargs):
+        CountingScraper.scraped.append(url)
+        return super().scrape_handler(url, html, driver, **kwargs)
+
+
+class FailingOperator(MemoryOperator):
+    '''
+    Operator whose storage fails after storing `chunks_before_failure` chunks.
+    '''
+
+    def __init__(self, *args, chunks_before_failure=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chunks_before_failure = chunks_before_failure
+
+    def store_results(self, df):
+        if self.chunks_before_failure is not None and len(self.chunks) == self.chunks_before_failure:
+            raise RuntimeError('Storage is down')
+        super().store_results(df)
+
+
+def test_retry_resumes_from_checkpoint(tmp_path, context):
+    CountingScraper.scraped = []
+    options = dict(task_id='scrape', scraper_cls=CountingScraper, urls=URLS[:50],
+                   checkpoint_dir=str(tmp_path), pipeline_batch_size=10, flush_every_rows=10,
+                   pipeline_queue_size=1)
+    operator = FailingOperator(chunks_before_failure=2, **options)
+    with pytest.raises(RuntimeError, match='Storage is down'):
+        operator.execute(context)
+    first_attempt = list(CountingScraper.scraped)
+    assert 20 <= len(first_attempt) < 50
+
+    CountingScraper.scraped = []
+    retry = FailingOperator(**options)
+    retry.execute(context)
+    # Urls recorded by the first attempt are replayed, not scraped again
+    assert sorted(first_attempt + CountingScraper.scraped) == sorted(URLS[:50])
+    assert sorted(pd.concat(retry.chunks).url) == sorted(URLS[:50])
+    # The checkpoint is deleted once the run succeeds
+    assert [name for _, _, names in os.walk(tmp_path) for name in names] == []
+
+
+class SlowScraper(ExampleScraper):
+    '''
+    Scraper whose requests take 20ms, recording when they start and how many are in flight.
+    '''
+    lock = threading.Lock()
+    in_flight = Counter()
+    max_in_flight = Counter()
+    started = defaultdict(list)
+
+    def _load_html_requests(self, url):
+        host = urlsplit(url).hostname
+        with self.lock:
+            self.started[host].append(monotonic())
+            self.in_flight[host] += 1
+            self.in_flight['all'] += 1
+            for key in (host, 'all'):
+                self.max_in_flight[key] = max(self.max_in_flight[key], self.in_flight[key])
+        sleep(0.02)
+        with self.lock:
+            self.in_flight[host] -= 1
+            self.in_flight['all'] -= 1
+        return b'<html></html>'
+
+
+def host_urls(hosts, urls_per_host):
+    return [f'https://host{host}.com/{i}' for i in range(urls_per_host) for host in range(hosts)]
+
+
+@pytest.fixture
+def slow_scraper():
+    SlowScraper.in_flight = Counter()
+    SlowScraper.max_in_flight = Counter()
+    SlowScraper.started = defaultdict(list)
+    return SlowScraper
+
+
+def test_hosts_are_scraped_concurrently_within_their_limits(context, slow_scraper):
+    operator = MemoryOperator(task_id='scrape', scraper_cls=slow_scraper, urls=host_urls(4, 5),
+                              requests_per_host=1000, max_connections_per_host=1)
+    operator.execute(context)
+    assert stored_rows(operator) == 20
+    # Workers default to max_connections, so the hosts are scraped at the same time
+    assert slow_scraper.max_in_flight['all'] > 1
+    assert max(slow_scraper.max_in_flight[f'host{host}.com'] for host in range(4)) == 1
+
+
+def test_requests_per_host_are_rate_limited(context, slow_scraper):
+    operator = MemoryOperator(task_id='scrape', scraper_cls=slow_scraper, urls=host_urls(2, 4),
+                              requests_per_host=10, max_workers=4)
+    operator.execute(context)
+    assert stored_rows(operator) == 8
+    for started in slow_scraper.started.values():
+        intervals = [later - earlier for earlier, later in zip(started, started[1:])]
+        assert len(intervals) == 3
+        assert min(intervals) >= 0.09
+
+
+class FlakyScraper(ExampleScraper):
+    '''
+    Scraper whose requests can't connect the first time for every url, or ever for the urls of
+    `unreachable` hosts.
+    '''
+    unreachable = ()
+    attempts = Counter()
+
+    def _load_html_requests(self, url):
+        self.attempts[url] += 1
+        if self.attempts[url] == 1 or urlsplit(url).hostname in self.unreachable:
+            raise requests.ConnectionError(f'Failed to connect to {url}')
+        return b'<html></html>'
+
+
+def flaky_scraper(unreachable=()):
+    return type('FlakyScraper', (FlakyScraper,), {'unreachable': unreachable, 'attempts': Counter()})
+
+
+def test_transient_errors_are_retried(context):
+    scraper_cls = flaky_scraper()
+    operator = MemoryOperator(task_id='scrape', scraper_cls=scraper_cls, urls=host_urls(2, 10),
+                              retry_policy=RetryPolicy(backoff=0.01), max_workers=2)
+    operator.execute(context)
+    assert sorted(pd.concat(operator.chunks).url) == sorted(host_urls(2, 10))
+    assert set(scraper_cls.attempts.values()) == {2}
+
+
+def test_retries_stop_after_the_last_attempt(context):
+    scraper_cls = flaky_scraper(unreachable=['unreachable.com'])
+    unreachable = [f'https://unreachable.com/{i}' for i in range(40)]
+    operator = MemoryOperator(task_id='scrape', scraper_cls=scraper_cls, urls=unreachable + URLS[:960],
+                              retry_policy=RetryPolicy(attempts=3, backoff=0.01), max_workers=2)
+    operator.execute(context)
+    # The unreachable urls fail every attempt, and are errors within the threshold
+    assert stored_rows(operator) == 960
+    assert [scraper_cls.attempts[url] for url in unreachable] == [3] * 40
+    assert [scraper_cls.attempts[url] for url in URLS[:960]] == [2] * 960
+
+
+def test_thread_workers_keep_the_input_order(context, slow_scraper):
+    operator = MemoryOperator(task_id='scrape', scraper_cls=slow_scraper, urls=URLS[:40], max_workers=4)
+    operator.execute(context)
+    assert list(pd.concat(operator.chunks).url) == URLS[:40]
+    assert slow_scraper.max_in_flight['all'] == 4
+
+
+class ProcessScraper(ExampleScraper):
+    COLUMNS = ['url', 'title', 'pid']
+
+    def scrape_handler(self, url, html=None, driver=None, **kwargs):
+        df = super().scrape_handler(url, html, driver, **kwargs)
+        return df.assign(pid=os.getpid())
+
+
+def test_process_workers_keep_the_input_order(context):
+    operator = MemoryOperator(task_id='scrape', scraper_cls=ProcessScraper, urls=URLS[:40],
+                              worker_executor='process', max_workers=2)
+    operator.execute(context)
+    df = pd.concat(operator.chunks)
+    assert list(df.url) == URLS[:40]
+    # The urls are scraped in worker processes
+    assert os.getpid() not in set(df.pid)
@@ -0,0 +1,234 @@
+import asyncio
+from datetime import datetime, timezone
+import itertools
+import os
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+import pytest
+from airflow.exceptions import AirflowException, TaskDeferred
+from google.api_core.exceptions import NotFound
+from as_scraper.scraper import Scraper
+from as_scraper_airflow.operators import ScraperToBigqueryOperator
+from as_scraper_airflow.triggers import BigQueryLoadJobsTrigger
+
+
+class ExampleScraper(Scraper):
+    COLUMNS = ['url', 'title']
+
+    def _load_html_requests(self, url):
+        return b'<html></html>'
+
+    def scrape_handler(self, url, html=None, driver=None, **kwargs):
+        return pd.DataFrame([{'url': url, 'title': url.rsplit('/', 1)[-1]}])
+
+
+class FakeJob:
+    '''
+    Load job that is done after being polled `polls` times.
+    '''
+    ids = itertools.count()
+
+    def __init__(self, rows, job_config, polls=2, error_result=None):
+        self.job_id = f'job_{next(self.ids)}'
+        self.project = 'project'
+        self.location = 'EU'
+        self.rows = rows
+        self.write_disposition = job_config.write_disposition
+        self.polls = polls
+        self.ended = None
+        self.error_result = error_result
+        self.errors = None if error_result is None else [error_result]
+
+    @property
+    def state(self):
+        self.polls -= 1
+        if self.polls > 0:
+            return 'RUNNING'
+        self.ended = datetime(2022, 1, 1, tzinfo=timezone.utc)
+        return 'DONE'
+
+    def result(self):
+        raise AssertionError('Deferrable operators must not wait for load jobs')
+
+
+class FakeClient:
+    project = 'project'
+
+    def __init__(self, error_result=None):
+        self.jobs = {}
+        self.error_result = error_result
+        self.tables = set()
+        self.copies = []
+
+    def get_table(self, table):
+        raise NotFound(f'Table {table} not found')
+
+    def create_table(self, table, exists_ok=False):
+        self.tables.add(f'{table.dataset_id}.{table.table_id}')
+
+    def delete_table(self, table, not_found_ok=False):
+        self.tables.remove(table)
+
+    def copy_table(self, source, destination, job_config):
+        self.copies.append((source, destination, job_config.write_disposition))
+        return SimpleNamespace(result=lambda: None)
+
+    def load_table_from_json(self, rows, destination, job_config):
+        assert destination in self.tables
+        job = FakeJob(rows, job_config, error_result=self.error_result)
+        self.jobs[job.job_id] = job
+        return job
+
+    def get_job(self, job_id, project=None, location=None):
+        if job_id not in self.jobs:
+            raise KeyError(f'Job {job_id} not found')
+        return self.jobs[job_id]
+
+
+@pytest.fixture
+def context():
+    ti = SimpleNamespace(dag_id='dag', task_id='scrape',
+                         run_id='scheduled__2022-01-01T00:00:00+00:00', map_index=-1)
+    return {'ti': ti, 'dag_run': SimpleNamespace(start_date=datetime(2022, 1, 1, tzinfo=timezone.utc))}
+
+
+def make_operator(tmp_path, client):
+    operator = ScraperToBigqueryOperator(
+        task_id='scrape',
+        scraper_cls=ExampleScraper,
+        urls=[f'https://example.com/{i}' for i in range(10)],
+        destination_table='dataset.table',
+        bigquery_conn_id='bigquery',
+        schema='[{"name": "url", "type": "STRING"}, {"name": "title", "type": "STRING"}, '
+               '{"name": "scraped_date", "type": "TIMESTAMP"}]',
+        write_disposition='WRITE_APPEND',
+        deferrable=True,
+        poll_interval=0.01,
+        flush_every_rows=4,
+        drop_duplicates=['url'],
+        fingerprint_index=str(tmp_path / 'index.npy'),
+        checkpoint_dir=str(tmp_path / 'checkpoints'),
+    )
+    operator._bq_client = client
+    return operator
+
+
+def run_trigger(trigger, client):
+    # The triggerer rebuilds the trigger from its serialized form
+    classpath, kwargs = trigger.serialize()
+    assert classpath == 'as_scraper_airflow.triggers.bigquery.BigQueryLoadJobsTrigger'
+    trigger = BigQueryLoadJobsTrigger(**kwargs)
+    trigger.get_client = lambda: client
+
+    async def first_event():
+        async for event in trigger.run():
+            return event.payload
+    return asyncio.run(first_event())
+
+
+def checkpoint_files(tmp_path):
+    return [name for _, _, names in os.walk(tmp_path / 'checkpoints') for name in names]
+
+
+def test_deferred_run_completes_after_load_jobs(tmp_path, context):
+    client = FakeClient()
+    operator = make_operator(tmp_path, client)
+    with pytest.raises(TaskDeferred) as deferred:
+        operator.execute(context)
+    assert deferred.value.method_name == 'execute_complete'
+    assert [len(job.rows) for job in client.jobs.values()] == [4, 4, 2]
+    # Flushed chunks are staged, so that a retry does not append them twice
+    staging_table = deferred.value.kwargs['staging_table']
+    assert client.tables == {staging_table}
+    assert client.copies == []
+    # Nothing is marked as stored until the load jobs are done
+    assert len(np.load(tmp_path / 'index.npy')) == 0
+    assert checkpoint_files(tmp_path) == ['scheduled__2022-01-01T00%3A00%3A00%2B00%3A00.sqlite']
+
+    event = run_trigger(deferred.value.trigger, client)
+    assert event['status'] == 'success'
+    assert sorted(event['jobs']) == sorted(client.jobs)
+    assert all(outcome['ended'] is not None for outcome in event['jobs'].values())
+
+    # The task resumes on a new instance of the operator
+    resumed = make_operator(tmp_path, client)
+    getattr(resumed, deferred.value.method_name)(
+        context, event, **deferred.value.kwargs)
+    assert client.copies == [(staging_table, 'dataset.table', 'WRITE_APPEND')]
+    assert client.tables == set()
+    assert len(np.load(tmp_path / 'index.npy')) == 10
+    assert checkpoint_files(tmp_path) == []
+    assert sorted(os.listdir(tmp_path)) == ['checkpoints', 'index.npy']
+
+
+def test_failed_trigger_keeps_the_run_uncommitted(tmp_path, context):
+    client = FakeClient()
+    operator = make_operator(tmp_path, client)
+    with pytest.raises(TaskDeferred) as deferred:
+        operator.execute(context)
+
+    event = run_trigger(deferred.value.trigger, FakeClient())
+    assert event['status'] == 'error'
+    assert 'not found' in event['message']
+
+    resumed = make_operator(tmp_path, client)
+    with pytest.raises(AirflowException, match='Failed waiting for load jobs'):
+        resumed.execute_complete(context, event, **deferred.value.kwargs)
+    assert len(np.load(tmp_path / 'index.npy')) == 0
+    assert len(checkpoint_files(tmp_path)) == 1
+
+
+def test_failed_load_job_keeps_the_run_uncommitted(tmp_path, context):
+    client = FakeClient(error_result={'reason': 'invalid', 'message': 'Bad row'})
+    operator = make_operator(tmp_path, client)
+    with pytest.raises(TaskDeferred) as deferred:
+        operator.execute(context)
+
+    event = run_trigger(deferred.value.trigger, client)
+    assert event['status'] == 'success'
+    assert all(outcome['error_result'] is not None for outcome in event['jobs'].values())
+
+    resumed = make_operator(tmp_path, client)
+    with pytest.raises(AirflowException, match='Load jobs failed'):
+        resumed.execute_complete(context, event, **deferred.value.kwargs)
+    assert client.copies == []
+    assert len(np.load(tmp_path / 'index.npy')) == 0
+    assert len(checkpoint_files(tmp_path)) == 1
+
+
+@pytest.mark.parametrize('options', [{'write_disposition': 'WRITE_TRUNCATE'},
+                                     {'write_disposition': 'WRITE_APPEND', 'upsert': True}])
+def test_fingerprint_index_requires_appends(tmp_path, options):
+    with pytest.raises(AirflowException, match='fingerprint_index requires'):
+        ScraperToBigqueryOperator(
+            task_id='scrape', scraper_cls=ExampleScraper, urls=[], destination_table='dataset.table',
+            bigquery_conn_id='bigquery', schema='[{"name": "url", "type": "STRING"}]',
+            drop_duplicates=['url'], fingerprint_index=str(tmp_path / 'index.npy'), **options)
+
+
+def upsert_operator(**options):
+    return ScraperToBigqueryOperator(
+        task_id='scrape', scraper_cls=ExampleScraper, urls=[], destination_table='dataset.table',
+        bigquery_conn_id='bigquery', upsert=True, merge_keys=['url', 'page'],
+        schema='[{"name": "url", "type": "STRING"}, {"name": "page", "type": "INTEGER"}, '
+               '{"name": "title", "type": "STRING"}, {"name": "scraped_date", "type": "TIMESTAMP"}]',
+        **options)
+
+
+def test_merge_query():
+    assert upsert_operator().merge_query('dataset.staging') == '\n'.join([
+        'MERGE `dataset.table` T',
+        'USING (SELECT * FROM `dataset.staging` WHERE TRUE',
+        '       QUALIFY ROW_NUMBER() OVER (PARTITION BY `url`, `page`) = 1) S',
+        'ON T.`url` IS NOT DISTINCT FROM S.`url` AND T.`page` IS NOT DISTINCT FROM S.`page`',
+        'WHEN MATCHED THEN UPDATE SET `title` = S.`title`, `scraped_date` = S.`scraped_date`',
+        'WHEN NOT MATCHED THEN INSERT (`url`, `page`, `title`, `scraped_date`) '
+        'VALUES (S.`url`, S.`page`, S.`title`, S.`scraped_date`)',
+    ])
+
+
+def test_merge_query_skips_unchanged_rows():
+    query = upsert_operator(skip_unchanged=True).merge_query('dataset.staging')
+    assert ('WHEN MATCHED AND FARM_FINGERPRINT(TO_JSON_STRING(STRUCT(T.`title`))) != '
+            'FARM_FINGERPRINT(TO_JSON_STRING(STRUCT(S.`title`))) THEN UPDATE SET') in query
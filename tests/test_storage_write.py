@@ -0,0 +1,171 @@
+import pandas as pd
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+pytest.importorskip('google.cloud.bigquery_storage_v1')
+from google.cloud.bigquery_storage_v1 import types  # noqa: E402
+from as_scraper_airflow import storage_write  # noqa: E402
+from as_scraper_airflow.storage_write import StorageWriteSink  # noqa: E402
+
+TABLE = 'projects/project/datasets/dataset/tables/table'
+SCHEMA = [{'name': 'url', 'type': 'STRING'}, {'name': 'position', 'type': 'INTEGER'}]
+
+
+class FakeFuture:
+    def __init__(self, stream, request, error=None):
+        self.stream = stream
+        self.request = request
+        self.error = error
+        self.done = False
+
+    def result(self):
+        if not self.done:
+            self.done = True
+            self.stream.outstanding -= 1
+        if self.error is not None:
+            raise self.error
+        return types.AppendRowsResponse(append_result={'offset': self.request.offset})
+
+
+class FakeAppendRowsStream:
+    '''
+    Connection to a write stream that answers requests once their result is waited for.
+    '''
+
+    def __init__(self, client, template):
+        self.client = client
+        self.template = template
+        self.requests = []
+        self.outstanding = 0
+        # Requests waiting for their response when every request was sent
+        self.outstanding_at_send = []
+        self.closed = False
+        client.connections.append(self)
+
+    def send(self, request):
+        assert not self.closed
+        self.outstanding_at_send.append(self.outstanding)
+        self.requests.append(request)
+        self.outstanding += 1
+        return FakeFuture(self, request, self.client.append_errors.get(len(self.requests) - 1))
+
+    def close(self):
+        self.closed = True
+
+    def batches(self):
+        schema = pa.ipc.read_schema(pa.py_buffer(
+            self.template.arrow_rows.writer_schema.serialized_schema))
+        return [pa.ipc.read_record_batch(pa.py_buffer(request.arrow_rows.rows.serialized_record_batch),
+                                         schema) for request in self.requests]
+
+
+class FakeWriteClient:
+    def __init__(self, stream_errors=None, append_errors=None):
+        self.stream_errors = stream_errors or []
+        self.append_errors = append_errors or {}
+        self.connections = []
+        self.calls = []
+
+    def create_write_stream(self, parent, write_stream):
+        self.calls.append(('create', parent, write_stream.type_))
+        return types.WriteStream(name=f'{parent}/streams/stream_{len(self.calls)}', type_=write_stream.type_)
+
+    def finalize_write_stream(self, name):
+        assert all(connection.closed for connection in self.connections)
+        self.calls.append(('finalize', name))
+        return types.FinalizeWriteStreamResponse()
+
+    def batch_commit_write_streams(self, request):
+        self.calls.append(('commit', request.parent, list(request.write_streams)))
+        return types.BatchCommitWriteStreamsResponse(stream_errors=self.stream_errors)
+
+
+@pytest.fixture(autouse=True)
+def fake_append_rows_stream(monkeypatch):
+    monkeypatch.setattr(storage_write.writer,
+                        'AppendRowsStream', FakeAppendRowsStream)
+
+
+def rows(start, stop):
+    return pd.DataFrame({'url': [f'https://example.com/{i}' for i in range(start, stop)],
+                         'position': range(start, stop)})
+
+
+def test_appends_batches_at_consecutive_offsets():
+    client = FakeWriteClient()
+    sink = StorageWriteSink(client, TABLE, SCHEMA, max_request_bytes=1000)
+    sink.append(rows(0, 100))
+    sink.append(rows(100, 150))
+    sink.commit()
+
+    connection, = client.connections
+    assert connection.template.write_stream.startswith(f'{TABLE}/streams/')
+    batches = connection.batches()
+    assert len(batches) > 2
+    assert all(batch.nbytes <= 1000 for batch in batches)
+    offsets = [request.offset for request in connection.requests]
+    assert offsets == [sum(batch.num_rows for batch in batches[:i]) for i in range(len(batches))]
+    assert pa.Table.from_batches(batches).to_pandas().equals(rows(0, 150))
+    assert sink.rows == 150
+
+
+def test_bounds_requests_in_flight():
+    client = FakeWriteClient()
+    sink = StorageWriteSink(client, TABLE, SCHEMA,
+                            max_request_bytes=500, max_in_flight=3)
+    for start in range(0, 200, 50):
+        sink.append(rows(start, start + 50))
+        assert client.connections[0].outstanding <= 3
+    connection, = client.connections
+    assert len(connection.requests) > 10
+    assert max(connection.outstanding_at_send) == 3
+    sink.commit()
+    assert connection.outstanding == 0
+
+
+def test_commit_finalizes_and_commits_the_stream():
+    client = FakeWriteClient()
+    sink = StorageWriteSink(client, TABLE, SCHEMA)
+    sink.append(rows(0, 0))
+    assert client.calls == []
+    sink.append(rows(0, 10))
+    sink.commit()
+
+    stream = client.connections[0].template.write_stream
+    assert client.calls == [
+        ('create', TABLE, types.WriteStream.Type.PENDING),
+        ('finalize', stream),
+        ('commit', TABLE, [stream]),
+    ]
+    assert client.connections[0].closed
+    # The stream is committed once
+    sink.commit()
+    sink.close()
+    assert len(client.calls) == 3
+
+
+def test_commit_without_rows_does_nothing():
+    client = FakeWriteClient()
+    sink = StorageWriteSink(client, TABLE, SCHEMA)
+    sink.commit()
+    assert client.calls == []
+
+
+def test_stream_errors_fail_the_commit():
+    client = FakeWriteClient(stream_errors=[types.StorageError(
+        code=types.StorageError.StorageErrorCode.STREAM_FINALIZED, error_message='Stream already committed')])
+    sink = StorageWriteSink(client, TABLE, SCHEMA)
+    sink.append(rows(0, 10))
+    with pytest.raises(RuntimeError, match='Stream already committed'):
+        sink.commit()
+
+
+def test_failed_append_is_not_committed():
+    client = FakeWriteClient(append_errors={1: ValueError('Invalid offset')})
+    sink = StorageWriteSink(client, TABLE, SCHEMA, max_request_bytes=500)
+    sink.append(rows(0, 50))
+    with pytest.raises(ValueError, match='Invalid offset'):
+        sink.commit()
+    sink.close()
+    assert [call[0] for call in client.calls] == ['create']
+    assert client.connections[0].closed